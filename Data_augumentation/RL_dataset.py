@@ -1,17 +1,24 @@
-from openai import OpenAI
-
-client = OpenAI()
 import dotenv
-import pandas as pd
+import functools
 import os
+import argparse
+from llm_cache import add_cache_arguments, configure_llm_cache, get_llm_cache
+from result_sink import JsonlSink, hash_input
+import tracing
 
 dotenv.load_dotenv()
 
 # Set up OpenAI API key
 openai_key = os.getenv("OPENAI_API_KEY")
 
-# Load dataset (CSV example)
-df = pd.read_csv("data/finetuning_dataset/confirmed/generated_expectations_20241231_185728.csv")  # Replace with your actual file
+
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """
+    OpenAI client, created on first use so importing this module stays cheap.
+    """
+    from openai import OpenAI
+    return OpenAI()
 
 # Few-shot examples in GSM8K format
 few_shot_examples = """
@@ -60,19 +67,64 @@ def generate_gsm8k_answer(row):
     GSM8K-Formatted Answer:
     """
 
-    response = client.chat.completions.create(model="gpt-4o-mini",
-    messages=[
+    messages = [
         {"role": "system", "content": "You are an AI that formats answers in GSM8K style with reasoning."},
         {"role": "user", "content": prompt}
-    ],
-    temperature=0.7)
+    ]
 
-    return response.choices[0].message.content.strip()
+    with tracing.span('llm', 'gsm8k_answer', model="gpt-4o-mini", cache_hit=True) as span:
+        def call():
+            span.set(cache_hit=False)
+            response = get_client().chat.completions.create(model="gpt-4o-mini", messages=messages, temperature=0.7)
+            span.record_usage(response.usage)
+            return response.choices[0].message.content.strip()
 
-# Apply function to dataset
-df["generated_expectations_gsm8k"] = df.apply(generate_gsm8k_answer, axis=1)
+        # Identical few-shot prompt + row always yields the same request, so reruns are served from the cache
+        return get_llm_cache().get_or_call(model="gpt-4o-mini", temperature=0.7, messages=messages, call=call)
 
-# Save updated dataset
-df.to_csv("data/finetuning_dataset/generated/gsm8k_formatted_dataset.csv", index=False)
-
-print("Dataset successfully updated in GSM8K format!")
+def main(args):
+    """
+    Streams the input CSV in chunks, appending each GSM8K answer to a JSONL sink as it
+    arrives, then materializes the final CSV from the sink.
+    """
+    import pandas as pd
+
+    output_jsonl = os.path.splitext(args.output)[0] + '.jsonl'
+    columns = None
+
+    with JsonlSink(output_jsonl, resume=args.resume) as sink:
+        for chunk in pd.read_csv(args.input, chunksize=args.chunk_size):
+            columns = list(chunk.columns) + ["generated_expectations_gsm8k"]
+            records = []
+            for row in chunk.to_dict('records'):
+                input_hash = hash_input(row["user_prompt"], row["generated_expectations"])
+                if sink.is_done(input_hash):
+                    continue
+                row["generated_expectations_gsm8k"] = generate_gsm8k_answer(row)
+                row["input_hash"] = input_hash
+                records.append(row)
+            sink.write_chunk(records)
+            print(f"Processed {len(sink.completed)} rows.")
+
+        # Save updated dataset
+        if columns:
+            sink.materialize_csv(args.output, columns=columns)
+
+    print("Dataset successfully updated in GSM8K format!")
+    print(get_llm_cache().summary())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input',
+                        default="data/finetuning_dataset/confirmed/generated_expectations_20241231_185728.csv",
+                        help='CSV with user_prompt and generated_expectations columns')
+    parser.add_argument('-o', '--output', default="data/finetuning_dataset/generated/gsm8k_formatted_dataset.csv",
+                        help='Final CSV; results stream to a JSONL file of the same name first')
+    parser.add_argument('--chunk-size', type=int, default=50, help='Rows read and checkpointed per chunk')
+    parser.add_argument('--resume', action='store_true', help='Skip rows already answered in a previous run')
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    configure_llm_cache(path=args.cache_path, mode=args.cache_mode)
+    main(args)
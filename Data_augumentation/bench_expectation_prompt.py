@@ -0,0 +1,71 @@
+import argparse
+import time
+
+from langchain_core.prompts import ChatPromptTemplate, FewShotChatMessagePromptTemplate
+
+from util_func import EXPECTATION_EXAMPLES, ExpectationGenerator, get_accepted_expectations
+
+
+def legacy_build_messages(input_text, catalogue_path):
+    """
+    Per-call prompt construction as get_expectation_from_openai did it before ExpectationGenerator:
+    parse the catalogue, rebuild every template and render the full prompt.
+    """
+    accepted_expectations = get_accepted_expectations(catalogue_path)
+    expectations_reference = "\n".join(
+        [f"{category}: {', '.join(expectations)}" for category, expectations in accepted_expectations.items()]
+    )
+    few_shot_prompt = FewShotChatMessagePromptTemplate(
+        input_variables=['user_prompt'],
+        examples=EXPECTATION_EXAMPLES,
+        example_prompt=ChatPromptTemplate.from_messages([
+            ("human", "{user_prompt}"), ("ai", "{Expectations}")
+        ])
+    )
+    prompt_instruction = f'''Convert the following data quality prompts to great_expectations in the form 
+                                  expectation_type(columnName, params...).
+                                  Use the accepted expectations reference below to get the available expectations. 
+                                  Do not hallucinate or infer expectations from other sources.
+                                  Accepted Expectations Reference:
+                                  {expectations_reference}'''
+    final_prompt = ChatPromptTemplate.from_messages([
+        ('system', prompt_instruction),
+        few_shot_prompt,
+        ('human', '{user_prompt}')
+    ])
+    return final_prompt.format_messages(user_prompt=input_text)
+
+
+def time_per_call(build, prompts):
+    start = time.perf_counter()
+    for prompt in prompts:
+        build(prompt)
+    return (time.perf_counter() - start) / len(prompts)
+
+
+def main(args):
+    with open(args.prompts, 'r') as file:
+        prompts = [line.strip() for line in file if line.strip()][:args.n]
+
+    generator = ExpectationGenerator(catalogue_path=args.catalogue)
+    legacy = legacy_build_messages(prompts[0], args.catalogue)
+    compiled = generator.build_messages(prompts[0])
+    if [(m.type, m.content) for m in legacy] != [(m.type, m.content) for m in compiled]:
+        raise AssertionError("ExpectationGenerator renders different messages than the legacy prompt")
+
+    legacy_time = time_per_call(lambda prompt: legacy_build_messages(prompt, args.catalogue), prompts)
+    compiled_time = time_per_call(generator.build_messages, prompts)
+
+    print(f"Prompts timed: {len(prompts)}")
+    print(f"Legacy per-call overhead:   {legacy_time * 1e3:8.3f} ms")
+    print(f"Compiled per-call overhead: {compiled_time * 1e3:8.3f} ms")
+    print(f"Speed-up: {legacy_time / compiled_time:.0f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-call prompt construction overhead, before and after ExpectationGenerator.')
+    parser.add_argument('--catalogue', default='./data/finetuning_dataset/listExpectations.csv',
+                        help='Accepted expectations catalogue (.csv or .xlsx)')
+    parser.add_argument('--prompts', default='./data/initial_prompt_sample/sample_quality_check_prompts.txt')
+    parser.add_argument('-n', type=int, default=200, help='Number of prompts to time')
+    main(parser.parse_args())
@@ -0,0 +1,84 @@
+import argparse
+import csv
+import os
+import random
+import statistics
+import tempfile
+import time
+from itertools import combinations
+
+from local_index import LocalVectorIndex, snapshot_from_file
+
+
+def build_queries(catalogue_file, n, seed=0):
+    """
+    Constraint sections like generate_prompts.create_user_prompt builds them, sampled
+    with repetition from the 2-3 category combos of the catalogue.
+    """
+    with open(catalogue_file, 'r', encoding='utf-8-sig') as file:
+        categories = list(dict.fromkeys(row['Category'] for row in csv.DictReader(file) if row['Category']))
+    combos = [combo for size in (2, 3) for combo in combinations(categories, size)]
+    rng = random.Random(seed)
+    return [''.join(f'- **{category}**: checks of the {category} category\n' for category in rng.choice(combos))
+            for _ in range(n)]
+
+
+def time_queries(search, queries, top_n):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query, top_n)
+        latencies.append((time.perf_counter() - start) * 1e3)
+    latencies.sort()
+    return {
+        'mean_ms': statistics.fmean(latencies),
+        'p50_ms': latencies[len(latencies) // 2],
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1],
+    }
+
+
+def main(args):
+    queries = build_queries(args.catalogue, args.queries)
+    print(f"{len(queries)} queries, {len(set(queries))} distinct")
+
+    if args.fake_embeddings:
+        from langchain_core.embeddings import DeterministicFakeEmbedding
+        embeddings = DeterministicFakeEmbedding(size=args.dimensions)
+        path = os.path.join(tempfile.mkdtemp(), 'bench_index')
+        snapshot_from_file(args.filepath, embeddings, path=path)
+    else:
+        import embed_sample_prompt
+        embeddings, path = embed_sample_prompt.get_embeddings(), args.index_path
+
+    results = {}
+    index = LocalVectorIndex(path, embeddings)
+    results['local exact'] = time_queries(lambda q, k: index.search(q, top_n=k), queries, args.top_n)
+    print(f"Query embedding cache: {index.embed_query.cache_info()}")
+
+    hnsw_index = LocalVectorIndex(path, embeddings, use_hnsw=True)
+    if hnsw_index.hnsw is not None:
+        results['local hnsw'] = time_queries(lambda q, k: hnsw_index.search(q, top_n=k), queries, args.top_n)
+
+    if args.pgvector:
+        import embed_sample_prompt
+        results['pgvector'] = time_queries(
+            lambda q, k: embed_sample_prompt.search_text(q, top_n=k, backend='pgvector'), queries, args.top_n)
+
+    print(f"{'backend':<14}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, stats in results.items():
+        print(f"{name:<14}{stats['mean_ms']:>10.3f}{stats['p50_ms']:>10.3f}{stats['p95_ms']:>10.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Latency per query of the local index vs the PGVector search path.')
+    parser.add_argument('--catalogue', default='./data/finetuning_dataset/listExpectations.csv')
+    parser.add_argument('-f', '--filepath', default='./data/initial_prompt_sample/sample_quality_check_prompts.txt',
+                        help='Corpus embedded into the snapshot when --fake-embeddings is set')
+    parser.add_argument('--index-path', default=os.getenv('LOCAL_INDEX_PATH', './data/vector_index/sample_text_file'))
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--top-n', type=int, default=3)
+    parser.add_argument('--fake-embeddings', action='store_true',
+                        help='Use deterministic fake embeddings (offline, local backends only)')
+    parser.add_argument('--dimensions', type=int, default=3072, help='Size of the fake embeddings')
+    parser.add_argument('--pgvector', action='store_true', help='Also time search_text against PGVector')
+    main(parser.parse_args())
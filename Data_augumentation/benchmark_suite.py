@@ -0,0 +1,348 @@
+import argparse
+import csv
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import tracing
+
+PROMPTS_FILE = './data/initial_prompt_sample/sample_quality_check_prompts.txt'
+DATASET_FILE = './data/test.jsonl'
+CATALOGUE_FILE = './data/finetuning_dataset/listExpectations.csv'
+CATEGORIES_FILE = './data/initial_prompt_sample/DQR_categories.xlsx'
+# Throughput and memory depend on the machine, so the baseline is per machine and not committed
+DEFAULT_BASELINE = './.cache/benchmarks/baseline.json'
+DEFAULT_OUTPUT = './.cache/benchmarks/latest.json'
+STAGES = ('embed_sample_prompt', 'create_dataset', 'generate_prompts', 'RL_dataset')
+
+# Relative change of a metric that counts as a regression: throughput down, memory or p50 latency up
+DEFAULT_TOLERANCE = 0.2
+# Latencies below this many ms (file writes, fsync) are dominated by disk and scheduler noise and never flagged
+MIN_FLAGGED_LATENCY_MS = 20.0
+# Rate limits of the stages, high enough that the benchmark measures the pipeline and not the limiter
+UNLIMITED_RPM = 1000000
+UNLIMITED_TPM = 1000000000
+
+
+def start_fake_server(latency, latency_jitter, error_rate, seed):
+    """
+    Runs fake_openai_server.py in its own process, so neither its CPU time nor its
+    allocations are counted in the stages measured here.
+
+    Returns:
+        tuple: (process, base URL)
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_openai_server.py')
+    process = subprocess.Popen(
+        [sys.executable, script, '--port', '0', '--latency', str(latency), '--latency-jitter', str(latency_jitter),
+         '--error-rate', str(error_rate), '--seed', str(seed)],
+        stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    if 'http://' not in line:
+        process.kill()
+        raise RuntimeError(f"Fake OpenAI server did not start: {line!r}")
+    return process, line.split('listening on ')[1].split()[0]
+
+
+def server_stats(base_url):
+    import urllib.request
+
+    with urllib.request.urlopen(f"{base_url}/stats", timeout=5) as response:
+        return json.load(response)
+
+
+def point_clients_at(base_url):
+    """
+    Sends every OpenAI client of the pipeline to the fake server: the chat models
+    and RL_dataset's client through the environment, the embeddings explicitly.
+    """
+    os.environ['OPENAI_BASE_URL'] = base_url
+    os.environ['OPENAI_API_BASE'] = base_url
+    os.environ.setdefault('OPENAI_API_KEY', 'sk-fake')
+
+    from langchain_openai import OpenAIEmbeddings
+    from embed_sample_prompt import EMBEDDING_MODEL, configure_clients
+
+    # Token-length checks would download a tiktoken encoding; the fake server embeds text as is
+    configure_clients(embeddings=OpenAIEmbeddings(model=EMBEDDING_MODEL, base_url=base_url, api_key='sk-fake',
+                                                  check_embedding_ctx_length=False, max_retries=3))
+
+
+def write_lines(lines, file_path):
+    with open(file_path, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+    return file_path
+
+
+def count_lines(file_path):
+    if not os.path.exists(file_path):
+        return 0
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return sum(1 for line in file if line.strip())
+
+
+def stage_embed(args, workdir, prompts_file):
+    """
+    Embeds the prompts into an in-memory store; generate_prompts.py then searches that store.
+    """
+    from langchain_core.vectorstores import InMemoryVectorStore
+    from embed_sample_prompt import configure_clients, embed_sample_text, get_embeddings
+
+    store = InMemoryVectorStore(get_embeddings())
+    stats = embed_sample_text(prompts_file, store=store, batch_size=args.embed_batch_size)
+    configure_clients(vector_store=store)
+    return stats['inserted']
+
+
+def stage_create_dataset(args, workdir, prompts_file):
+    from create_dataset import call_openai
+
+    output_file = os.path.join(workdir, 'generated_expectations.jsonl')
+    call_openai(batch_size=args.batch_size, concurrency=args.concurrency, requests_per_minute=UNLIMITED_RPM,
+                tokens_per_minute=UNLIMITED_TPM, sample_prompt_file=prompts_file,
+                output_file=output_file, pack_k=args.pack_k)
+    return count_lines(output_file)
+
+
+def stage_generate_prompts(args, workdir, prompts_file):
+    """
+    Runs the shard of category combinations closest to `--combos` combos.
+    """
+    import generate_prompts
+
+    generate_prompts.CATEGORIES = generate_prompts.process_excel_with_expectations(args.categories)
+    total = len(generate_prompts.create_categories_combo(list(generate_prompts.CATEGORIES)))
+    output_dir = os.path.join(workdir, 'prompt_runs')
+    generate_prompts.run_shard(0, max(1, total // args.combos), concurrency=args.concurrency,
+                               requests_per_minute=UNLIMITED_RPM, tokens_per_minute=UNLIMITED_TPM,
+                               output_dir=output_dir, seed=args.seed)
+    status_files = [os.path.join(output_dir, name) for name in os.listdir(output_dir) if name.startswith('status_')]
+    return sum(count_lines(file_path) for file_path in status_files)
+
+
+def stage_rl_dataset(args, workdir, prompts_file):
+    import RL_dataset
+
+    with open(args.dataset, 'r', encoding='utf-8') as file:
+        rows = [json.loads(line) for line in file if line.strip()][:args.rl_rows]
+    input_file = os.path.join(workdir, 'rl_input.csv')
+    with open(input_file, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=['user_prompt', 'generated_expectations'], extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+    output_file = os.path.join(workdir, 'gsm8k_formatted_dataset.csv')
+    RL_dataset.main(argparse.Namespace(input=input_file, output=output_file, chunk_size=50, resume=False))
+    return count_lines(os.path.splitext(output_file)[0] + '.jsonl')
+
+
+STAGE_FUNCTIONS = {
+    'embed_sample_prompt': stage_embed,
+    'create_dataset': stage_create_dataset,
+    'generate_prompts': stage_generate_prompts,
+    'RL_dataset': stage_rl_dataset,
+}
+
+
+def run_stage(name, args, workdir, prompts_file, track_memory=False):
+    """
+    Runs one stage in a directory of its own. The stage's script is imported first,
+    so import time and module allocations are not part of its numbers.
+
+    The timed run traces its spans for the latencies; with `track_memory` the stage
+    runs under tracemalloc instead, which slows it too much to time it.
+
+    Returns:
+        dict: items, seconds, items_per_sec and p50/p95 ms per span kind, or peak_mb with `track_memory`.
+    """
+    importlib.import_module(name)
+    workdir = os.path.join(workdir, f"{name}_{'memory' if track_memory else 'timed'}")
+    os.makedirs(workdir)
+    if track_memory:
+        tracemalloc.start()
+        try:
+            STAGE_FUNCTIONS[name](args, workdir, prompts_file)
+            return {'peak_mb': round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)}
+        finally:
+            tracemalloc.stop()
+
+    trace_file = os.path.join(workdir, 'trace.jsonl')
+    tracing.configure_tracing(trace_file, stage=name)
+    try:
+        start = time.perf_counter()
+        items = STAGE_FUNCTIONS[name](args, workdir, prompts_file)
+        elapsed = time.perf_counter() - start
+    finally:
+        tracing.configure_tracing('')
+
+    latencies = {row['kind']: {'calls': row['calls'], 'errors': row['errors'], 'p50_ms': round(row['p50_ms'], 2),
+                               'p95_ms': round(row['p95_ms'], 2)}
+                 for row in tracing.summarize(tracing.read_spans([trace_file]), by=('kind',))}
+    return {
+        'items': items,
+        'seconds': round(elapsed, 3),
+        'items_per_sec': round(items / elapsed, 3) if elapsed else 0.0,
+        'latency': latencies,
+    }
+
+
+def run_suite(args):
+    """
+    Starts the fake server, runs the selected stages in pipeline order and collects their results.
+    """
+    with open(args.prompts, 'r', encoding='utf-8') as file:
+        prompts = [line.strip() for line in file if line.strip()][:args.n]
+
+    from llm_cache import configure_llm_cache
+    from util_func import configure_expectation_generator
+
+    # Every request must reach the server, or reruns would only measure the response cache
+    configure_llm_cache(mode='off')
+    configure_expectation_generator(args.catalogue)
+    process, base_url = start_fake_server(args.latency, args.latency_jitter, args.error_rate, args.seed)
+    stages = {}
+    try:
+        point_clients_at(base_url)
+        with tempfile.TemporaryDirectory() as workdir:
+            prompts_file = write_lines(prompts, os.path.join(workdir, 'prompts.txt'))
+            # generate_prompts.py searches the store the embedding stage fills
+            selected = [stage for stage in STAGES if stage in args.stages or
+                        (stage == 'embed_sample_prompt' and 'generate_prompts' in args.stages)]
+            for name in selected:
+                print(f"--- {name}")
+                stages[name] = run_stage(name, args, workdir, prompts_file)
+                stages[name]['peak_mb'] = (0.0 if args.no_memory else
+                                           run_stage(name, args, workdir, prompts_file, track_memory=True)['peak_mb'])
+        server = server_stats(base_url)
+    finally:
+        process.terminate()
+        process.wait()
+
+    return {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'settings': {
+            'n': args.n, 'combos': args.combos, 'rl_rows': args.rl_rows, 'latency': args.latency,
+            'latency_jitter': args.latency_jitter, 'error_rate': args.error_rate, 'seed': args.seed,
+            'concurrency': args.concurrency, 'batch_size': args.batch_size, 'pack_k': args.pack_k,
+        },
+        'environment': {'python': platform.python_version(), 'machine': platform.machine(),
+                        'cpus': os.cpu_count()},
+        'server': server,
+        'stages': stages,
+    }
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Metrics of `results` worse than `baseline` by more than `tolerance`: lower items/sec,
+    higher peak memory, or higher p50 latency of a span kind. p95 is recorded but not
+    compared; over a few hundred calls with injected faults it moves with every retry.
+
+    Returns:
+        list: (stage, metric, baseline value, current value, relative change) per regression.
+    """
+    regressions = []
+    for stage, current in results['stages'].items():
+        previous = baseline.get('stages', {}).get(stage)
+        if not previous:
+            continue
+        checks = [('items_per_sec', previous['items_per_sec'], current['items_per_sec'], -1)]
+        if previous.get('peak_mb') and current['peak_mb']:
+            checks.append(('peak_mb', previous['peak_mb'], current['peak_mb'], 1))
+        for kind, latency in current['latency'].items():
+            before = previous['latency'].get(kind, {}).get('p50_ms')
+            if before and max(before, latency['p50_ms']) >= MIN_FLAGGED_LATENCY_MS:
+                checks.append((f'{kind}.p50_ms', before, latency['p50_ms'], 1))
+        for metric, before, now, direction in checks:
+            change = (now - before) / before if before else 0.0
+            if change * direction > tolerance:
+                regressions.append((stage, metric, before, now, change))
+    return regressions
+
+
+def print_results(results, baseline=None):
+    previous = (baseline or {}).get('stages', {})
+    print(f"{'stage':<22} {'items':>6} {'seconds':>8} {'items/s':>9} {'vs base':>8} {'peak MB':>8}  latency p50/p95 ms")
+    for stage, result in results['stages'].items():
+        before = previous.get(stage, {}).get('items_per_sec')
+        change = f"{(result['items_per_sec'] - before) / before:+.0%}" if before else '-'
+        latency = ', '.join(f"{kind} {values['p50_ms']:.0f}/{values['p95_ms']:.0f}"
+                            for kind, values in result['latency'].items())
+        print(f"{stage:<22} {result['items']:>6} {result['seconds']:>8.2f} {result['items_per_sec']:>9.2f} "
+              f"{change:>8} {result['peak_mb']:>8.1f}  {latency}")
+    print(f"Fake server: {results['server']}")
+
+
+def save_results(results, file_path):
+    os.makedirs(os.path.dirname(os.path.abspath(file_path)), exist_ok=True)
+    with open(file_path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2)
+
+
+def main(args):
+    results = run_suite(args)
+    save_results(results, args.output)
+
+    baseline = None
+    if os.path.exists(args.baseline) and not args.update_baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        for key in ('settings', 'environment'):
+            if baseline.get(key) != results[key]:
+                print(f"Warning: {key} differ from the baseline's {baseline.get(key)}; "
+                      f"the comparison may not be meaningful")
+    print_results(results, baseline)
+    print(f"Results saved to {args.output}")
+
+    if args.update_baseline or baseline is None:
+        save_results(results, args.baseline)
+        print(f"Baseline saved to {args.baseline}")
+        if baseline is None and not args.update_baseline:
+            print("There was no baseline for this machine yet: nothing was compared")
+            return 2 if args.require_baseline else 0
+        return 0
+
+    regressions = compare(results, baseline, args.tolerance)
+    for stage, metric, before, now, change in regressions:
+        print(f"REGRESSION {stage} {metric}: {before} -> {now} ({change:+.0%})")
+    if not regressions:
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}")
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Offline benchmark of the pipeline stages against a fake OpenAI server and an in-memory vector store.')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--prompts', default=PROMPTS_FILE, help='Prompt file of the embedding and create_dataset stages')
+    parser.add_argument('--dataset', default=DATASET_FILE, help='JSONL rows of the RL_dataset stage')
+    parser.add_argument('--catalogue', default=CATALOGUE_FILE, help='Accepted expectations catalogue (.csv or .xlsx)')
+    parser.add_argument('--categories', default=CATEGORIES_FILE, help='Constraint categories of generate_prompts')
+    parser.add_argument('-n', type=int, default=200, help='Prompts embedded and sent to create_dataset')
+    parser.add_argument('--combos', type=int, default=20, help='Approximate category combos of generate_prompts')
+    parser.add_argument('--rl-rows', type=int, default=50, help='Rows formatted by RL_dataset (one request at a time)')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds of fake server latency per request')
+    parser.add_argument('--latency-jitter', type=float, default=0.02, help='Extra random latency per request')
+    parser.add_argument('--error-rate', type=float, default=0.02, help='Share of requests answered with HTTP 500')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the injected faults and the prompt sampling')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--batch-size', type=int, default=50, help='create_dataset prompts per batch')
+    parser.add_argument('--embed-batch-size', type=int, default=64, help='Lines embedded per request')
+    parser.add_argument('--pack-k', type=int, default=1, help='create_dataset prompts per request')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='Skip the second, tracemalloc run of each stage that measures its memory peak')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT, help='JSON results of this run')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='JSON baseline of this machine to compare against; written by the first run')
+    parser.add_argument('--update-baseline', action='store_true', help='Replace the baseline with this run')
+    parser.add_argument('--require-baseline', action='store_true',
+                        help='Exit with status 2 instead of 0 when there was no baseline to compare against, e.g. in CI')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='Relative change flagged as a regression')
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,73 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# Cumulative `python -X importtime` budget per entry point, in ms. Measured at
+# 13-60 ms; the headroom absorbs machine noise, not a client or driver import.
+IMPORT_BUDGETS_MS = {
+    'llm_cache': 60,
+    'llm_engine': 100,
+    'result_sink': 40,
+    'util_func': 60,
+    'create_dataset': 150,
+    'generate_prompts': 150,
+    'embed_sample_prompt': 60,
+    'RL_dataset': 60,
+    'dedup_prompts': 60,
+}
+
+# Modules that must only be imported on first use of a client, store or DataFrame
+HEAVY_MODULES = ('langchain', 'langchain_core', 'langchain_openai', 'langchain_postgres', 'langchain_chroma',
+                 'openai', 'pandas', 'sqlalchemy', 'psycopg')
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)')
+
+
+def measure(module):
+    """
+    Import `module` in a fresh interpreter.
+
+    Returns:
+        tuple: (cumulative import time in ms, heavy modules loaded as a side effect)
+    """
+    script = (f"import sys, {module}\n"
+              f"print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', script],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing '{module}' failed:\n{result.stderr}")
+    cumulative_us = 0
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        # The module's own line holds its cumulative time, interpreter startup (site, encodings) excluded
+        if match and match.group(2) == module:
+            cumulative_us = int(match.group(1))
+    heavy = [name for name in result.stdout.strip().split(',') if name]
+    return cumulative_us / 1e3, heavy
+
+
+def main(args):
+    modules = args.modules or list(IMPORT_BUDGETS_MS)
+    violations = 0
+    print(f"{'module':<22}{'import ms':>10}{'budget ms':>11}  heavy modules")
+    for module in modules:
+        budget = IMPORT_BUDGETS_MS.get(module, args.default_budget) * args.scale
+        elapsed, heavy = min((measure(module) for _ in range(args.repeat)), key=lambda run: run[0])
+        failed = elapsed > budget or heavy
+        violations += bool(failed)
+        print(f"{module:<22}{elapsed:>10.1f}{budget:>11.0f}  {', '.join(heavy) or '-'}{'  FAIL' if failed else ''}")
+    if violations:
+        print(f"{violations} entry point(s) over budget or importing heavy modules eagerly.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the import time of the augmentation entry points against a budget.')
+    parser.add_argument('modules', nargs='*', help='Modules to check (default: all budgeted entry points)')
+    parser.add_argument('--repeat', type=int, default=3, help='Imports per module; the fastest one is kept')
+    parser.add_argument('--scale', type=float, default=1.0, help='Multiply every budget, e.g. on slow CI machines')
+    parser.add_argument('--default-budget', type=float, default=60, help='Budget in ms for modules not listed')
+    main(parser.parse_args())
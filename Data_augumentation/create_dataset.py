@@ -1,52 +1,194 @@
 import os
-import pandas as pd
+import argparse
+import functools
 
 import logging
 import datetime
-from util_func import set_up_logging, get_expectation_from_openai
+import time
+from llm_engine import GenerationEngine, estimate_tokens
+from llm_cache import add_cache_arguments, configure_llm_cache, get_llm_cache, CacheMissError
+from result_sink import JsonlSink, hash_input, iter_chunks
+from util_func import (set_up_logging, get_expectation_from_openai, get_expectations_packed, get_chat_model,
+                       get_expectation_generator, PACKED_PROMPT_INSTRUCTION)
 
 set_up_logging(take_log=True)
 
-def call_openai(batch_size=10):
+# Approximate tokens every request adds on top of the user prompt
+# (system instruction, accepted expectations reference, few-shot examples and the completion)
+REQUEST_OVERHEAD_TOKENS = 1200
+# Approximate completion tokens of each additional prompt in a packed request
+PACKED_COMPLETION_TOKENS = 150
+# Approximate tokens the packing instruction adds to the prompts of a packed request
+PACKED_INSTRUCTION_TOKENS = estimate_tokens(PACKED_PROMPT_INSTRUCTION)
+
+
+def estimate_request_tokens(item):
+    """
+    Token budget of one engine item: a single prompt, or a list of prompts packed in one request.
+    """
+    if isinstance(item, list):
+        return (sum(estimate_tokens(prompt) for prompt in item) + REQUEST_OVERHEAD_TOKENS
+                + PACKED_COMPLETION_TOKENS * (len(item) - 1))
+    return estimate_tokens(item) + REQUEST_OVERHEAD_TOKENS
+
+
+def prompt_tokens(messages):
+    return sum(estimate_tokens(message.content) for message in messages)
+
+
+def prefix_tokens():
+    """
+    Tokens of the instruction prefix every request starts with, counted on the pre-rendered messages.
+    """
+    generator = get_expectation_generator()
+    generator.refresh()
+    return prompt_tokens(generator.prefix_messages)
+
+
+def read_prompts(sample_prompt_file):
+    """
+    Lazily yields the non-empty lines of the prompt file.
+    """
+    with open(sample_prompt_file, 'r') as file:
+        for line in file:
+            if line.strip():
+                yield line.strip()
+
+
+def generate_batch(engine, batch, generate, generate_packed, pack_k, packing_stats):
+    """
+    Generates expectations for a batch, `pack_k` prompts per request when pack_k > 1.
+
+    Prompts a packed response did not answer validly are retried with single-prompt calls.
+    Prompt tokens sent, and those one request per prompt would have sent, are only
+    counted when packing, from the prefix size plus the prompt lengths.
+
+    Returns:
+        list: Expectations per prompt of the batch (None on failure), in batch order.
+    """
+    if pack_k <= 1:
+        packing_stats['single_requests'] += len(batch)
+        return engine.run(generate, batch)
+
+    prefix = prefix_tokens()
+    batch_tokens = [estimate_tokens(prompt) for prompt in batch]
+    packing_stats['unpacked_prompt_tokens'] += prefix * len(batch) + sum(batch_tokens)
+
+    packs = list(iter_chunks(batch, pack_k))
+    results = []
+    for pack, answers in zip(packs, engine.run(generate_packed, packs)):
+        results.extend(answers or [None] * len(pack))
+    packing_stats['packed_requests'] += len(packs)
+    # Each packed prompt also carries its `[i] ` number, about one token
+    packing_stats['prompt_tokens'] += ((prefix + PACKED_INSTRUCTION_TOKENS) * len(packs)
+                                       + sum(batch_tokens) + len(batch))
+
+    fallback = [i for i, expectations in enumerate(results) if expectations is None]
+    if fallback:
+        logging.info(f"Retrying {len(fallback)} prompts of unanswered packs with single-prompt calls.")
+        packing_stats['single_requests'] += len(fallback)
+        packing_stats['prompt_tokens'] += sum(prefix + batch_tokens[i] for i in fallback)
+        for i, expectations in zip(fallback, engine.run(generate, [batch[i] for i in fallback])):
+            results[i] = expectations
+    return results
+
+
+def packing_report(pack_k, prompts, packing_stats, elapsed):
+    """
+    Prints the requests made, the prompt tokens sent vs one request per prompt, and prompts/sec.
+    """
+    message = (f"K={pack_k}: {prompts} prompts in {packing_stats['packed_requests']} packed + "
+               f"{packing_stats['single_requests']} single requests, "
+               f"{prompts / elapsed if elapsed else 0.0:.2f} prompts/sec")
+    if packing_stats['unpacked_prompt_tokens']:
+        saved = 1 - packing_stats['prompt_tokens'] / packing_stats['unpacked_prompt_tokens']
+        message += (f"; ~{packing_stats['prompt_tokens']} prompt tokens vs "
+                    f"~{packing_stats['unpacked_prompt_tokens']} unpacked ({saved:.0%} saved)")
+    logging.info(message)
+    print(message)
+
+
+def call_openai(batch_size=10, concurrency=8, requests_per_minute=500, tokens_per_minute=200000,
+                base_url=None, sample_prompt_file='./data/expectation_and_prompt_sample/sample_quality_check_prompts.txt',
+                output_file=None, resume=False, pack_k=1):
     """
     Reads user prompts from a text file and generates expectations for each line using OpenAI's model.
 
+    Results are appended to a JSONL sink as each batch completes, so an interrupted run
+    can be resumed; the final CSV is materialized from the sink at the end.
+
     Args:
         batch_size (int): Number of prompts to process in a single batch.
+        concurrency (int): Number of requests in flight within a batch.
+        requests_per_minute (int): Request budget shared by all concurrent calls.
+        tokens_per_minute (int): Token budget shared by all concurrent calls.
+        base_url (str): OpenAI compatible endpoint, e.g. a local stub server.
+        sample_prompt_file (str): Text file with one user prompt per line.
+        output_file (str): JSONL sink of the run, timestamped when omitted.
+        resume (bool): Skip prompts already completed in `output_file`.
+        pack_k (int): Number of prompts answered per request; 1 sends one request per prompt.
     """
-    sample_prompt_file = './data/expectation_and_prompt_sample/sample_quality_check_prompts.txt'
+    if output_file is None:
+        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+        output_file = f'data/finetuning_dataset/generated/generated_expectations_{timestamp}.jsonl'
 
-        generated_expectations = []
+    model_kwargs = {'base_url': base_url} if base_url else {}
+    # Retries are handled by the engine so it can see the 429s and adapt its rate
+    model = get_chat_model(model="gpt-4o-mini", temperature=0.7, max_retries=0, **model_kwargs)
+    engine = GenerationEngine(
+        concurrency=concurrency,
+        requests_per_minute=requests_per_minute,
+        tokens_per_minute=tokens_per_minute,
+        token_estimator=estimate_request_tokens,
+        fatal_exceptions=(CacheMissError,),
+    )
+    generate = functools.partial(get_expectation_from_openai, model=model, raise_errors=True)
+    generate_packed = functools.partial(get_expectations_packed, model=model, raise_errors=True)
+    packing_stats = {'packed_requests': 0, 'single_requests': 0, 'prompt_tokens': 0, 'unpacked_prompt_tokens': 0}
+    prompts_done = 0
+    start = time.perf_counter()
 
     try:
-        # Read input prompts from file
-        with open(sample_prompt_file, 'r') as file:
-            prompts = [line.strip() for line in file if line.strip()]
-
-        # Process prompts in batches
-        for i in range(0, len(prompts), batch_size):
-            batch = prompts[i:i + batch_size]
-            logging.info(f"Processing batch {i // batch_size + 1} with {len(batch)} prompts.")
-            print(f"Processing batch {i // batch_size + 1} with {len(batch)} prompts.")
-
-            for prompt in batch:
-                expectations = get_expectation_from_openai(input_text=prompt)
-                if expectations:
-                    generated_expectations.append({
+        with JsonlSink(output_file, resume=resume) as sink:
+            pending = (prompt for prompt in read_prompts(sample_prompt_file)
+                       if not sink.is_done(hash_input(prompt)))
+
+            # Process prompts in batches
+            for batch_number, batch in enumerate(iter_chunks(pending, batch_size), start=1):
+                logging.info(f"Processing batch {batch_number} with {len(batch)} prompts.")
+                print(f"Processing batch {batch_number} with {len(batch)} prompts.")
+
+                results = generate_batch(engine, batch, generate, generate_packed, pack_k, packing_stats)
+                prompts_done += len(batch)
+                sink.write_chunk([
+                    {
+                        'input_hash': hash_input(prompt),
                         'user_prompt': prompt,
                         'generated_expectations': expectations
-                    })
+                    }
+                    for prompt, expectations in zip(batch, results)
+                    if expectations
+                ])
 
-        # Save results to a DataFrame with a timestamped filename
-        timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-        output_file = f'data/finetuning_dataset/generated/generated_expectations_{timestamp}.csv'
-        df = pd.DataFrame(generated_expectations)
-        df.to_csv(output_file, index=False)
-        logging.info(f"Generated expectations saved to '{output_file}'.")
+            # Save results next to the sink as CSV
+            csv_file = os.path.splitext(output_file)[0] + '.csv'
+            sink.materialize_csv(csv_file, columns=['user_prompt', 'generated_expectations'])
+        logging.info(f"Generated expectations saved to '{csv_file}'.")
     except FileNotFoundError:
         logging.error(f"The file {sample_prompt_file} was not found.")
+    except FileExistsError as e:
+        # JsonlSink refuses to overwrite an earlier run unless it is resumed
+        logging.error(str(e))
+        raise
+    except CacheMissError as e:
+        logging.error(f"Replay run stopped: {e}")
+        raise
     except Exception as e:
         logging.error(f"An error occurred: {e}")
+    finally:
+        engine.report(unit='requests' if pack_k > 1 else 'prompts')
+        packing_report(pack_k, prompts_done, packing_stats, time.perf_counter() - start)
+        print(get_llm_cache().summary())
 
 
 def encode_data_json():
@@ -54,5 +196,31 @@ def encode_data_json():
 
 
 if __name__ == '__main__':
-    # Set the desired batch size
-    call_openai(batch_size=100)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-f', '--filepath',
+                        help='Text file with one data quality prompt per line',
+                        default='./data/expectation_and_prompt_sample/sample_quality_check_prompts.txt')
+    parser.add_argument('--batch-size', type=int, default=100, help='Number of prompts per batch')
+    parser.add_argument('--concurrency', type=int, default=8, help='Number of requests in flight')
+    parser.add_argument('--rpm', type=int, default=500, help='Requests per minute limit')
+    parser.add_argument('--tpm', type=int, default=200000, help='Tokens per minute limit')
+    parser.add_argument('--base-url', default=None,
+                        help='OpenAI compatible endpoint, e.g. http://127.0.0.1:8000/v1 for fake_openai_server.py')
+    parser.add_argument('-o', '--output', default=None,
+                        help='JSONL results file of the run (timestamped by default); the CSV is written next to it')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue the run in --output, skipping prompts already completed')
+    parser.add_argument('--pack-k', type=int, default=1,
+                        help='Prompts answered per request as a JSON array; unanswered ones fall back to single calls')
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+    if args.resume and not args.output:
+        parser.error('--resume requires --output pointing at the run to continue')
+    if args.output and os.path.exists(args.output) and not args.resume:
+        parser.error(f"'{args.output}' already exists; pass --resume to continue that run or choose a new --output")
+
+    configure_llm_cache(path=args.cache_path, mode=args.cache_mode)
+    call_openai(batch_size=args.batch_size, concurrency=args.concurrency,
+                requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                base_url=args.base_url, sample_prompt_file=args.filepath,
+                output_file=args.output, resume=args.resume, pack_k=args.pack_k)
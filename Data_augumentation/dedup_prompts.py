@@ -0,0 +1,360 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+import zlib
+
+from embed_sample_prompt import normalize_text
+from result_sink import iter_chunks
+
+# Jaccard similarity of shingle sets above which two prompts are near-duplicates
+DEFAULT_THRESHOLD = 0.8
+# Clusters for the split assignment also join prompts this much below the threshold, since the
+# MinHash estimate of a pair right at the threshold falls below it about half the time
+DEFAULT_SPLIT_MARGIN = 0.1
+# MinHash permutations; more give a finer Jaccard estimate at the cost of memory (4 bytes each per prompt)
+DEFAULT_NUM_PERM = 128
+# Words per shingle
+DEFAULT_SHINGLE_SIZE = 3
+# Prompts hashed together in one vectorized MinHash step
+CHUNK_SIZE = 2048
+# Earlier prompts kept per LSH bucket as candidates; caps the work on very common buckets
+MAX_BUCKET_SIZE = 8
+DEFAULT_SPLITS = 'train=0.8,eval=0.1,test=0.1'
+# Weight of missed pairs when choosing the LSH bands: a missed pair can leak between splits,
+# while an extra candidate only costs one signature comparison
+FALSE_NEGATIVE_WEIGHT = 0.9
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+# Punctuation and quoting do not make two prompts different
+PUNCTUATION_PATTERN = re.compile(r"[^\w\s]+")
+
+
+def read_lines(input_files):
+    """
+    Streams the non-empty prompt lines of the input files, in order.
+    """
+    for file_path in input_files:
+        with open(file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                if line.strip():
+                    yield line.strip()
+
+
+def shingles(text, size=DEFAULT_SHINGLE_SIZE):
+    """
+    32-bit hashes of the word `size`-grams of a normalized prompt; shorter prompts are a single shingle.
+    """
+    words = PUNCTUATION_PATTERN.sub(' ', normalize_text(text)).split()
+    if len(words) <= size:
+        return {zlib.crc32(' '.join(words).encode('utf-8'))}
+    return {zlib.crc32(' '.join(words[i:i + size]).encode('utf-8')) for i in range(len(words) - size + 1)}
+
+
+def exact_key(text):
+    return hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=8).digest()
+
+
+def optimal_bands(threshold, num_perm, false_positive_weight=0.5, false_negative_weight=0.5):
+    """
+    Bands and rows per band (bands * rows <= num_perm) minimizing the weighted probability of
+    pairs below the threshold colliding and pairs above it not colliding.
+    """
+    def area(function, low, high, steps=200):
+        width = (high - low) / steps
+        return sum(function(low + (i + 0.5) * width) for i in range(steps)) * width
+
+    best, best_error = (1, num_perm), float('inf')
+    for bands in range(1, num_perm + 1):
+        for rows in range(1, num_perm // bands + 1):
+            false_positive = area(lambda s: 1 - (1 - s ** rows) ** bands, 0.0, threshold)
+            false_negative = area(lambda s: (1 - s ** rows) ** bands, threshold, 1.0)
+            error = false_positive_weight * false_positive + false_negative_weight * false_negative
+            if error < best_error:
+                best, best_error = (bands, rows), error
+    return best
+
+
+class MinHasher:
+    """
+    MinHash signatures of shingle sets, computed for a chunk of prompts at once.
+
+    Args:
+        num_perm (int): Number of hash permutations (signature length).
+        seed (int): Seed of the permutations; signatures are only comparable with the same seed.
+    """
+
+    def __init__(self, num_perm=DEFAULT_NUM_PERM, seed=1):
+        import numpy as np
+
+        self.np = np
+        generator = np.random.RandomState(seed)
+        self.a = generator.randint(1, MAX_HASH, size=(num_perm, 1), dtype=np.uint64)
+        self.b = generator.randint(0, MAX_HASH, size=(num_perm, 1), dtype=np.uint64)
+        self.band_weights = generator.randint(1, MAX_HASH, size=num_perm, dtype=np.uint64) | np.uint64(1)
+
+    def signatures(self, shingle_sets):
+        """
+        Returns a (len(shingle_sets), num_perm) uint32 array of signatures.
+        """
+        np = self.np
+        lengths = [len(shingle_set) for shingle_set in shingle_sets]
+        values = np.fromiter((value for shingle_set in shingle_sets for value in shingle_set),
+                             dtype=np.uint64, count=sum(lengths))
+        # Universal hashing (a * x + b) mod p; the uint64 overflow is part of the hash
+        permuted = ((self.a * values + self.b) % MERSENNE_PRIME) & MAX_HASH
+        offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        return np.minimum.reduceat(permuted, offsets, axis=1).T.astype(np.uint32)
+
+    def band_keys(self, signatures, bands, rows):
+        """
+        Returns a (len(signatures), bands) list of 64-bit keys, one hash per band of each signature.
+        """
+        np = self.np
+        weighted = signatures[:, :bands * rows].astype(np.uint64) * self.band_weights[:bands * rows]
+        return weighted.reshape(len(signatures), bands, rows).sum(axis=2, dtype=np.uint64).tolist()
+
+
+class DisjointSet:
+    """
+    Union-find over line numbers; the root of a cluster is its earliest line.
+    """
+
+    def __init__(self):
+        self.parent = []
+
+    def add(self):
+        self.parent.append(len(self.parent))
+
+    def find(self, item):
+        parent = self.parent
+        root = item
+        while parent[root] != root:
+            root = parent[root]
+        while parent[item] != root:
+            parent[item], item = root, parent[item]
+        return root
+
+    def union(self, first, second):
+        first, second = self.find(first), self.find(second)
+        if first != second:
+            self.parent[max(first, second)] = min(first, second)
+
+
+def find_duplicates(lines, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM,
+                    shingle_size=DEFAULT_SHINGLE_SIZE, split_margin=DEFAULT_SPLIT_MARGIN, seed=1):
+    """
+    Streams prompts through exact and MinHash-LSH near-duplicate detection.
+
+    Each prompt is first matched on its normalized text, then its signature's bands
+    are looked up in the LSH buckets; candidates whose estimated Jaccard similarity
+    reaches `threshold` are near-duplicates. A prompt is dropped when it duplicates
+    any earlier prompt. Candidates within `split_margin` below the threshold are
+    merged into the same cluster too (the LSH bands are tuned for that lower
+    similarity), so that whole clusters can be assigned to one split.
+
+    Returns:
+        tuple: (DisjointSet of clusters, set of dropped line numbers, stats dict).
+    """
+    import numpy as np
+
+    cluster_threshold = max(threshold - split_margin, 0.0)
+    bands, rows = optimal_bands(cluster_threshold, num_perm, 1 - FALSE_NEGATIVE_WEIGHT, FALSE_NEGATIVE_WEIGHT)
+    hasher = MinHasher(num_perm, seed)
+    clusters = DisjointSet()
+    dropped = set()
+    exact = {}
+    # Buckets hold positions in `store`, the signatures of every prompt that was not an exact duplicate
+    buckets = [{} for _ in range(bands)]
+    store = np.empty((CHUNK_SIZE, num_perm), dtype=np.uint32)
+    store_lines = []
+    stats = {'lines': 0, 'exact_duplicates': 0, 'near_duplicates': 0, 'candidates_checked': 0,
+             'bands': bands, 'rows_per_band': rows, 'examples': []}
+
+    for chunk in iter_chunks(lines, CHUNK_SIZE):
+        first_line = stats['lines']
+        stats['lines'] += len(chunk)
+        pending = []
+        for offset, text in enumerate(chunk):
+            line_number = first_line + offset
+            clusters.add()
+            key = exact_key(text)
+            if key in exact:
+                clusters.union(line_number, exact[key])
+                dropped.add(line_number)
+                stats['exact_duplicates'] += 1
+            else:
+                exact[key] = line_number
+                pending.append(line_number)
+        if not pending:
+            continue
+
+        signatures = hasher.signatures([shingles(chunk[line_number - first_line], shingle_size)
+                                        for line_number in pending])
+        if len(store_lines) + len(pending) > len(store):
+            store = np.resize(store, (max(2 * len(store), len(store_lines) + len(pending)), num_perm))
+        store[len(store_lines):len(store_lines) + len(pending)] = signatures
+        for current, line_number, keys in zip(signatures, pending, hasher.band_keys(signatures, bands, rows)):
+            position = len(store_lines)
+            store_lines.append(line_number)
+            candidates = set()
+            for bucket, key in zip(buckets, keys):
+                candidates.update(bucket.get(key, ()))
+            if candidates:
+                candidates = sorted(candidates)
+                stats['candidates_checked'] += len(candidates)
+                similarities = np.count_nonzero(store[candidates] == current, axis=1) / num_perm
+                for candidate, similarity in zip(candidates, similarities.tolist()):
+                    if similarity < cluster_threshold:
+                        continue
+                    clusters.union(line_number, store_lines[candidate])
+                    if similarity >= threshold and line_number not in dropped:
+                        dropped.add(line_number)
+                        stats['near_duplicates'] += 1
+                        if len(stats['examples']) < 20:
+                            stats['examples'].append({'line': line_number, 'duplicate_of': store_lines[candidate],
+                                                      'similarity': round(similarity, 3)})
+            for bucket, key in zip(buckets, keys):
+                members = bucket.setdefault(key, [])
+                if len(members) < MAX_BUCKET_SIZE:
+                    members.append(position)
+        logging.info(f"Dedup: {stats['lines']} lines, {len(dropped)} duplicates")
+
+    stats['signature_mb'] = len(store_lines) * num_perm * 4 / 2 ** 20
+    return clusters, dropped, stats
+
+
+def parse_splits(splits):
+    """
+    Parses 'train=0.8,eval=0.1,test=0.1' into [(name, cumulative fraction), ...].
+    """
+    parsed, total = [], 0.0
+    for part in splits.split(','):
+        name, fraction = part.split('=')
+        total += float(fraction)
+        parsed.append((name.strip(), total))
+    if abs(total - 1.0) > 1e-6:
+        raise ValueError(f"Split fractions must sum to 1, got {total}")
+    return parsed
+
+
+def assign_split(text, splits):
+    """
+    Split of a cluster, from a hash of its root prompt so it is stable across runs.
+    """
+    position = int.from_bytes(exact_key(text), 'big') / 2 ** 64
+    return next((name for name, bound in splits if position < bound), splits[-1][0])
+
+
+def dedup(input_files, output_dir, threshold=DEFAULT_THRESHOLD, num_perm=DEFAULT_NUM_PERM,
+          shingle_size=DEFAULT_SHINGLE_SIZE, splits=DEFAULT_SPLITS, split_margin=DEFAULT_SPLIT_MARGIN, seed=1):
+    """
+    Removes exact and near-duplicate prompts and writes the rest to one file per split.
+
+    The inputs are streamed twice: the first pass finds the duplicate clusters, the
+    second writes every kept prompt to the split of its cluster's root, so no
+    near-duplicate cluster spans two splits.
+
+    Args:
+        input_files (list): Prompt text files, one prompt per line.
+        output_dir (str): Directory of the `<split>.txt` files and `dedup_report.json`.
+
+    Returns:
+        dict: The dedup report.
+    """
+    start = time.perf_counter()
+    splits = parse_splits(splits)
+    clusters, dropped, stats = find_duplicates(read_lines(input_files), threshold, num_perm, shingle_size,
+                                               split_margin, seed)
+    detection_seconds = time.perf_counter() - start
+
+    os.makedirs(output_dir, exist_ok=True)
+    files = {name: open(os.path.join(output_dir, f"{name}.txt"), 'w', encoding='utf-8') for name, _ in splits}
+    root_splits, split_counts, cluster_sizes = {}, dict.fromkeys(files, 0), {}
+    examples = {example['line']: example for example in stats['examples']}
+    wanted = set(examples) | {example['duplicate_of'] for example in stats['examples']}
+    texts = {}
+    try:
+        for line_number, text in enumerate(read_lines(input_files)):
+            root = clusters.find(line_number)
+            if root == line_number:
+                root_splits[root] = assign_split(text, splits)
+            cluster_sizes[root] = cluster_sizes.get(root, 0) + 1
+            if line_number in wanted:
+                texts[line_number] = text
+            if line_number not in dropped:
+                split = root_splits[root]
+                files[split].write(text + '\n')
+                split_counts[split] += 1
+    finally:
+        for file in files.values():
+            file.close()
+
+    for example in stats['examples']:
+        example['text'] = texts.get(example['line'])
+        example['duplicate_text'] = texts.get(example['duplicate_of'])
+    sizes = sorted(cluster_sizes.values(), reverse=True)
+    elapsed = time.perf_counter() - start
+    report = {
+        'input_files': list(input_files),
+        'threshold': threshold,
+        'num_perm': num_perm,
+        'shingle_size': shingle_size,
+        'split_margin': split_margin,
+        'bands': stats['bands'],
+        'rows_per_band': stats['rows_per_band'],
+        'lines': stats['lines'],
+        'kept': stats['lines'] - len(dropped),
+        'exact_duplicates': stats['exact_duplicates'],
+        'near_duplicates': stats['near_duplicates'],
+        'duplicate_rate': len(dropped) / stats['lines'] if stats['lines'] else 0.0,
+        'clusters': len(sizes),
+        'duplicate_clusters': sum(size > 1 for size in sizes),
+        'largest_clusters': sizes[:10],
+        'candidates_checked': stats['candidates_checked'],
+        'signature_mb': round(stats['signature_mb'], 1),
+        'splits': split_counts,
+        'detection_seconds': round(detection_seconds, 2),
+        'elapsed_seconds': round(elapsed, 2),
+        'lines_per_second': round(stats['lines'] / elapsed) if elapsed else 0,
+        'examples': stats['examples'],
+    }
+    with open(os.path.join(output_dir, 'dedup_report.json'), 'w', encoding='utf-8') as file:
+        json.dump(report, file, indent=2, ensure_ascii=False)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Remove exact and near-duplicate prompts (MinHash LSH) and split the rest without leakage.')
+    parser.add_argument('inputs', nargs='*', help='Prompt files or glob patterns, one prompt per line',
+                        default=['./data/expectation_and_prompt_sample/user_prompt_*.txt'])
+    parser.add_argument('-o', '--output-dir', default='./data/expectation_and_prompt_sample/dedup')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Estimated Jaccard similarity of word shingles at which prompts are duplicates')
+    parser.add_argument('--num-perm', type=int, default=DEFAULT_NUM_PERM, help='MinHash permutations')
+    parser.add_argument('--shingle-size', type=int, default=DEFAULT_SHINGLE_SIZE, help='Words per shingle')
+    parser.add_argument('--splits', default=DEFAULT_SPLITS, help='Split names and fractions')
+    parser.add_argument('--split-margin', type=float, default=DEFAULT_SPLIT_MARGIN,
+                        help='Prompts this far below the threshold are still kept in the same split')
+    parser.add_argument('--seed', type=int, default=1, help='MinHash permutation seed')
+    args = parser.parse_args()
+
+    input_files = sorted({path for pattern in args.inputs for path in glob.glob(pattern)})
+    if not input_files:
+        parser.error(f"No input files match {args.inputs}")
+    report = dedup(input_files, args.output_dir, threshold=args.threshold, num_perm=args.num_perm,
+                   shingle_size=args.shingle_size, splits=args.splits, split_margin=args.split_margin, seed=args.seed)
+    logging.info(f"Dedup report: {report}")
+    print(f"{report['lines']} prompts: kept {report['kept']}, dropped {report['exact_duplicates']} exact and "
+          f"{report['near_duplicates']} near duplicates ({report['duplicate_rate']:.1%}) "
+          f"in {report['duplicate_clusters']} clusters")
+    print(f"Splits: {report['splits']}")
+    print(f"{report['elapsed_seconds']}s ({report['lines_per_second']} lines/sec), "
+          f"bands {report['bands']} x {report['rows_per_band']} rows, {report['signature_mb']} MB of signatures")
+    print(f"Report saved to {os.path.join(args.output_dir, 'dedup_report.json')}")
@@ -1,14 +1,18 @@
-from langchain_openai import OpenAIEmbeddings
-from langchain_postgres import PGVector
-from langchain.prompts import PromptTemplate
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import hashlib
+import threading
+import time
 import os
 import dotenv
 import argparse
+import tracing
 
 
 dotenv.load_dotenv()
-# Initialize OpenAI Embeddings
-embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+EMBEDDING_MODEL = "text-embedding-3-large"
+# Optional reduced embedding size; pgvector can only index up to 2000 dimensions
+EMBEDDING_DIMENSIONS = int(os.getenv('EMBEDDING_DIMENSIONS', 0)) or None
 
 # Database connection configuration
 db_connection_args = {
@@ -19,56 +23,242 @@ db_connection_args = {
     "database": os.getenv('POSTGRES_DB', 'GELMDB')
 }
 
+# Default per-query ANN search parameters (pgvector_admin.py manages the index itself)
+PG_EF_SEARCH = int(os.getenv('PG_EF_SEARCH', 0)) or None
+PG_IVFFLAT_PROBES = int(os.getenv('PG_IVFFLAT_PROBES', 0)) or None
 
-# Create PGVector instance
-vector_store = PGVector(
-    embeddings=embeddings,
-    collection_name="sample_text_file",
-    connection=f"postgresql+psycopg://{db_connection_args['user']}:{db_connection_args['password']}@{db_connection_args['host']}/{db_connection_args['database']}"
-)
+# 'pgvector' queries Postgres, 'local' searches the memory-mapped snapshot built by local_index.py
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'pgvector')
 
+# The embeddings client, the database engine and the vector store are created on
+# first use, so importing this module needs neither langchain nor a live database
+_clients = {}
+_clients_lock = threading.Lock()
 
-def search_text(query, top_n=3):
+
+def _get_or_create(name, factory):
+    if name not in _clients:
+        with _clients_lock:
+            if name not in _clients:
+                _clients[name] = factory()
+    return _clients[name]
+
+
+def configure_clients(**clients):
+    """
+    Replace shared clients by name ('embeddings', 'engine', 'vector_store', 'local_index'),
+    e.g. with a local embeddings endpoint and an in-memory store for offline runs.
+    """
+    with _clients_lock:
+        _clients.update(clients)
+    embed_query_cached.cache_clear()
+
+
+def get_embeddings():
+    """
+    OpenAI embeddings client, created on first use.
+    """
+    def create():
+        from langchain_openai import OpenAIEmbeddings
+        return OpenAIEmbeddings(model=EMBEDDING_MODEL, dimensions=EMBEDDING_DIMENSIONS)
+    return _get_or_create('embeddings', create)
+
+
+def get_engine():
+    """
+    Pooled engine shared by the vector store and the tuned search path (see pgvector_admin.POOL_SETTINGS).
+    """
+    def create():
+        from pgvector_admin import build_engine
+        return build_engine(db_connection_args)
+    return _get_or_create('engine', create)
+
+
+def get_vector_store():
+    """
+    PGVector store of the sample prompts, connected on first use.
+    """
+    def create():
+        from langchain_postgres import PGVector
+        return PGVector(
+            embeddings=get_embeddings(),
+            collection_name="sample_text_file",
+            connection=get_engine(),
+            embedding_length=EMBEDDING_DIMENSIONS
+        )
+    return _get_or_create('vector_store', create)
+
+
+@functools.lru_cache(maxsize=1024)
+def embed_query_cached(query):
+    """
+    Embed a search query once per distinct text; combos sharing categories repeat their queries.
+    """
+    with tracing.span('embedding', 'embed_query', model=EMBEDDING_MODEL) as span:
+        span.record_text([query])
+        return get_embeddings().embed_query(query)
+
+
+def get_local_index():
+    """
+    Load the local snapshot index on first use.
+    """
+    def create():
+        from local_index import LocalVectorIndex, DEFAULT_INDEX_PATH
+        return LocalVectorIndex(DEFAULT_INDEX_PATH, get_embeddings(), use_hnsw=os.getenv('LOCAL_INDEX_HNSW') == '1')
+    return _get_or_create('local_index', create)
+
+
+def search_text(query, top_n=3, backend=None, ef_search=None, probes=None):
     """
     Perform a similarity search on the embedding table using LangChain's vector store.
 
     Args:
         query (str): The search query to match against the embeddings.
         top_n (int): The number of top documents to retrieve.
+        backend (str): 'pgvector' or 'local', defaults to the SEARCH_BACKEND environment variable.
+        ef_search (int): HNSW ef_search for this query, defaults to PG_EF_SEARCH.
+        probes (int): IVFFlat probes for this query, defaults to PG_IVFFLAT_PROBES.
 
     Returns:
         list: A list of document contents from the embedding table.
     """
     try:
-        # Perform similarity search in the vector store
-        results = vector_store.similarity_search(query, k=top_n)
-        
-        # Extract document content
-        documents = [result.page_content for result in results]
-        
-        return documents
-    
+        with tracing.span('search', backend or SEARCH_BACKEND, top_n=top_n) as span:
+            documents = _search_text(query, top_n, backend, ef_search, probes)
+            span.set(results=len(documents))
+            return documents
     except Exception as e:
         print(f"Error during similarity search: {e}")
         return []
 
 
+def _search_text(query, top_n, backend, ef_search, probes):
+    if (backend or SEARCH_BACKEND) == 'local':
+        return get_local_index().search(query, top_n=top_n)
+
+    ef_search = ef_search or PG_EF_SEARCH
+    probes = probes or PG_IVFFLAT_PROBES
+    if ef_search or probes:
+        from pgvector_admin import search_by_vector
+        return search_by_vector(get_engine(), embed_query_cached(query), k=top_n,
+                                collection_name="sample_text_file",
+                                ef_search=ef_search, probes=probes)
+
+    # Perform similarity search in the vector store
+    results = get_vector_store().similarity_search_by_vector(embed_query_cached(query), k=top_n)
+    
+    # Extract document content
+    documents = [result.page_content for result in results]
+    
+    return documents
+
+
         
-def embed_sample_text(sample_prompt_file):
+def normalize_text(text):
+    """
+    Normalize a prompt line for de-duplication (trim, collapse whitespace, casefold).
+    """
+    return ' '.join(text.split()).casefold()
+
+
+def content_hash(text):
+    """
+    Content address of a prompt line, used as its row ID in the vector store.
+    """
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def find_existing_ids(store, ids):
+    """
+    Return the subset of `ids` already present in the vector store.
+    """
+    return {document.id for document in store.get_by_ids(list(ids))}
+
+
+def embed_sample_text(sample_prompt_file, store=None, batch_size=256, max_in_flight=4):
+    """
+    Incrementally embed the lines of a prompt file into the vector store.
+
+    Each normalized line is hashed and the hash is used as the row ID (and stored
+    as `content_hash` metadata), so lines that are duplicated in the file or already
+    present in the store are skipped. The remaining lines are embedded in batches
+    with several batches in flight at once.
+
+    Args:
+        sample_prompt_file (str): Text file with one prompt per line.
+        store (VectorStore): Target store, the PGVector collection by default.
+        batch_size (int): Lines embedded per request.
+        max_in_flight (int): Batches embedded and inserted concurrently.
+
+    Returns:
+        dict: Counts of read, duplicate, already present and inserted lines, and rows/sec.
+    """
+    store = store if store is not None else get_vector_store()
+    start = time.perf_counter()
+
     with open(sample_prompt_file, 'r') as file:
         prompts = [line.strip() for line in file if line.strip()]
-    
-    # Add prompts to vector store
-    vector_store.add_texts(
-        texts=prompts,
-        metadatas=[{"source": sample_prompt_file} for _ in prompts]
-    )
+
+    # De-duplicate within the file, keeping the first spelling of each line
+    unique = {}
+    for prompt in prompts:
+        unique.setdefault(content_hash(prompt), prompt)
+
+    # Skip lines already ingested by a previous run
+    ids = list(unique)
+    existing = set()
+    for i in range(0, len(ids), batch_size):
+        existing |= find_existing_ids(store, ids[i:i + batch_size])
+    new_ids = [id_ for id_ in ids if id_ not in existing]
+
+    def add_batch(batch_ids):
+        texts = [unique[id_] for id_ in batch_ids]
+        # Embeds and inserts the batch; the embedding API reports no usage, so tokens are estimated
+        with tracing.span('embedding', 'add_texts', model=EMBEDDING_MODEL, rows=len(texts)) as span:
+            span.record_text(texts)
+            store.add_texts(
+                texts=texts,
+                metadatas=[{"source": sample_prompt_file, "content_hash": id_} for id_ in batch_ids],
+                ids=batch_ids
+            )
+        return len(batch_ids)
+
+    inserted = 0
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        batches = [new_ids[i:i + batch_size] for i in range(0, len(new_ids), batch_size)]
+        for count in executor.map(add_batch, batches):
+            inserted += count
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        'read': len(prompts),
+        'duplicates_in_file': len(prompts) - len(unique),
+        'already_present': len(existing),
+        'inserted': inserted,
+        'rows_per_sec': inserted / elapsed if elapsed else 0.0,
+    }
+    print(f"Read {stats['read']} lines: {stats['duplicates_in_file']} duplicates in file, "
+          f"{stats['already_present']} already embedded, {stats['inserted']} inserted "
+          f"in {elapsed:.1f}s ({stats['rows_per_sec']:.1f} rows/sec)")
+    return stats
+
+
+def build_local_store(embedding_size=256):
+    """
+    In-memory vector store with deterministic fake embeddings, for offline runs and tests.
+    """
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from langchain_core.vectorstores import InMemoryVectorStore
+    return InMemoryVectorStore(DeterministicFakeEmbedding(size=embedding_size))
 
     
 def main(args):
     # Load prompts from file
     sample_prompt_file = args.filepath
-    embed_sample_text(sample_prompt_file=sample_prompt_file)
+    store = build_local_store() if args.store == 'memory' else get_vector_store()
+    embed_sample_text(sample_prompt_file=sample_prompt_file, store=store,
+                      batch_size=args.batch_size, max_in_flight=args.in_flight)
 
 
     
@@ -78,6 +268,10 @@ if __name__ == '__main__':
                         help='Enter the filepath of the txt file to be encoded',
                         required=False,
                         default='./data/expectation_and_prompt_sample/sample_quality_check_prompts.txt')
-    
+    parser.add_argument('--batch-size', type=int, default=256, help='Lines embedded per request')
+    parser.add_argument('--in-flight', type=int, default=4, help='Batches embedded concurrently')
+    parser.add_argument('--store', choices=['pgvector', 'memory'], default='pgvector',
+                        help='Target store; memory uses deterministic fake embeddings (dry run)')
+
     args = parser.parse_args()
     main(args)
\ No newline at end of file
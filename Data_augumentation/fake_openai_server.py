@@ -0,0 +1,260 @@
+import argparse
+import array
+import base64
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Column names quoted as 'name' or `name` in the data quality prompts
+COLUMN_PATTERN = re.compile(r"['`](\w+)['`]")
+# Size of the fake embeddings when a request sets no `dimensions`
+EMBEDDING_DIMENSIONS = 256
+# Prompts of one generate_prompts.py answer, as its PROMPT asks for
+GENERATED_PROMPTS = 25
+# The cleaned expectations RL_dataset.py asks to reformat
+GSM8K_EXPECTATIONS_PATTERN = re.compile(r'Expected Answer \(Cleaned Expectations\): (.*)')
+
+
+def fake_expectations(text):
+    """
+    Build a deterministic, well formed expectation list for a user prompt.
+    """
+    columns = COLUMN_PATTERN.findall(text) or ['value']
+    return ',\n'.join(
+        f'expect_column_to_exist(column="{column}"),\nexpect_column_values_to_not_be_null(column="{column}")'
+        for column in dict.fromkeys(columns)
+    )
+
+
+# Numbered prompts of a packed request, "[1] prompt"
+PACKED_PROMPT_PATTERN = re.compile(r'^\[(\d+)\] (.*)$', re.MULTILINE)
+
+
+def fake_user_prompts(prompt):
+    """
+    Numbered, quoted data quality prompts like generate_prompts.py expects, varying with the request.
+    """
+    seed = hashlib.blake2b(prompt.encode('utf-8'), digest_size=4).hexdigest()
+    return '\n'.join(f'{i}. "For field \'field_{seed}_{i}\': Ensure the field is required (not null)."'
+                     for i in range(1, GENERATED_PROMPTS + 1))
+
+
+def fake_gsm8k_answer(prompt):
+    """
+    RL_dataset.py answer: a reasoning step, then the expectations after `####`.
+    """
+    match = GSM8K_EXPECTATIONS_PATTERN.search(prompt)
+    expectations = match.group(1).strip() if match else fake_expectations(prompt)
+    return f'answer:\n1. The expectations follow from the question.\n\\n####  "{expectations}"'
+
+
+def fake_completion(prompt):
+    """
+    Answer a single prompt with its expectations, or a packed request with a JSON array of them.
+    Prompt generation (generate_prompts.py) and GSM8K formatting (RL_dataset.py) requests
+    get answers in the layout those scripts parse.
+    """
+    packed = PACKED_PROMPT_PATTERN.findall(prompt)
+    if packed and 'JSON array' in prompt:
+        return json.dumps([{'index': int(index), 'expectations': fake_expectations(text)} for index, text in packed])
+    if 'GSM8K-Formatted Answer' in prompt:
+        return fake_gsm8k_answer(prompt)
+    if 'expectation prompts' in prompt:
+        return fake_user_prompts(prompt)
+    return fake_expectations(prompt)
+
+
+def fake_embedding(text, dimensions=EMBEDDING_DIMENSIONS):
+    """
+    Deterministic unit vector of a text: the same text always gets the same embedding.
+    """
+    rng = random.Random(hashlib.blake2b(text.encode('utf-8'), digest_size=8).digest())
+    vector = [rng.gauss(0.0, 1.0) for _ in range(dimensions)]
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def encode_embedding(vector, encoding_format):
+    """
+    Floats, or the little-endian float32 base64 the openai client requests by default.
+    """
+    if encoding_format == 'base64':
+        return base64.b64encode(array.array('f', vector).tobytes()).decode('ascii')
+    return vector
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    Minimal OpenAI compatible `/v1/chat/completions` and `/v1/embeddings` endpoints.
+
+    Every `rate_limit_every`-th request is answered with a 429 and a random
+    `error_rate` share with a 500, so clients can exercise their retry and backoff
+    logic. `GET /stats` returns the request, error and per-endpoint counts.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/stats'):
+            with self.server.lock:
+                self._send_json(200, dict(self.server.stats))
+        else:
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        server = self.server
+
+        with server.lock:
+            server.request_count += 1
+            count = server.request_count
+            server.stats['requests'] = count
+            latency = server.latency + (server.rng.uniform(0.0, server.latency_jitter) if server.latency_jitter else 0.0)
+            failed = bool(server.error_rate) and server.rng.random() < server.error_rate
+
+        if latency:
+            time.sleep(latency)
+
+        if server.rate_limit_every and count % server.rate_limit_every == 0:
+            self._count('rate_limited')
+            self._send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'requests'}},
+                            headers={'retry-after': '0.1'})
+            return
+
+        if failed:
+            self._count('server_errors')
+            self._send_json(500, {'error': {'message': 'Injected server error', 'type': 'server_error'}})
+            return
+
+        if self.path.rstrip('/').endswith('/embeddings'):
+            self._count('embeddings')
+            self._send_embeddings(request, count)
+            return
+
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+            return
+        self._count('chat')
+
+        messages = request.get('messages', [])
+        prompt = messages[-1].get('content', '') if messages else ''
+        content = fake_completion(prompt)
+        prompt_tokens = sum(len(str(m.get('content', ''))) for m in messages) // 4
+        completion_tokens = len(content) // 4
+        self._send_json(200, {
+            'id': f'chatcmpl-fake-{count}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'fake-model'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+                'total_tokens': prompt_tokens + completion_tokens,
+            },
+        })
+
+    def _count(self, name):
+        with self.server.lock:
+            self.server.stats[name] = self.server.stats.get(name, 0) + 1
+
+    def _send_embeddings(self, request, count):
+        inputs = request.get('input', [])
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dimensions = request.get('dimensions') or self.server.embedding_dimensions
+        encoding_format = request.get('encoding_format', 'float')
+        data = []
+        for index, text in enumerate(inputs):
+            # Inputs already tokenized by the client are embedded by their token ids
+            text = text if isinstance(text, str) else ' '.join(map(str, text))
+            data.append({'object': 'embedding', 'index': index,
+                         'embedding': encode_embedding(fake_embedding(text, dimensions), encoding_format)})
+        tokens = sum(len(str(text)) for text in inputs) // 4
+        self._send_json(200, {
+            'object': 'list',
+            'data': data,
+            'model': request.get('model', 'fake-embedding'),
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens},
+        })
+
+
+def start_server(host='127.0.0.1', port=0, latency=0.0, rate_limit_every=0, latency_jitter=0.0, error_rate=0.0,
+                 embedding_dimensions=EMBEDDING_DIMENSIONS, seed=0):
+    """
+    Start the fake server on a background thread.
+
+    Args:
+        host (str): Interface to bind.
+        port (int): Port to bind, 0 picks a free one.
+        latency (float): Seconds to sleep before answering each request.
+        rate_limit_every (int): Answer every n-th request with a 429 (0 disables).
+        latency_jitter (float): Up to this many extra seconds, drawn uniformly per request.
+        error_rate (float): Share of requests answered with a 500.
+        embedding_dimensions (int): Size of the embeddings when a request sets no `dimensions`.
+        seed (int): Seed of the jitter and error draws, so runs inject the same faults.
+
+    Returns:
+        ThreadingHTTPServer: The running server; its base URL is `server.base_url`.
+    """
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.rate_limit_every = rate_limit_every
+    server.latency_jitter = latency_jitter
+    server.error_rate = error_rate
+    server.embedding_dimensions = embedding_dimensions
+    server.rng = random.Random(seed)
+    server.stats = {'requests': 0}
+    server.request_count = 0
+    server.lock = threading.Lock()
+    server.base_url = f'http://{host}:{server.server_address[1]}/v1'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local OpenAI compatible stub for offline runs.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='Seconds of simulated latency per request')
+    parser.add_argument('--rate-limit-every', type=int, default=0,
+                        help='Return HTTP 429 on every n-th request (0 disables)')
+    parser.add_argument('--latency-jitter', type=float, default=0.0,
+                        help='Up to this many extra seconds of latency, drawn per request')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of requests answered with HTTP 500')
+    parser.add_argument('--embedding-dimensions', type=int, default=EMBEDDING_DIMENSIONS,
+                        help='Size of the fake embeddings when a request sets no dimensions')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the injected latency and errors')
+    args = parser.parse_args()
+
+    server = start_server(args.host, args.port, args.latency, args.rate_limit_every, args.latency_jitter,
+                          args.error_rate, args.embedding_dimensions, args.seed)
+    print(f"Fake OpenAI server listening on {server.base_url} (set OPENAI_BASE_URL to use it)", flush=True)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
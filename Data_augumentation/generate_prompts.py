@@ -1,13 +1,19 @@
-import pandas as pd
 import os
 import re
+import sys
 import random
-import time
+import json
+import argparse
+import multiprocessing
+import tracing
 from itertools import combinations
 from embed_sample_prompt import search_text
 from datetime import datetime
 
 from util_func import generate_prompt_text
+from llm_cache import add_cache_arguments, configure_llm_cache, get_llm_cache, CacheMissError
+from llm_engine import GenerationEngine, is_retryable
+from result_sink import hash_input, iter_chunks
 
 
 
@@ -43,6 +49,9 @@ Return the **25 prompts** as a **structured list**, ensuring:
 Ensure the prompts are tailored to reflect the nuances of the selected domains and constraints.
 '''
 
+# Approximate tokens per combo request (rendered PROMPT with examples plus 25 generated prompts)
+PROMPT_TOKENS = 2500
+
 DOMAINS = [ "E-commerce", "Healthcare", "Banking and Finance", "Social Media Platforms", "Education and Learning Management Systems", "Customer Relationship Management (CRM)",
     "Enterprise Resource Planning (ERP)",  "Travel and Hospitality", "Retail and Inventory Management",
     "Government and Public Services", "Real Estate Management", "Telecommunications", "Gaming and Entertainment", "Supply Chain Management",
@@ -64,6 +73,8 @@ def process_excel_with_expectations(file_path):
     Combine descriptions with expectations into a final dictionary.
     """
     
+    import pandas as pd
+
     try:
         df = pd.read_excel(file_path, engine='openpyxl')
     except Exception as e:
@@ -119,13 +130,22 @@ def create_categories_combo(categories_key):
     
 
 
-def create_user_prompt(selected_constraints):
+def create_user_prompt(selected_constraints, rng=random, output_file=None):
     """
     Dynamically generate a user prompt based on selected constraints and random domains.
+
+    Args:
+        selected_constraints (list): Constraint categories of the combo.
+        rng (random.Random): Source of randomness for the domain selection.
+        output_file (str): File receiving the prompts, the daily file when omitted.
+            Pass False to only return them.
+
+    Returns:
+        str: The cleaned prompts (empty if none could be extracted).
     """
     # Select random domains
-    num_domains = random.randint(2, 5)
-    selected_domains = random.sample(DOMAINS, num_domains)
+    num_domains = rng.randint(2, 5)
+    selected_domains = rng.sample(DOMAINS, num_domains)
     
     # Extract constraint definitions
     selected_constraints_definition = [CATEGORIES.get(x, 'No description available') for x in selected_constraints]
@@ -152,54 +172,249 @@ def create_user_prompt(selected_constraints):
     # Clean the response to keep only the prompts
     cleaned_response = extract_prompts(response)
     
-    if cleaned_response:
-        write_to_user_prompt_file(cleaned_response)
+    if cleaned_response and output_file is not False:
+        write_to_user_prompt_file(cleaned_response, file_name=output_file)
+    return cleaned_response
 
 
-def write_to_user_prompt_file(content):
+def write_to_user_prompt_file(content, file_name=None):
     """
-    Write or append content to a daily timestamped file.
+    Write or append content to a file, by default the daily timestamped file.
     """
-    # Generate daily filename
-    today = datetime.now().strftime("%Y_%m_%d")
-    directory = "./data/expectation_and_prompt_sample"
-    os.makedirs(directory, exist_ok=True)
-    file_name = os.path.join(directory, f"user_prompt_{today}.txt")
-    
-    # Write or append to the file
-    write_mode = 'a' if os.path.exists(file_name) else 'w'
-    with open(file_name, write_mode) as file:
-        if write_mode == 'a':
-            file.write("\n")  # Add a separator for new entries
-        file.write(content)
-    
+    if file_name is None:
+        # Generate daily filename
+        today = datetime.now().strftime("%Y_%m_%d")
+        directory = "./data/expectation_and_prompt_sample"
+        file_name = os.path.join(directory, f"user_prompt_{today}.txt")
+    os.makedirs(os.path.dirname(file_name) or '.', exist_ok=True)
+
+    # Entries end in a newline and are appended in one O_APPEND write, so local workers
+    # sharing a shard's file never interleave; older files may lack the final newline
+    separator = ''
+    if os.path.exists(file_name) and os.path.getsize(file_name):
+        with open(file_name, 'rb') as file:
+            file.seek(-1, os.SEEK_END)
+            separator = '' if file.read(1) == b'\n' else '\n'
+    data = (separator + content + '\n').encode('utf-8')
+    with tracing.span('file_write', 'user_prompt_file', bytes=len(data)):
+        fd = os.open(file_name, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
     print(f"Content successfully written to {file_name}")
 
+
+# --------------------------
+# SCHEDULER
+# --------------------------
+
+def combo_key(combo):
+    """
+    Stable identifier of a category combination.
+    """
+    return ' | '.join(combo)
+
+
+def parse_shard(shard):
+    """
+    Parse an 'i/N' shard specification into (i, N).
+    """
+    try:
+        index, count = (int(part) for part in shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Shard must look like 'i/N', got '{shard}'")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Shard index must satisfy 0 <= i < N, got '{shard}'")
+    return index, count
+
+
+def select_shard(combos, shard_index, num_shards):
+    """
+    Deterministically assign combos to shards by hashing their key, so every
+    process or machine computes the same partition without coordination.
+    """
+    return [combo for combo in combos
+            if int(hash_input(combo_key(combo))[:16], 16) % num_shards == shard_index]
+
+
+def load_combo_status(status_file):
+    """
+    Latest recorded status ('done' or 'failed') of every combo in a shard's status log.
+    """
+    status = {}
+    if os.path.exists(status_file):
+        with open(status_file, 'r') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn line from an interrupted run
+                status[record['combo']] = record['status']
+    return status
+
+
+def run_shard(shard_index=0, num_shards=1, concurrency=4, requests_per_minute=60, tokens_per_minute=200000,
+              only_failed=False, output_dir='./data/expectation_and_prompt_sample/runs', seed=None,
+              worker_index=0, num_workers=1):
+    """
+    Generate prompts for one shard of the category combinations.
+
+    Combos run concurrently through a GenerationEngine whose rate limiter replaces
+    the old fixed sleep. Each shard appends to its own output file and records the
+    status of every combo, so reruns skip finished combos and can target failed ones.
+    Local workers of a shard take disjoint parts of its combos and append to the
+    shard's files, so a rerun sees their records whatever its number of workers.
+
+    Args:
+        shard_index (int): Index i of this shard.
+        num_shards (int): Total number of shards N.
+        concurrency (int): Combos in flight at once.
+        requests_per_minute (int): Request budget of this shard.
+        tokens_per_minute (int): Token budget of this shard.
+        only_failed (bool): Only retry combos whose last status is 'failed'.
+        output_dir (str): Directory of the shard output and status files.
+        seed (int): Seed for reproducible (and therefore cacheable) domain sampling.
+        worker_index (int): Index k of this local worker of the shard.
+        num_workers (int): Local workers W sharing the shard.
+    """
+    # Sub-shard i + k*N of N*W: since hash % (N*W) % N == hash % N, the W workers
+    # cover exactly the combos of shard i/N
+    categories_combo = select_shard(create_categories_combo(list(CATEGORIES.keys())),
+                                    shard_index + worker_index * num_shards, num_shards * num_workers)
+
+    shard_name = f"shard_{shard_index}_of_{num_shards}"
+    output_file = os.path.join(output_dir, f"user_prompt_{shard_name}.txt")
+    status_file = os.path.join(output_dir, f"status_{shard_name}.jsonl")
+    os.makedirs(output_dir, exist_ok=True)
+
+    status = load_combo_status(status_file)
+    if only_failed:
+        pending = [combo for combo in categories_combo if status.get(combo_key(combo)) == 'failed']
+    else:
+        pending = [combo for combo in categories_combo if status.get(combo_key(combo)) != 'done']
+    worker_name = f" (worker {worker_index}/{num_workers})" if num_workers > 1 else ''
+    print(f"Shard {shard_index}/{num_shards}{worker_name}: {len(categories_combo)} combos, {len(pending)} to run.")
+
+    def generate(combo):
+        rng = random.Random(f"{seed}:{combo_key(combo)}") if seed is not None else random.Random()
+        try:
+            return {'prompts': create_user_prompt(list(combo), rng=rng, output_file=False)}
+        except CacheMissError:
+            raise  # a replay run stops at the first request it has no response for
+        except Exception as e:
+            if is_retryable(e):
+                raise  # let the engine back off and retry
+            return {'error': str(e)}
+
+    engine = GenerationEngine(concurrency=concurrency, requests_per_minute=requests_per_minute,
+                              tokens_per_minute=tokens_per_minute, token_estimator=lambda combo: PROMPT_TOKENS,
+                              fatal_exceptions=(CacheMissError,))
+
+    for chunk in iter_chunks(pending, concurrency * 4):
+        results = engine.run(generate, chunk)
+        prompts = [result['prompts'] for result in results if result and result.get('prompts')]
+        if prompts:
+            write_to_user_prompt_file('\n'.join(prompts), file_name=output_file)
+
+        records = []
+        for combo, result in zip(chunk, results):
+            ok = bool(result) and 'error' not in result
+            if not ok:
+                print(f"Error processing combo {combo}: {(result or {}).get('error', 'retries exhausted')}")
+            records.append(json.dumps({
+                'combo': combo_key(combo),
+                'status': 'done' if ok else 'failed',
+                'error': None if ok else (result or {}).get('error', 'retries exhausted'),
+                'timestamp': datetime.now().isoformat(timespec='seconds'),
+            }) + '\n')
+        # One O_APPEND write per chunk, so the records of workers sharing the file never interleave
+        fd = os.open(status_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, ''.join(records).encode('utf-8'))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    engine.report()
+
+
 # --------------------------
 # MAIN LOGIC
 # --------------------------
 
             
             
-def main():
+def run_shard_process(categories, cache_path, cache_mode, *args, **kwargs):
+    """
+    Entry point of a local worker process: restore the module state, run its shard
+    and report its own cache statistics.
+    """
+    global CATEGORIES
+    CATEGORIES = categories
+    configure_llm_cache(path=cache_path, mode=cache_mode)
+    try:
+        run_shard(*args, **kwargs)
+        print(get_llm_cache().summary())
+    finally:
+        tracing.flush()
+
+
+def main(args):
     file_path = './data/expectation_and_prompt_sample/listExpectations.xlsx'
     try:
         global CATEGORIES
         CATEGORIES = process_excel_with_expectations(file_path)
     except FileNotFoundError as e:
         print(e)
-        return
-    
-    categories_key = list(CATEGORIES.keys())
-    categories_combo = create_categories_combo(categories_key)
-    
-    for combo in categories_combo:
-        try:
-            create_user_prompt(list(combo))
-            time.sleep(5)
-        except Exception as e:
-            print(f"Error processing combo {combo}: {e}")
+        return 1
+
+    shard_index, num_shards = args.shard
+    shard_kwargs = dict(concurrency=args.concurrency, requests_per_minute=args.rpm, tokens_per_minute=args.tpm,
+                        only_failed=args.only_failed, output_dir=args.output_dir, seed=args.seed)
+
+    if args.local_workers > 1:
+        # One process per part of the shard; the rate budget is split between them
+        shard_kwargs['requests_per_minute'] = max(1, args.rpm // args.local_workers)
+        shard_kwargs['tokens_per_minute'] = max(1, args.tpm // args.local_workers)
+        workers = [
+            multiprocessing.Process(target=run_shard_process,
+                                    args=(CATEGORIES, args.cache_path, args.cache_mode, shard_index, num_shards),
+                                    kwargs=dict(shard_kwargs, worker_index=k, num_workers=args.local_workers))
+            for k in range(args.local_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        failed = [k for k, worker in enumerate(workers) if worker.exitcode != 0]
+        if failed:
+            print(f"Local workers {failed} of shard {shard_index}/{num_shards} exited with an error")
+            return 1
+    else:
+        run_shard(shard_index, num_shards, **shard_kwargs)
+        print(get_llm_cache().summary())
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1),
+                        help="Run shard i of N ('i/N') of the category combinations, e.g. one per machine")
+    parser.add_argument('--local-workers', type=int, default=1,
+                        help='Split the --shard between this many local processes sharing its files')
+    parser.add_argument('--concurrency', type=int, default=4, help='Combos in flight per shard')
+    parser.add_argument('--rpm', type=int, default=60, help='Requests per minute limit')
+    parser.add_argument('--tpm', type=int, default=200000, help='Tokens per minute limit')
+    parser.add_argument('--only-failed', action='store_true',
+                        help='Only retry combos recorded as failed in the shard status file')
+    parser.add_argument('--output-dir', default='./data/expectation_and_prompt_sample/runs',
+                        help='Directory of the per-shard prompt and status files')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed the domain sampling so reruns issue identical (cacheable) requests')
+    add_cache_arguments(parser)
+    args = parser.parse_args()
+
+    configure_llm_cache(path=args.cache_path, mode=args.cache_mode)
+    sys.exit(main(args))
@@ -0,0 +1,230 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import dotenv
+
+dotenv.load_dotenv()
+
+DEFAULT_CACHE_PATH = os.getenv('LLM_CACHE_PATH', './.cache/llm_responses.sqlite')
+DEFAULT_CACHE_MODE = os.getenv('LLM_CACHE_MODE', 'read_write')
+
+# read_write: read-through and write-through
+# read_only:  serve hits, call the API on a miss but do not store the response
+# write_only: always call the API and (re)write the entry
+# replay:     serve hits, raise CacheMissError on a miss (no API calls at all)
+# off:        bypass the cache
+CACHE_MODES = ('read_write', 'read_only', 'write_only', 'replay', 'off')
+
+
+class CacheMissError(KeyError):
+    """
+    Raised in replay mode when a request is not in the cache.
+    """
+
+
+class LLMCache:
+    """
+    Persistent, content-addressed cache of chat completions backed by SQLite.
+
+    Entries are keyed by a hash of (model, temperature, fully rendered messages),
+    so the same request made by any script is answered from disk.
+
+    Args:
+        path (str): SQLite file holding the cache.
+        mode (str): One of CACHE_MODES.
+        max_entries (int): Keep at most this many entries, evicting the least recently used.
+        max_age_days (float): Drop entries written more than this many days ago.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, mode=DEFAULT_CACHE_MODE, max_entries=None, max_age_days=None):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode '{mode}', expected one of {CACHE_MODES}")
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_age_days = max_age_days
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0}
+        self.lock = threading.Lock()
+        self.connection = None
+        if mode != 'off':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                ' key TEXT PRIMARY KEY, model TEXT, response TEXT,'
+                ' created_at REAL, accessed_at REAL)'
+            )
+            self.connection.commit()
+            self.evict()
+
+    @staticmethod
+    def make_key(model, temperature, messages):
+        """
+        Hash a request into its cache key.
+
+        Args:
+            model (str): Model name.
+            temperature (float): Sampling temperature.
+            messages (list): Rendered messages as {'role': ..., 'content': ...} dicts.
+
+        Returns:
+            str: Hex SHA-256 digest.
+        """
+        payload = json.dumps({'model': model, 'temperature': temperature, 'messages': messages},
+                             sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            row = self.connection.execute('SELECT response, created_at FROM responses WHERE key = ?', (key,)).fetchone()
+            if row and self.max_age_days and time.time() - row[1] > self.max_age_days * 86400:
+                row = None
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            self.stats['hits'] += 1
+            self.connection.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self.connection.commit()
+            return row[0]
+
+    def put(self, key, model, response):
+        now = time.time()
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO responses (key, model, response, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, model, response, now, now)
+            )
+            self.connection.commit()
+            self.stats['writes'] += 1
+
+    def get_or_call(self, model, temperature, messages, call, validate=None):
+        """
+        Return the cached response for a request, calling `call()` on a miss.
+
+        Args:
+            model (str): Model name, part of the cache key.
+            temperature (float): Sampling temperature, part of the cache key.
+            messages (list): Rendered messages, part of the cache key.
+            call (callable): Zero-argument function performing the real API call and returning text.
+            validate (callable): Optional check of a fresh response; responses it rejects
+                are returned but not cached, so a rerun asks again instead of replaying them.
+
+        Returns:
+            str: The (cached) response text.
+        """
+        if self.mode == 'off':
+            return call()
+
+        key = self.make_key(model, temperature, messages)
+        if self.mode != 'write_only':
+            cached = self.get(key)
+            if cached is not None:
+                return cached
+            if self.mode == 'replay':
+                raise CacheMissError(f"No cached response for request {key[:12]} (replay mode)")
+
+        response = call()
+        if response is not None and self.mode in ('read_write', 'write_only') and (validate is None or validate(response)):
+            self.put(key, model, response)
+        return response
+
+    def iter_responses(self, model=None):
+        """
+        Yield every cached response (optionally of one model), e.g. to re-run post-processing offline.
+        """
+        query = 'SELECT response FROM responses' + (' WHERE model = ?' if model else '') + ' ORDER BY created_at'
+        for (response,) in self.connection.execute(query, (model,) if model else ()):
+            yield response
+
+    def evict(self):
+        """
+        Apply the age and size eviction policy.
+
+        Returns:
+            int: Number of evicted entries.
+        """
+        evicted = 0
+        with self.lock:
+            if self.max_age_days:
+                cursor = self.connection.execute('DELETE FROM responses WHERE created_at < ?',
+                                                 (time.time() - self.max_age_days * 86400,))
+                evicted += cursor.rowcount
+            if self.max_entries:
+                cursor = self.connection.execute(
+                    'DELETE FROM responses WHERE key NOT IN '
+                    '(SELECT key FROM responses ORDER BY accessed_at DESC LIMIT ?)', (self.max_entries,)
+                )
+                evicted += cursor.rowcount
+            self.connection.commit()
+        if evicted:
+            logging.info(f"Evicted {evicted} entries from the LLM cache '{self.path}'.")
+        return evicted
+
+    def __len__(self):
+        if self.connection is None:
+            return 0
+        return self.connection.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+
+    def summary(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / lookups if lookups else 0.0
+        return (f"LLM cache ({self.mode}): {self.stats['hits']} hits, {self.stats['misses']} misses, "
+                f"{self.stats['writes']} writes, hit rate {hit_rate:.1%}")
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+_cache = None
+
+
+def get_llm_cache():
+    """
+    Return the process wide cache, configured from LLM_CACHE_PATH / LLM_CACHE_MODE unless set explicitly.
+    """
+    global _cache
+    if _cache is None:
+        _cache = LLMCache()
+    return _cache
+
+
+def configure_llm_cache(path=DEFAULT_CACHE_PATH, mode=DEFAULT_CACHE_MODE, max_entries=None, max_age_days=None):
+    """
+    Replace the process wide cache, e.g. from a script's --cache-mode flag.
+    """
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = LLMCache(path=path, mode=mode, max_entries=max_entries, max_age_days=max_age_days)
+    return _cache
+
+
+def add_cache_arguments(parser):
+    """
+    Add the shared --cache-* options to a script's argument parser.
+    """
+    parser.add_argument('--cache-mode', choices=CACHE_MODES, default=DEFAULT_CACHE_MODE,
+                        help='How LLM responses are read from / written to the response cache')
+    parser.add_argument('--cache-path', default=DEFAULT_CACHE_PATH, help='SQLite file of the response cache')
+    return parser
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Inspect and maintain the LLM response cache.')
+    parser.add_argument('--cache-path', default=DEFAULT_CACHE_PATH)
+    parser.add_argument('--max-entries', type=int, default=None, help='Evict down to this many entries (LRU)')
+    parser.add_argument('--max-age-days', type=float, default=None, help='Evict entries older than this')
+    args = parser.parse_args()
+
+    cache = LLMCache(path=args.cache_path, mode='read_only',
+                     max_entries=args.max_entries, max_age_days=args.max_age_days)
+    print(f"{len(cache)} cached responses in {args.cache_path}")
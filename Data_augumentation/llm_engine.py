@@ -0,0 +1,220 @@
+import asyncio
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tracing
+
+# HTTP status codes worth retrying: rate limiting, timeouts and server side errors
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+RETRYABLE_EXCEPTIONS = ('APIConnectionError', 'APITimeoutError', 'ConnectError', 'ReadTimeout')
+
+
+def estimate_tokens(text):
+    """
+    Rough token estimate (~4 characters per token) used for the tokens-per-minute budget.
+    """
+    return max(1, len(str(text)) // 4)
+
+
+def get_status_code(error):
+    """
+    Extract the HTTP status code from an OpenAI/httpx style exception, if any.
+    """
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status
+
+
+def is_retryable(error):
+    """
+    Decide whether a failed call should be retried (429, 5xx, timeouts, dropped connections).
+    """
+    if get_status_code(error) in RETRYABLE_STATUS_CODES:
+        return True
+    return type(error).__name__ in RETRYABLE_EXCEPTIONS
+
+
+def get_retry_after(error):
+    """
+    Return the server supplied Retry-After delay in seconds, if present.
+    """
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at `rate_per_minute`.
+
+    The refill rate adapts to the server: `slow_down` cuts it after a 429
+    (at most once per `cooldown` seconds, so one burst of 429s counts once)
+    and `speed_up` recovers it step by step up to the configured maximum.
+    """
+
+    def __init__(self, rate_per_minute, min_rate_per_minute=None, cooldown=1.0):
+        self.max_rate = rate_per_minute / 60.0
+        self.min_rate = (min_rate_per_minute or max(1, rate_per_minute // 20)) / 60.0
+        self.rate = self.max_rate
+        self.cooldown = cooldown
+        self.slowed_at = 0.0
+        self.capacity = float(rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = None
+        self.loop = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(float(amount), self.capacity)
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # asyncio locks are bound to one event loop; `run` starts a new one per call
+            self.lock, self.loop = asyncio.Lock(), loop
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+    def slow_down(self):
+        now = time.monotonic()
+        if now - self.slowed_at >= self.cooldown:
+            self.slowed_at = now
+            self.rate = max(self.min_rate, self.rate * 0.7)
+
+    def speed_up(self):
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class RateLimiter:
+    """
+    Combined requests-per-minute and tokens-per-minute limiter.
+    """
+
+    def __init__(self, requests_per_minute=500, tokens_per_minute=200000):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, tokens=1):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(tokens)
+
+    def on_rate_limited(self):
+        self.requests.slow_down()
+        self.tokens.slow_down()
+
+    def on_success(self):
+        self.requests.speed_up()
+        self.tokens.speed_up()
+
+
+class GenerationEngine:
+    """
+    Runs a blocking LLM call over many inputs with bounded parallelism.
+
+    Any callable taking one input works, e.g.
+    `functools.partial(get_expectation_from_openai, raise_errors=True)` or
+    `lambda kwargs: generate_prompt_text(PROMPT, **kwargs)`. Results keep the
+    order of the inputs; inputs that still fail after `max_retries` yield None.
+
+    Args:
+        concurrency (int): Maximum number of calls in flight.
+        requests_per_minute (int): Request budget of the rate limiter.
+        tokens_per_minute (int): Token budget of the rate limiter.
+        max_retries (int): Retries per input on 429/5xx/timeouts.
+        backoff_base (float): First backoff delay in seconds, doubled on every retry.
+        backoff_max (float): Upper bound of a single backoff delay.
+        token_estimator (callable): Maps an input to its estimated token cost.
+        rate_limiter (RateLimiter): Shared limiter, built from the budgets if omitted.
+        fatal_exceptions (tuple): Exception types that abort the whole run instead of yielding None.
+    """
+
+    def __init__(self, concurrency=8, requests_per_minute=500, tokens_per_minute=200000,
+                 max_retries=5, backoff_base=1.0, backoff_max=60.0,
+                 token_estimator=estimate_tokens, rate_limiter=None, fatal_exceptions=()):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.token_estimator = token_estimator
+        self.rate_limiter = rate_limiter or RateLimiter(requests_per_minute, tokens_per_minute)
+        self.fatal_exceptions = tuple(fatal_exceptions)
+        self.stats = {'completed': 0, 'failed': 0, 'retries': 0, 'elapsed': 0.0}
+
+    @property
+    def throughput(self):
+        """Prompts per second over all runs of this engine."""
+        done = self.stats['completed'] + self.stats['failed']
+        return done / self.stats['elapsed'] if self.stats['elapsed'] else 0.0
+
+    async def _call(self, fn, item, executor, semaphore):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        queued = time.perf_counter()
+        async with semaphore:
+            while True:
+                await self.rate_limiter.acquire(self.token_estimator(item))
+                # Time spent waiting for a slot and the rate limiter, recorded on the call's spans
+                call = tracing.bind_call(fn, queue_wait_ms=(time.perf_counter() - queued) * 1000, attempt=attempt)
+                try:
+                    result = await loop.run_in_executor(executor, call, item)
+                    self.rate_limiter.on_success()
+                    self.stats['completed'] += 1
+                    return result
+                except self.fatal_exceptions:
+                    raise
+                except Exception as e:
+                    if not is_retryable(e) or attempt >= self.max_retries:
+                        logging.error(f"Giving up on input after {attempt + 1} attempt(s): {e}")
+                        self.stats['failed'] += 1
+                        return None
+                    if get_status_code(e) == 429:
+                        self.rate_limiter.on_rate_limited()
+                    delay = get_retry_after(e)
+                    if delay is None:
+                        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+                        delay *= random.uniform(0.5, 1.0)
+                    attempt += 1
+                    self.stats['retries'] += 1
+                    logging.warning(f"Retryable error ({get_status_code(e)}), retry {attempt} in {delay:.1f}s: {e}")
+                    await asyncio.sleep(delay)
+                    queued = time.perf_counter()
+
+    async def arun(self, fn, items):
+        """
+        Apply `fn` to every item concurrently and return the results in input order.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = await asyncio.gather(*(self._call(fn, item, executor, semaphore) for item in items))
+        self.stats['elapsed'] += time.perf_counter() - start
+        return list(results)
+
+    def run(self, fn, items):
+        """
+        Blocking wrapper around `arun` for use from synchronous scripts.
+        """
+        return asyncio.run(self.arun(fn, items))
+
+    def report(self, unit='prompts'):
+        """
+        Log and print the throughput of the runs so far, counting items as `unit`.
+        """
+        message = (f"Processed {self.stats['completed'] + self.stats['failed']} {unit} "
+                   f"({self.stats['failed']} failed, {self.stats['retries']} retries) in "
+                   f"{self.stats['elapsed']:.1f}s: {self.throughput:.2f} {unit}/sec")
+        logging.info(message)
+        print(message)
+        return message
@@ -0,0 +1,139 @@
+import argparse
+import functools
+import json
+import logging
+import os
+
+import numpy as np
+
+DEFAULT_INDEX_PATH = os.getenv('LOCAL_INDEX_PATH', './data/vector_index/sample_text_file')
+
+
+def normalize_rows(matrix):
+    """
+    L2-normalize rows so cosine similarity becomes a dot product.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def save_snapshot(path, texts, vectors, model_name=None):
+    """
+    Write a corpus snapshot: `<path>.npy` (normalized float32 matrix),
+    `<path>.jsonl` (texts, one per line) and `<path>.meta.json`.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    vectors = normalize_rows(vectors)
+    np.save(f"{path}.npy", vectors)
+    with open(f"{path}.jsonl", 'w', encoding='utf-8') as file:
+        for text in texts:
+            file.write(json.dumps(text, ensure_ascii=False) + '\n')
+    with open(f"{path}.meta.json", 'w') as file:
+        json.dump({'model': model_name, 'count': len(texts), 'dimensions': int(vectors.shape[1])}, file)
+    logging.info(f"Saved snapshot of {len(texts)} vectors to '{path}'.")
+
+
+def snapshot_from_file(sample_prompt_file, embeddings, path=DEFAULT_INDEX_PATH, batch_size=256):
+    """
+    Embed a prompt file (one prompt per line, de-duplicated) and save it as a snapshot.
+    """
+    with open(sample_prompt_file, 'r') as file:
+        texts = list(dict.fromkeys(line.strip() for line in file if line.strip()))
+    vectors = []
+    for i in range(0, len(texts), batch_size):
+        vectors.extend(embeddings.embed_documents(texts[i:i + batch_size]))
+    save_snapshot(path, texts, vectors, model_name=getattr(embeddings, 'model', None))
+
+
+def snapshot_from_pgvector(engine, collection_name='sample_text_file', path=DEFAULT_INDEX_PATH):
+    """
+    Export the texts and stored embeddings of a PGVector collection as a snapshot, without re-embedding.
+    """
+    import sqlalchemy
+
+    query = sqlalchemy.text(
+        'SELECT e.document, e.embedding::text FROM langchain_pg_embedding e '
+        'JOIN langchain_pg_collection c ON e.collection_id = c.uuid WHERE c.name = :name'
+    )
+    texts, vectors = [], []
+    with engine.connect() as connection:
+        for document, embedding in connection.execute(query, {'name': collection_name}):
+            texts.append(document)
+            vectors.append(np.array(json.loads(embedding), dtype=np.float32))
+    save_snapshot(path, texts, vectors)
+
+
+class LocalVectorIndex:
+    """
+    In-process retrieval over a snapshot of the corpus embeddings.
+
+    The matrix is memory-mapped, so loading is instant and pages are shared
+    between processes. Search is exact top-k by vectorized cosine similarity,
+    or approximate through an HNSW index when `use_hnsw` is set and hnswlib is
+    installed. Query embeddings are kept in an LRU cache keyed by query text,
+    since the constraint sections of overlapping combos repeat.
+
+    Args:
+        path (str): Snapshot path prefix written by `save_snapshot`.
+        embeddings (Embeddings): Model used to embed queries; must match the snapshot.
+        use_hnsw (bool): Use an HNSW index instead of exact search.
+        query_cache_size (int): Number of query embeddings kept in the LRU cache.
+    """
+
+    def __init__(self, path, embeddings, use_hnsw=False, query_cache_size=1024):
+        self.vectors = np.load(f"{path}.npy", mmap_mode='r')
+        with open(f"{path}.jsonl", 'r', encoding='utf-8') as file:
+            self.texts = [json.loads(line) for line in file]
+        self.embeddings = embeddings
+        self.embed_query = functools.lru_cache(maxsize=query_cache_size)(self._embed_query)
+        self.hnsw = self._build_hnsw() if use_hnsw else None
+
+    def _embed_query(self, query):
+        return normalize_rows(self.embeddings.embed_query(query))
+
+    def _build_hnsw(self, ef_construction=200, m=16):
+        try:
+            import hnswlib
+        except ImportError:
+            logging.warning("hnswlib is not installed, falling back to exact search.")
+            return None
+        index = hnswlib.Index(space='ip', dim=self.vectors.shape[1])
+        index.init_index(max_elements=len(self.texts), ef_construction=ef_construction, M=m)
+        index.add_items(np.asarray(self.vectors), np.arange(len(self.texts)))
+        index.set_ef(max(64, ef_construction // 2))
+        return index
+
+    def search(self, query, top_n=3):
+        """
+        Return the `top_n` most similar texts to the query, best first.
+        """
+        top_n = min(top_n, len(self.texts))
+        if top_n <= 0:
+            return []
+        query_vector = self.embed_query(query)
+        if self.hnsw is not None:
+            labels, _ = self.hnsw.knn_query(query_vector, k=top_n)
+            return [self.texts[i] for i in labels[0]]
+        scores = self.vectors @ query_vector
+        best = np.argpartition(-scores, top_n - 1)[:top_n]
+        best = best[np.argsort(-scores[best])]
+        return [self.texts[i] for i in best]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build a local snapshot of the prompt embeddings for search_text.')
+    parser.add_argument('--path', default=DEFAULT_INDEX_PATH, help='Snapshot path prefix')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('-f', '--filepath', default='./data/expectation_and_prompt_sample/sample_quality_check_prompts.txt',
+                        help='Prompt file to embed into the snapshot')
+    source.add_argument('--from-pgvector', action='store_true',
+                        help='Export the stored embeddings of the PGVector collection instead of re-embedding')
+    args = parser.parse_args()
+
+    import embed_sample_prompt
+    if args.from_pgvector:
+        snapshot_from_pgvector(embed_sample_prompt.get_engine(), path=args.path)
+    else:
+        snapshot_from_file(args.filepath, embed_sample_prompt.get_embeddings(), path=args.path)
+    print(f"Snapshot written to {args.path}.npy")
@@ -0,0 +1,227 @@
+import argparse
+import json
+import logging
+import os
+import statistics
+import time
+
+import sqlalchemy
+from sqlalchemy import text
+
+EMBEDDING_TABLE = 'langchain_pg_embedding'
+COLLECTION_TABLE = 'langchain_pg_collection'
+INDEX_NAME = 'langchain_pg_embedding_ann_idx'
+# pgvector cannot build HNSW/IVFFlat indexes on `vector` columns wider than this
+MAX_INDEXED_DIMENSIONS = 2000
+
+# Connection pool settings of the engine shared by the vector store
+POOL_SETTINGS = {
+    'pool_size': int(os.getenv('PG_POOL_SIZE', 10)),
+    'max_overflow': int(os.getenv('PG_MAX_OVERFLOW', 10)),
+    'pool_timeout': float(os.getenv('PG_POOL_TIMEOUT', 30)),
+    'pool_recycle': int(os.getenv('PG_POOL_RECYCLE', 1800)),
+    'pool_pre_ping': True,
+}
+
+
+def build_engine(db_connection_args, **pool_overrides):
+    """
+    Create a pooled SQLAlchemy engine for the vector database.
+
+    Args:
+        db_connection_args (dict): user, password, host, port and database.
+        **pool_overrides: Overrides of POOL_SETTINGS (pool_size, max_overflow, ...).
+
+    Returns:
+        sqlalchemy.engine.Engine: Engine using psycopg 3 with a QueuePool.
+    """
+    url = sqlalchemy.engine.URL.create(
+        drivername='postgresql+psycopg',
+        username=db_connection_args['user'],
+        password=db_connection_args['password'],
+        host=db_connection_args['host'],
+        port=db_connection_args['port'],
+        database=db_connection_args['database'],
+    )
+    return sqlalchemy.create_engine(url, **{**POOL_SETTINGS, **pool_overrides})
+
+
+def vector_literal(vector):
+    return '[' + ','.join(repr(float(value)) for value in vector) + ']'
+
+
+def get_dimensions(connection):
+    """
+    Return (declared, stored) dimensions of the embedding column; declared is None for an untyped `vector`.
+    """
+    declared = connection.execute(text(
+        "SELECT NULLIF(atttypmod, -1) FROM pg_attribute "
+        "WHERE attrelid = CAST(:table AS regclass) AND attname = 'embedding'"
+    ), {'table': EMBEDDING_TABLE}).scalar()
+    stored = connection.execute(text(f"SELECT vector_dims(embedding) FROM {EMBEDDING_TABLE} LIMIT 1")).scalar()
+    return declared, stored
+
+
+def create_index(engine, method='hnsw', m=16, ef_construction=64, lists=100, rebuild=False):
+    """
+    Create (or rebuild) the ANN index on the embedding column for cosine distance,
+    the distance PGVector uses by default.
+
+    The column is first given a fixed dimension if it was created untyped, since
+    pgvector can only index typed columns.
+
+    Args:
+        engine (Engine): Engine of the vector database.
+        method (str): 'hnsw' or 'ivfflat'.
+        m (int): HNSW graph degree.
+        ef_construction (int): HNSW build-time candidate list size.
+        lists (int): IVFFlat number of lists (~rows / 1000 up to 1M rows).
+        rebuild (bool): Drop and recreate an existing index.
+    """
+    with engine.begin() as connection:
+        declared, stored = get_dimensions(connection)
+        dimensions = declared or stored
+        if dimensions is None:
+            raise ValueError("The embedding table is empty; ingest prompts before indexing.")
+        if dimensions > MAX_INDEXED_DIMENSIONS:
+            raise ValueError(
+                f"Embeddings have {dimensions} dimensions but pgvector indexes at most {MAX_INDEXED_DIMENSIONS}. "
+                f"Re-embed with EMBEDDING_DIMENSIONS<={MAX_INDEXED_DIMENSIONS} (text-embedding-3 models support it)."
+            )
+        if declared is None:
+            logging.info(f"Setting embedding column type to vector({dimensions}).")
+            connection.execute(text(f"ALTER TABLE {EMBEDDING_TABLE} ALTER COLUMN embedding TYPE vector({dimensions})"))
+
+        if rebuild:
+            connection.execute(text(f"DROP INDEX IF EXISTS {INDEX_NAME}"))
+        if method == 'hnsw':
+            options = f"m = {int(m)}, ef_construction = {int(ef_construction)}"
+        elif method == 'ivfflat':
+            options = f"lists = {int(lists)}"
+        else:
+            raise ValueError(f"Unknown index method '{method}'")
+
+        start = time.perf_counter()
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {INDEX_NAME} ON {EMBEDDING_TABLE} "
+            f"USING {method} (embedding vector_cosine_ops) WITH ({options})"
+        ))
+        connection.execute(text(f"ANALYZE {EMBEDDING_TABLE}"))
+    print(f"{method} index '{INDEX_NAME}' ready ({options}) in {time.perf_counter() - start:.1f}s")
+
+
+def drop_index(engine):
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP INDEX IF EXISTS {INDEX_NAME}"))
+    print(f"Dropped index '{INDEX_NAME}'.")
+
+
+def search_by_vector(engine, query_vector, k=3, collection_name='sample_text_file',
+                     ef_search=None, probes=None, exact=False):
+    """
+    Nearest documents by cosine distance with per-query search parameters.
+
+    Args:
+        engine (Engine): Engine of the vector database.
+        query_vector (list): Query embedding.
+        k (int): Number of documents to return.
+        collection_name (str): PGVector collection to search.
+        ef_search (int): HNSW candidate list size for this query (recall/latency trade-off).
+        probes (int): IVFFlat lists probed for this query.
+        exact (bool): Disable index scans to get the exact (sequential scan) answer.
+
+    Returns:
+        list: Document texts, nearest first.
+    """
+    with engine.begin() as connection:
+        # SET LOCAL scopes the parameters to this transaction, i.e. to this query
+        if ef_search:
+            connection.execute(text(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+        if probes:
+            connection.execute(text(f"SET LOCAL ivfflat.probes = {int(probes)}"))
+        if exact:
+            connection.execute(text("SET LOCAL enable_indexscan = off"))
+        rows = connection.execute(text(
+            f"SELECT e.document FROM {EMBEDDING_TABLE} e "
+            f"JOIN {COLLECTION_TABLE} c ON e.collection_id = c.uuid "
+            f"WHERE c.name = :collection "
+            f"ORDER BY e.embedding <=> CAST(:query AS vector) LIMIT :k"
+        ), {'collection': collection_name, 'query': vector_literal(query_vector), 'k': k})
+        return [row[0] for row in rows]
+
+
+def recall_report(engine, collection_name='sample_text_file', queries=50, k=10,
+                  ef_search_values=(10, 20, 40, 80, 160), probes_values=(1, 5, 10, 20)):
+    """
+    Recall@k and latency of the index at several search settings, against exact search.
+
+    Query vectors are sampled from the stored embeddings, so no embedding calls are made.
+
+    Returns:
+        list: One dict per setting with recall, mean and p95 latency in ms.
+    """
+    with engine.connect() as connection:
+        method = connection.execute(text(
+            "SELECT am.amname FROM pg_class c JOIN pg_am am ON c.relam = am.oid WHERE c.relname = :name"
+        ), {'name': INDEX_NAME}).scalar()
+        samples = [json.loads(row[0]) for row in connection.execute(text(
+            f"SELECT embedding::text FROM {EMBEDDING_TABLE} ORDER BY random() LIMIT :n"), {'n': queries})]
+    if method is None:
+        raise ValueError(f"Index '{INDEX_NAME}' does not exist; run create-index first.")
+
+    def timed(**params):
+        latencies, answers = [], []
+        for vector in samples:
+            start = time.perf_counter()
+            answers.append(search_by_vector(engine, vector, k=k, collection_name=collection_name, **params))
+            latencies.append((time.perf_counter() - start) * 1e3)
+        latencies.sort()
+        return answers, statistics.fmean(latencies), latencies[max(0, int(len(latencies) * 0.95) - 1)]
+
+    truth, exact_mean, exact_p95 = timed(exact=True)
+    report = [{'setting': 'exact', 'recall': 1.0, 'mean_ms': exact_mean, 'p95_ms': exact_p95}]
+    settings = [{'ef_search': v} for v in ef_search_values] if method == 'hnsw' else [{'probes': v} for v in probes_values]
+    for params in settings:
+        answers, mean_ms, p95_ms = timed(**params)
+        recall = statistics.fmean(len(set(a) & set(t)) / max(1, len(t)) for a, t in zip(answers, truth))
+        name = ', '.join(f"{key}={value}" for key, value in params.items())
+        report.append({'setting': name, 'recall': recall, 'mean_ms': mean_ms, 'p95_ms': p95_ms})
+
+    print(f"{method} index, {len(samples)} queries, recall@{k}")
+    print(f"{'setting':<16}{'recall':>8}{'mean ms':>10}{'p95 ms':>10}")
+    for row in report:
+        print(f"{row['setting']:<16}{row['recall']:>8.3f}{row['mean_ms']:>10.2f}{row['p95_ms']:>10.2f}")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the ANN index of the PGVector embedding table.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    create = subparsers.add_parser('create-index', help='Create the HNSW/IVFFlat index (no-op if it exists)')
+    rebuild = subparsers.add_parser('rebuild-index', help='Drop and recreate the index with new parameters')
+    for sub in (create, rebuild):
+        sub.add_argument('--method', choices=['hnsw', 'ivfflat'], default='hnsw')
+        sub.add_argument('--m', type=int, default=16, help='HNSW: max connections per node')
+        sub.add_argument('--ef-construction', type=int, default=64, help='HNSW: build candidate list size')
+        sub.add_argument('--lists', type=int, default=100, help='IVFFlat: number of lists')
+    subparsers.add_parser('drop-index', help='Drop the index')
+    report = subparsers.add_parser('report', help='Recall vs latency against exact search')
+    report.add_argument('--queries', type=int, default=50)
+    report.add_argument('-k', type=int, default=10)
+    report.add_argument('--ef-search', default='10,20,40,80,160', help='HNSW ef_search values to test')
+    report.add_argument('--probes', default='1,5,10,20', help='IVFFlat probes values to test')
+    args = parser.parse_args()
+
+    from embed_sample_prompt import db_connection_args
+    engine = build_engine(db_connection_args, pool_size=2)
+
+    if args.command in ('create-index', 'rebuild-index'):
+        create_index(engine, method=args.method, m=args.m, ef_construction=args.ef_construction,
+                     lists=args.lists, rebuild=args.command == 'rebuild-index')
+    elif args.command == 'drop-index':
+        drop_index(engine)
+    else:
+        recall_report(engine, queries=args.queries, k=args.k,
+                      ef_search_values=[int(v) for v in args.ef_search.split(',')],
+                      probes_values=[int(v) for v in args.probes.split(',')])
@@ -0,0 +1,171 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+from itertools import islice
+
+import tracing
+
+
+def hash_input(*parts):
+    """
+    Stable content hash identifying one unit of work (e.g. a user prompt).
+    """
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def iter_chunks(iterable, size):
+    """
+    Yield lists of at most `size` items without materializing the whole input.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class JsonlSink:
+    """
+    Crash-safe, append-only JSONL sink for generation results.
+
+    Every record carries the `input_hash` of the work it answers. Each chunk is
+    appended and fsynced before its hashes are added to the `<path>.manifest`
+    file, so after a crash or Ctrl-C the manifest only lists work whose results
+    are on disk and a resumed run processes just the missing remainder.
+
+    Args:
+        path (str): JSONL file receiving the records.
+        resume (bool): Continue an existing run instead of starting a new one.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.manifest_path = f"{path}.manifest"
+        self.completed = set()
+
+        if os.path.exists(path) and not resume:
+            raise FileExistsError(f"'{path}' already exists; pass --resume to continue that run")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        if resume:
+            self._drop_partial_line(path)
+            self._drop_partial_line(self.manifest_path)
+            if os.path.exists(self.manifest_path):
+                with open(self.manifest_path, 'r') as file:
+                    self.completed = {line.strip() for line in file if line.strip()}
+            logging.info(f"Resuming '{path}' with {len(self.completed)} completed inputs.")
+
+        self.file = open(path, 'a', encoding='utf-8')
+        self.manifest = open(self.manifest_path, 'a')
+
+    @staticmethod
+    def _drop_partial_line(path):
+        """
+        Truncate a torn last line left behind by a crash mid-write.
+        """
+        if not os.path.exists(path) or os.path.getsize(path) == 0:
+            return
+        with open(path, 'rb+') as file:
+            file.seek(0, os.SEEK_END)
+            end = file.tell()
+            position = end
+            while position > 0:
+                step = min(4096, position)
+                file.seek(position - step)
+                block = file.read(step)
+                newline = block.rfind(b'\n')
+                if newline != -1:
+                    position = position - step + newline + 1
+                    break
+                position -= step
+            if position != end:
+                file.truncate(position)
+
+    def is_done(self, input_hash):
+        return input_hash in self.completed
+
+    def write_chunk(self, records):
+        """
+        Append a chunk of records and mark their inputs as completed, fsyncing both files.
+
+        Args:
+            records (list): Dicts, each with an 'input_hash' key.
+        """
+        if not records:
+            return
+        with tracing.span('file_write', 'jsonl_sink', records=len(records)) as span:
+            data = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            span.set(bytes=len(data))
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+            self.manifest.write(''.join(record['input_hash'] + '\n' for record in records))
+            self.manifest.flush()
+            os.fsync(self.manifest.fileno())
+        self.completed.update(record['input_hash'] for record in records)
+
+    def close(self):
+        self.file.close()
+        self.manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def iter_records(self):
+        """
+        Stream the records on disk, skipping duplicates re-written after an interrupted chunk.
+        """
+        seen = set()
+        with open(self.path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record['input_hash'] in seen:
+                    continue
+                seen.add(record['input_hash'])
+                yield record
+
+    def materialize_csv(self, output_file, columns):
+        """
+        Write the sink's records to a CSV file without loading them into memory.
+
+        Returns:
+            int: Number of rows written.
+        """
+        rows = 0
+        with tracing.span('file_write', 'materialize_csv') as span, \
+                open(output_file, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=columns, extrasaction='ignore')
+            writer.writeheader()
+            for record in self.iter_records():
+                writer.writerow(record)
+                rows += 1
+            span.set(records=rows)
+        logging.info(f"Materialized {rows} rows from '{self.path}' to '{output_file}'.")
+        return rows
+
+    def materialize_jsonl(self, output_file, columns):
+        """
+        Write the sink's records (restricted to `columns`) to a clean JSONL file.
+
+        Returns:
+            int: Number of rows written.
+        """
+        rows = 0
+        with tracing.span('file_write', 'materialize_jsonl') as span, open(output_file, 'w', encoding='utf-8') as file:
+            for record in self.iter_records():
+                file.write(json.dumps({column: record.get(column) for column in columns}, ensure_ascii=False) + '\n')
+                rows += 1
+            span.set(records=rows)
+        logging.info(f"Materialized {rows} rows from '{self.path}' to '{output_file}'.")
+        return rows
@@ -0,0 +1,449 @@
+import argparse
+import atexit
+import contextvars
+import functools
+import json
+import math
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# JSONL file receiving the spans; tracing is off (every span is a shared no-op) while this is empty
+DEFAULT_TRACE_FILE = os.getenv('TRACE_FILE', '')
+# Spans buffered before they are appended to the trace file, and the longest they stay buffered
+FLUSH_SPANS = 256
+FLUSH_SECONDS = 2.0
+
+# USD per 1M (input, output) tokens; dated snapshots (gpt-4o-mini-2024-07-18) use the longest matching prefix
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+    'gpt-4.1-mini': (0.40, 1.60),
+    'gpt-4.1': (2.00, 8.00),
+    'text-embedding-3-large': (0.13, 0.0),
+    'text-embedding-3-small': (0.02, 0.0),
+}
+# Share of the input price charged for prompt tokens served from the provider's prompt cache
+CACHED_INPUT_DISCOUNT = 0.5
+
+# Queue wait and attempt of the engine call running in this context (see bind_call)
+_call_context = contextvars.ContextVar('trace_call_context', default=None)
+_stage = contextvars.ContextVar('trace_stage', default=None)
+
+
+@functools.lru_cache(maxsize=64)
+def model_prices(model):
+    matches = [name for name in MODEL_PRICES if (model or '').startswith(name)]
+    return MODEL_PRICES[max(matches, key=len)] if matches else None
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens=0, cached_tokens=0):
+    """
+    Estimated USD cost of one call from MODEL_PRICES, None for an unknown model.
+    """
+    prices = model_prices(model)
+    if prices is None:
+        return None
+    input_price, output_price = prices
+    billed_input = prompt_tokens - cached_tokens + cached_tokens * CACHED_INPUT_DISCOUNT
+    return (billed_input * input_price + completion_tokens * output_price) / 1e6
+
+
+class NullSpan:
+    """
+    Span used while tracing is off: entering, setting fields and exiting do nothing.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **fields):
+        pass
+
+    def record_usage(self, usage=None, **fields):
+        pass
+
+    def record_text(self, texts, model=None):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span:
+    """
+    One traced call: its stage, kind and name, wall time, the engine's queue wait and
+    attempt, and whatever the caller records (tokens, cost, cache hit, bytes, ...).
+    """
+
+    __slots__ = ('tracer', 'record', 'start')
+
+    def __init__(self, tracer, kind, name, fields):
+        self.tracer = tracer
+        self.record = {'kind': kind, 'name': name, **fields}
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        record = self.record
+        record['duration_ms'] = (time.perf_counter() - self.start) * 1000
+        record['ts'] = time.time()
+        record['stage'] = _stage.get() or self.tracer.stage
+        context = _call_context.get()
+        if context:
+            record.update(context)
+        if exc_type is not None:
+            record['status'] = 'error'
+            record['error'] = exc_type.__name__
+        self.tracer.emit(record)
+        return False
+
+    def set(self, **fields):
+        self.record.update(fields)
+
+    def record_usage(self, usage=None, model=None, **fields):
+        """
+        Records token usage and its estimated cost.
+
+        Args:
+            usage: LangChain `usage_metadata` dict, or an OpenAI `usage` object.
+            model (str): Model the call was billed to, defaults to the span's `model` field.
+            **fields: prompt_tokens / completion_tokens / cached_tokens when there is no usage object.
+        """
+        if isinstance(usage, dict):
+            fields.setdefault('prompt_tokens', usage.get('input_tokens', 0))
+            fields.setdefault('completion_tokens', usage.get('output_tokens', 0))
+            fields.setdefault('cached_tokens', (usage.get('input_token_details') or {}).get('cache_read') or 0)
+        elif usage is not None:
+            fields.setdefault('prompt_tokens', getattr(usage, 'prompt_tokens', 0) or 0)
+            fields.setdefault('completion_tokens', getattr(usage, 'completion_tokens', 0) or 0)
+            details = getattr(usage, 'prompt_tokens_details', None)
+            fields.setdefault('cached_tokens', getattr(details, 'cached_tokens', 0) or 0)
+        self.record.update(fields)
+        model = model or self.record.get('model')
+        self.record['cost_usd'] = estimate_cost(model, self.record.get('prompt_tokens', 0),
+                                                self.record.get('completion_tokens', 0),
+                                                self.record.get('cached_tokens', 0))
+
+    def record_text(self, texts, model=None):
+        """
+        Records estimated input tokens of texts the API reports no usage for (embeddings),
+        at the ~4 characters per token of llm_engine.estimate_tokens.
+        """
+        tokens = sum(max(1, len(text) // 4) for text in texts)
+        self.record_usage(model=model, prompt_tokens=tokens, tokens_estimated=True)
+
+
+class Tracer:
+    """
+    Appends spans to a JSONL trace file.
+
+    Spans are buffered and written in one `os.write` on an O_APPEND descriptor,
+    every FLUSH_SPANS spans, FLUSH_SECONDS, and at exit, so threads and worker
+    processes tracing to the same file never interleave partial lines.
+    The exit and fork hooks are registered once per process and act on the current
+    tracer (see `_register_hooks`), so replaced tracers are not kept alive by them.
+
+    Args:
+        path (str): Trace file.
+        stage (str): Stage of spans emitted outside `set_stage`, the script name by default.
+    """
+
+    def __init__(self, path, stage=None):
+        self.path = path
+        self.stage = stage or os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0] or 'python'
+        self.run_id = os.getenv('TRACE_RUN_ID') or os.urandom(6).hex()
+        self.pid = os.getpid()
+        self.buffer = []
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def _after_fork(self):
+        # A forked worker must not write the parent's buffered spans a second time
+        self.buffer = []
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+
+    def span(self, kind, name, fields):
+        return Span(self, kind, name, fields)
+
+    def emit(self, record):
+        record['run'] = self.run_id
+        record['pid'] = self.pid
+        with self.lock:
+            self.buffer.append(record)
+            if len(self.buffer) >= FLUSH_SPANS or time.monotonic() - self.flushed_at >= FLUSH_SECONDS:
+                self._flush()
+
+    def _flush(self):
+        if self.buffer and self.fd is not None:
+            os.write(self.fd, ''.join(json.dumps(record, default=str) + '\n' for record in self.buffer).encode('utf-8'))
+        self.buffer = []
+        self.flushed_at = time.monotonic()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+
+
+_tracer = None
+_tracer_configured = False
+_hooks_registered = False
+
+
+def _close_tracer():
+    if _tracer is not None:
+        _tracer.close()
+
+
+def _reset_tracer_after_fork():
+    if _tracer is not None:
+        _tracer._after_fork()
+
+
+def _register_finalizer():
+    from multiprocessing import util
+
+    util.Finalize(None, _close_tracer, exitpriority=0)
+
+
+def _register_hooks():
+    """
+    Flush the current tracer at exit and reset it in forked children, registered once per process.
+
+    `multiprocessing` workers leave through `os._exit`, which skips atexit, so the tracer is also
+    closed by a multiprocessing finalizer. Forked workers start with an empty finalizer registry,
+    so it is registered again after each fork.
+    """
+    global _hooks_registered
+    if _hooks_registered:
+        return
+    _hooks_registered = True
+    from multiprocessing import util
+
+    atexit.register(_close_tracer)
+    if hasattr(os, 'register_at_fork'):
+        os.register_at_fork(after_in_child=_reset_tracer_after_fork)
+    _register_finalizer()
+    util.register_after_fork(_register_finalizer, lambda register: register())
+
+
+def get_tracer():
+    """
+    Return the process wide tracer, configured from TRACE_FILE on first use; None while tracing is off.
+    """
+    global _tracer, _tracer_configured
+    if not _tracer_configured:
+        _tracer_configured = True
+        if DEFAULT_TRACE_FILE:
+            _register_hooks()
+            _tracer = Tracer(DEFAULT_TRACE_FILE)
+    return _tracer
+
+
+def configure_tracing(path=DEFAULT_TRACE_FILE, stage=None):
+    """
+    Replace the process wide tracer, e.g. from a script's flag; an empty path switches tracing off.
+    """
+    global _tracer, _tracer_configured
+    if _tracer is not None:
+        _tracer.close()
+    if path:
+        _register_hooks()
+    _tracer = Tracer(path, stage) if path else None
+    _tracer_configured = True
+    return _tracer
+
+
+def span(kind, name, **fields):
+    """
+    Context manager tracing one call, e.g.
+
+        with tracing.span('llm', 'chat', model=model) as span:
+            message = llm.invoke(messages)
+            span.record_usage(message.usage_metadata)
+
+    `kind` is 'llm', 'embedding', 'search' or 'file_write'. While tracing is off this returns a
+    shared no-op span, so instrumented code pays one function call and one global lookup.
+    """
+    tracer = _tracer if _tracer_configured else get_tracer()
+    if tracer is None:
+        return NULL_SPAN
+    return tracer.span(kind, name, fields)
+
+
+def flush():
+    """
+    Write the buffered spans of this process now, e.g. before a worker returns.
+    """
+    tracer = _tracer if _tracer_configured else get_tracer()
+    if tracer is not None:
+        tracer.flush()
+
+
+def enabled():
+    return (_tracer if _tracer_configured else get_tracer()) is not None
+
+
+def set_stage(stage):
+    """
+    Stage of the spans emitted from the current context (and the engine calls it starts).
+    """
+    _stage.set(stage)
+
+
+def bind_call(fn, **fields):
+    """
+    `fn` running with `fields` (queue_wait_ms, attempt) added to every span it emits.
+
+    llm_engine.GenerationEngine binds each call before handing it to its thread pool,
+    so the LLM spans deep inside `fn` carry the wait and retry count of their engine call.
+    """
+    if not enabled():
+        return fn
+    context = contextvars.copy_context()
+    context.run(_call_context.set, fields)
+    return functools.partial(context.run, fn)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of sorted values.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+def read_spans(paths, run=None):
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # torn line from a killed process
+                if run is None or record.get('run') == run:
+                    yield record
+
+
+def summarize(spans, by=('stage', 'kind')):
+    """
+    Latency, throughput, retries, tokens and cost of the spans, grouped by `by` fields.
+
+    Throughput is calls per second over the wall time between the first span's start
+    and the last span's end of the group, so concurrent calls are counted as such.
+
+    Returns:
+        list: One dict per group, most expensive (then slowest) first.
+    """
+    import statistics
+
+    groups = defaultdict(list)
+    for record in spans:
+        groups[tuple(record.get(field) for field in by)].append(record)
+
+    rows = []
+    for key, records in groups.items():
+        durations = sorted(record['duration_ms'] for record in records)
+        starts = [record['ts'] - record['duration_ms'] / 1000 for record in records]
+        wall = max(record['ts'] for record in records) - min(starts)
+        costs = [record['cost_usd'] for record in records if record.get('cost_usd') is not None]
+        queue_waits = [record['queue_wait_ms'] for record in records if 'queue_wait_ms' in record]
+        rows.append({
+            **dict(zip(by, key)),
+            'calls': len(records),
+            'errors': sum(record.get('status') == 'error' for record in records),
+            'retries': sum(record.get('attempt', 0) > 0 for record in records),
+            'cache_hits': sum(bool(record.get('cache_hit')) for record in records),
+            'p50_ms': percentile(durations, 0.50),
+            'p95_ms': percentile(durations, 0.95),
+            'mean_queue_wait_ms': statistics.fmean(queue_waits) if queue_waits else 0.0,
+            'total_s': sum(durations) / 1000,
+            'calls_per_sec': len(records) / wall if wall > 0 else 0.0,
+            'prompt_tokens': sum(record.get('prompt_tokens', 0) for record in records),
+            'completion_tokens': sum(record.get('completion_tokens', 0) for record in records),
+            'cost_usd': sum(costs),
+        })
+    return sorted(rows, key=lambda row: (row['cost_usd'], row['total_s']), reverse=True)
+
+
+def print_summary(rows, by):
+    labels = [' / '.join(str(row[field]) for field in by) for row in rows]
+    width = max([len(' / '.join(by))] + [len(label) for label in labels])
+    header = (f"{' / '.join(by):<{width}} {'calls':>7} {'err':>5} {'retry':>5} {'hits':>6} {'p50 ms':>9} {'p95 ms':>9} "
+              f"{'wait ms':>8} {'calls/s':>8} {'tokens in':>10} {'tokens out':>10} {'cost $':>9}")
+    print(header)
+    print('-' * len(header))
+    for label, row in zip(labels, rows):
+        print(f"{label:<{width}} {row['calls']:>7} {row['errors']:>5} {row['retries']:>5} {row['cache_hits']:>6} "
+              f"{row['p50_ms']:>9.1f} {row['p95_ms']:>9.1f} {row['mean_queue_wait_ms']:>8.1f} "
+              f"{row['calls_per_sec']:>8.2f} {row['prompt_tokens']:>10} {row['completion_tokens']:>10} "
+              f"{row['cost_usd']:>9.4f}")
+    print(f"Total: {sum(row['calls'] for row in rows)} calls, ${sum(row['cost_usd'] for row in rows):.4f}")
+
+
+def measure_overhead(iterations=200000):
+    """
+    Per-span cost in microseconds with tracing off and on (to a temporary file).
+    """
+    import tempfile
+
+    def loop():
+        start = time.perf_counter()
+        for _ in range(iterations):
+            with span('llm', 'overhead', model='gpt-4o-mini') as current:
+                current.record_usage(prompt_tokens=100, completion_tokens=20)
+        return (time.perf_counter() - start) / iterations * 1e6
+
+    previous = _tracer if _tracer_configured else get_tracer()
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        configure_tracing('')
+        results['off'] = loop()
+        configure_tracing(os.path.join(directory, 'overhead.jsonl'))
+        results['on'] = loop()
+        configure_tracing('')
+    if previous is not None:
+        configure_tracing(previous.path, previous.stage)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize trace files written with TRACE_FILE=<path>.')
+    parser.add_argument('traces', nargs='*', default=[DEFAULT_TRACE_FILE] if DEFAULT_TRACE_FILE else [],
+                        help='JSONL trace files, TRACE_FILE by default')
+    parser.add_argument('--by', default='stage,kind', help='Comma separated span fields to group by, e.g. stage,kind,name')
+    parser.add_argument('--run', default=None, help='Only spans of this run id')
+    parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+    parser.add_argument('--overhead', action='store_true', help='Measure the per-span cost with tracing off and on')
+    args = parser.parse_args()
+
+    if args.overhead:
+        overhead = measure_overhead()
+        print(f"Per span: {overhead['off']:.2f} us with tracing off, {overhead['on']:.2f} us on")
+    elif not args.traces:
+        parser.error('no trace file given and TRACE_FILE is not set')
+    else:
+        by = tuple(field.strip() for field in args.by.split(','))
+        rows = summarize(read_spans(args.traces, args.run), by)
+        if args.json:
+            print(json.dumps(rows, indent=2))
+        else:
+            print_summary(rows, by)
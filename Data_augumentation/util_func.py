@@ -1,35 +1,78 @@
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, FewShotChatMessagePromptTemplate
-from langchain_chroma import Chroma
-from langchain_core.example_selectors import SemanticSimilarityExampleSelector
-from langchain_openai import OpenAIEmbeddings
-from langchain_core.prompts import PromptTemplate
 import os
-import pandas as pd
+import re
+import json
 import dotenv
 import logging
 import datetime
+import functools
+import threading
+import tracing
+from llm_cache import get_llm_cache, CacheMissError
 
 # Load environment variables
 dotenv.load_dotenv()
 
+# langchain, pandas and the OpenAI clients are imported / created on first use,
+# so importing this module (CLI --help, unit tests, worker start-up) stays cheap
+_chat_models = {}
+_chat_models_lock = threading.Lock()
+
+
+def get_chat_model(model="gpt-4o-mini", temperature=0.7, **kwargs):
+    """
+    Returns a shared ChatOpenAI client for the given settings, created on first use.
+    """
+    key = (model, temperature, tuple(sorted(kwargs.items())))
+    if key not in _chat_models:
+        with _chat_models_lock:
+            if key not in _chat_models:
+                from langchain_openai import ChatOpenAI
+                _chat_models[key] = ChatOpenAI(model=model, temperature=temperature, **kwargs)
+    return _chat_models[key]
+
+
 def set_up_logging(take_log=True):
     if logging:
        # Set up logging
         log_file = 'expectation_generation.log'
         logging.basicConfig(filename=log_file, level=logging.INFO, format='%(asctime)s : %(levelname)s - %(message)s')
         
-def get_accepted_expectations():
+# Catalogue of accepted expectations (.xlsx with an 'Expectation_list' sheet, or .csv)
+ACCEPTED_EXPECTATIONS_FILE = './data/expectation_and_prompt_sample/listExpectations.xlsx'
+
+EXPECTATION_EXAMPLES = [
+    {
+        'user_prompt': "For column 'processed_timestamp': Ensure the column is required (not null). Ensure the column matches the type 'timestamp', Ensure this column exists.",
+        'Expectations': '''expect_column_to_exist(column="processed_timestamp"),
+                                    expect_column_values_to_not_be_null(column="processed_timestamp"),
+                                    expect_column_values_to_be_of_type(column="processed_timestamp", type_="timestamp")'''
+    },
+    {
+        'user_prompt': "For column 'postal_code': Ensure the column matches the type 'text' and the format 'ZIP'. Ensure this column exists.",
+        'Expectations': '''expect_table_columns_to_match_set(column_set=["postal_code"], exact_match=False),
+                                    expect_column_values_to_be_of_type(column="postal_code", type_="text"),
+                                    expect_column_values_to_match_regex(column="postal_code", regex=r"^\d{5}(-\d{4})?$")'''
+    }
+]
+
+
+def get_accepted_expectations(file_path=ACCEPTED_EXPECTATIONS_FILE):
     """
-    Reads the list of accepted expectations from an Excel file and returns a dictionary.
+    Reads the list of accepted expectations from an Excel (or CSV) file and returns a dictionary.
     """
+    import pandas as pd
+
     try:
-        expectation_list = pd.read_excel('./data/expectation_and_prompt_sample/listExpectations.xlsx', 
-                                         sheet_name='Expectation_list',
-                                         usecols=['Category', 'Expectations'])
+        if file_path.endswith('.csv'):
+            expectation_list = pd.read_csv(file_path, usecols=['Category', 'Expectations'])
+        else:
+            expectation_list = pd.read_excel(file_path,
+                                             sheet_name='Expectation_list',
+                                             usecols=['Category', 'Expectations'])
         expectation_list['Category'] = expectation_list['Category'].ffill()  # Forward fill NaN values in 'Category'
         expectation_category_dict = (
-            expectation_list.groupby('Category')['Expectations']
+            expectation_list.dropna(subset=['Expectations'])
+            .groupby('Category')['Expectations']
             .apply(list)
             .to_dict()
         )
@@ -40,89 +83,289 @@ def get_accepted_expectations():
         raise
 
 
-def get_expectation_from_openai(input_text,model=ChatOpenAI(model="gpt-4o-mini", temperature=0.7)):
+def render_expectation_prefix(accepted_expectations):
     """
-    Sends a user input prompt to OpenAI's GPT model to generate expectations and references accepted expectations.
+    Renders the static part of the expectation prompt: system instruction and few-shot examples.
     Args:
-        input_text (str): The user prompt describing data quality requirements.
+        accepted_expectations (dict): Category -> list of accepted expectations.
     Returns:
-        str: The cleaned response with only the generated expectations.
+        list: LangChain messages preceding the user prompt.
     """
-    try:
-        # Fetch the accepted expectations dictionary
-        accepted_expectations = get_accepted_expectations()
+    from langchain_core.messages import SystemMessage
+    from langchain_core.prompts import ChatPromptTemplate, FewShotChatMessagePromptTemplate
 
-        # Convert the accepted expectations dictionary to a string representation
-        expectations_reference = "\n".join(
-            [f"{category}: {', '.join(expectations)}" for category, expectations in accepted_expectations.items()]
-        )
+    # Convert the accepted expectations dictionary to a string representation
+    expectations_reference = "\n".join(
+        [f"{category}: {', '.join(expectations)}" for category, expectations in accepted_expectations.items()]
+    )
 
-        examples = [
-            {
-                'user_prompt': "For column 'processed_timestamp': Ensure the column is required (not null). Ensure the column matches the type 'timestamp', Ensure this column exists.",
-                'Expectations': '''expect_column_to_exist(column="processed_timestamp"),
-                                    expect_column_values_to_not_be_null(column="processed_timestamp"),
-                                    expect_column_values_to_be_of_type(column="processed_timestamp", type_="timestamp")'''
-            },
-            {
-                'user_prompt': "For column 'postal_code': Ensure the column matches the type 'text' and the format 'ZIP'. Ensure this column exists.",
-                'Expectations': '''expect_table_columns_to_match_set(column_set=["postal_code"], exact_match=False),
-                                    expect_column_values_to_be_of_type(column="postal_code", type_="text"),
-                                    expect_column_values_to_match_regex(column="postal_code", regex=r"^\d{5}(-\d{4})?$")'''
-            }
-        ]
-
-        example_formatter_template = '''user_prompt: {user_prompt} 
-                                        expectations: {Expectations}'''
-
-        # Create example prompt
-        example_prompt = PromptTemplate(
-            input_variables=['user_prompt', 'Expectations'],
-            template=example_formatter_template
-        )
-
-        few_shot_prompt = FewShotChatMessagePromptTemplate(
-            input_variables=['user_prompt'],
-            examples=examples,
-            example_prompt=ChatPromptTemplate.from_messages([
-                ("human", "{user_prompt}"), ("ai", "{Expectations}")
-            ])
-        )
+    few_shot_prompt = FewShotChatMessagePromptTemplate(
+        input_variables=[],
+        examples=EXPECTATION_EXAMPLES,
+        example_prompt=ChatPromptTemplate.from_messages([
+            ("human", "{user_prompt}"), ("ai", "{Expectations}")
+        ])
+    )
 
-        # Add the accepted expectations reference to the prompt
-        prompt_instruction = f'''Convert the following data quality prompts to great_expectations in the form 
+    # Add the accepted expectations reference to the prompt
+    prompt_instruction = f'''Convert the following data quality prompts to great_expectations in the form 
                                   expectation_type(columnName, params...).
                                   Use the accepted expectations reference below to get the available expectations. 
                                   Do not hallucinate or infer expectations from other sources.
                                   Accepted Expectations Reference:
                                   {expectations_reference}'''
 
-        final_prompt = ChatPromptTemplate.from_messages([
-            ('system', prompt_instruction),
-            few_shot_prompt,
-            ('human', '{user_prompt}')
-        ])
+    return [SystemMessage(content=prompt_instruction)] + few_shot_prompt.format_messages()
+
+
+# Final human message of a packed request; the prompts are numbered from 1
+PACKED_PROMPT_INSTRUCTION = '''Convert each of the {count} numbered data quality prompts below separately.
+Return only a JSON array with one object per prompt, in prompt order:
+[{{"index": <prompt number>, "expectations": "<expectations of that prompt, formatted as for a single prompt>"}}]
+{prompts}'''
+
+# A JSON array, possibly wrapped in a markdown code fence or surrounded by text
+JSON_ARRAY_PATTERN = re.compile(r'\[.*\]', re.DOTALL)
+
+
+def parse_packed_response(response, count):
+    """
+    Splits the JSON array answer of a packed request back into per-prompt expectations.
+
+    Args:
+        response (str): Raw model response.
+        count (int): Number of prompts in the request.
+    Returns:
+        list: `count` entries in prompt order, None for each prompt that is missing,
+        duplicated or malformed in the response.
+    """
+    results = [None] * count
+    match = JSON_ARRAY_PATTERN.search(response or '')
+    if not match:
+        return results
+    try:
+        items = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return results
+    if not isinstance(items, list):
+        return results
+
+    seen = set()
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        index, expectations = item.get('index'), item.get('expectations')
+        if isinstance(expectations, list) and all(isinstance(e, str) for e in expectations):
+            expectations = ',\n'.join(expectations)
+        if not isinstance(index, int) or not 1 <= index <= count or not isinstance(expectations, str):
+            continue
+        if index in seen:
+            # Two answers for one prompt: trust neither
+            results[index - 1] = None
+            continue
+        seen.add(index)
+        results[index - 1] = expectations.strip() or None
+    return results
+
+
+class ExpectationGenerator:
+    """
+    Compiled expectation prompt, built once and reused for every user prompt.
+
+    The catalogue is parsed only when its modification time changes. The system
+    instruction and few-shot examples are rendered once and always precede the user
+    prompt unchanged, so every request starts with the same bytes and provider-side
+    prompt prefix caching applies.
+    """
+
+    def __init__(self, catalogue_path=ACCEPTED_EXPECTATIONS_FILE):
+        self.catalogue_path = catalogue_path
+        self.catalogue_mtime = None
+        self.prefix_messages = None
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Reload the catalogue and re-render the prefix if the catalogue file changed.
+        """
+        mtime = os.stat(self.catalogue_path).st_mtime_ns
+        if mtime != self.catalogue_mtime:
+            with self.lock:
+                if mtime != self.catalogue_mtime:
+                    self.prefix_messages = render_expectation_prefix(get_accepted_expectations(self.catalogue_path))
+                    self.catalogue_mtime = mtime
+
+    def build_messages(self, input_text):
+        """
+        Returns the full message list for one user prompt.
+        """
+        from langchain_core.messages import HumanMessage
+
+        self.refresh()
+        return self.prefix_messages + [HumanMessage(content=input_text)]
+
+    def generate(self, input_text, model):
+        """
+        Generates expectations for one user prompt with the given chat model.
+        """
+        return invoke_messages(self.build_messages(input_text), model)
 
-        # Combine prompt with model
-        chain = final_prompt | model
+    def build_packed_messages(self, input_texts):
+        """
+        Returns the message list answering several user prompts in one request.
 
-        # Generate raw response
-        raw_response = chain.invoke({"user_prompt": input_text})
+        The prefix is the same as for single prompts, so the two modes share the
+        provider-side prompt cache; only the final human message differs.
+        """
+        from langchain_core.messages import HumanMessage
+
+        self.refresh()
+        numbered = "\n".join(f"[{index}] {text}" for index, text in enumerate(input_texts, start=1))
+        return self.prefix_messages + [
+            HumanMessage(content=PACKED_PROMPT_INSTRUCTION.format(count=len(input_texts), prompts=numbered))
+        ]
+
+    def generate_packed(self, input_texts, model):
+        """
+        Generates expectations for several user prompts in one request.
+
+        Returns:
+            list: Expectations per prompt, in input order; None where the response
+            had no valid entry for that prompt.
+        """
+        count = len(input_texts)
+        # Only cache responses answering every prompt; a malformed one is asked again next run
+        response = invoke_messages(self.build_packed_messages(input_texts), model,
+                                   validate=lambda response: None not in parse_packed_response(response, count))
+        return parse_packed_response(response, count)
+
+
+_expectation_generator = None
+
+
+def get_expectation_generator():
+    """
+    Returns the shared ExpectationGenerator, creating it on first use.
+    """
+    global _expectation_generator
+    if _expectation_generator is None:
+        _expectation_generator = ExpectationGenerator()
+    return _expectation_generator
+
+
+def configure_expectation_generator(catalogue_path=ACCEPTED_EXPECTATIONS_FILE):
+    """
+    Replace the shared ExpectationGenerator, e.g. to read another catalogue.
+    """
+    global _expectation_generator
+    _expectation_generator = ExpectationGenerator(catalogue_path)
+    return _expectation_generator
+
+
+def get_expectation_from_openai(input_text, model=None, raise_errors=False):
+    """
+    Sends a user input prompt to OpenAI's GPT model to generate expectations and references accepted expectations.
+    Args:
+        input_text (str): The user prompt describing data quality requirements.
+        model (BaseChatModel): Chat model to use, the shared gpt-4o-mini client by default.
+        raise_errors (bool): Re-raise API errors instead of returning None, so callers
+            such as llm_engine.GenerationEngine can retry them.
+    Returns:
+        str: The cleaned response with only the generated expectations.
+    """
+    try:
+        # Generate raw response (served from the response cache when possible)
+        raw_response = get_expectation_generator().generate(input_text, model or get_chat_model())
 
         logging.info(f"Successfully processed prompt: {input_text}")
-        return raw_response.content
+        return raw_response
+    except CacheMissError:
+        raise
     except Exception as e:
         logging.error(f"Error processing prompt '{input_text}': {e}")
+        if raise_errors:
+            raise
         return None        
         
-def generate_prompt_text(prompt_, llm=ChatOpenAI(model="gpt-4o-mini", temperature=0.7), **kwargs,):
+def get_expectations_packed(input_texts, model=None, raise_errors=False):
+    """
+    Generates expectations for several user prompts in a single request.
+    Args:
+        input_texts (list): User prompts packed into the request.
+        model (BaseChatModel): Chat model to use, the shared gpt-4o-mini client by default.
+        raise_errors (bool): Re-raise API errors instead of returning Nones.
+    Returns:
+        list: Expectations per prompt, in input order; None for the prompts the
+        response did not answer validly, to be retried with single-prompt calls.
+    """
+    try:
+        results = get_expectation_generator().generate_packed(input_texts, model or get_chat_model())
+        missing = results.count(None)
+        if missing:
+            logging.warning(f"Packed response left {missing} of {len(input_texts)} prompts unanswered.")
+        return results
+    except CacheMissError:
+        raise
+    except Exception as e:
+        logging.error(f"Error processing packed prompts {input_texts}: {e}")
+        if raise_errors:
+            raise
+        return [None] * len(input_texts)
+
+
+def generate_prompt_text(prompt_, llm=None, **kwargs,):
     """
     Generates a response from OpenAI via LangChain using the given prompt template.
     """
     
-    prompt = ChatPromptTemplate.from_template(prompt_)
-    chain = prompt | llm
-    result = chain.invoke(kwargs)
-    return result.content
+    return invoke_chat_model(compile_prompt_template(prompt_), llm or get_chat_model(), **kwargs)
+
+
+@functools.lru_cache(maxsize=32)
+def compile_prompt_template(prompt_):
+    """
+    Parses a prompt template string once; generate_prompt_text reuses the same PROMPT for every combo.
+    """
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_template(prompt_)
+
+
+def invoke_chat_model(prompt, llm, **kwargs):
+    """
+    Renders a chat prompt template and invokes the model through the shared LLM response cache.
+
+    Args:
+        prompt (ChatPromptTemplate): The prompt template to render.
+        llm (BaseChatModel): The chat model to call on a cache miss.
+        **kwargs: Template variables.
+    Returns:
+        str: The response content.
+    """
+    return invoke_messages(prompt.format_messages(**kwargs), llm)
+
+
+def invoke_messages(messages, llm, validate=None):
+    """
+    Invokes the model on already rendered messages through the shared LLM response cache.
+
+    `validate`, if given, decides whether a fresh response may be cached.
+    """
+    rendered = [{'role': message.type, 'content': message.content} for message in messages]
+    model = getattr(llm, 'model_name', type(llm).__name__)
+    with tracing.span('llm', 'chat', model=model, cache_hit=True) as span:
+        def call():
+            span.set(cache_hit=False)
+            message = llm.invoke(messages)
+            span.record_usage(getattr(message, 'usage_metadata', None))
+            return message.content
+
+        return get_llm_cache().get_or_call(
+            model=model,
+            temperature=getattr(llm, 'temperature', None),
+            messages=rendered,
+            call=call,
+            validate=validate
+        )
     
        
\ No newline at end of file
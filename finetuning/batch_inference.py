@@ -0,0 +1,313 @@
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import statistics
+import time
+from itertools import islice
+
+# Same post-processing as the evaluation notebooks: the answer follows 'assistant\n\n' and ends at '?>' if present
+ASSISTANT_PATTERN = re.compile(r"assistant\n\n(.*?)(\?>|$)", re.DOTALL)
+ANSWER_END_PATTERN = re.compile(r"(.*?)(\?>|$)", re.DOTALL)
+
+
+def read_jsonl(file_path):
+    """
+    Lazily yields the records of a JSONL file.
+    """
+    with open(file_path, 'r', encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def extract_expectations(text):
+    """
+    Cleans a generated answer to the expectation list stored as `great_expectations`.
+    """
+    match = ASSISTANT_PATTERN.search(text) or ANSWER_END_PATTERN.match(text)
+    return match.group(1).strip()
+
+
+def render_prompt(tokenizer, user_prompt):
+    """
+    Renders one user prompt with the chat template, as the notebooks did before tokenizing.
+    Tokenizers without a chat template (e.g. tiny test models) get the raw prompt.
+    """
+    if getattr(tokenizer, 'chat_template', None):
+        return tokenizer.apply_chat_template([{"role": "user", "content": user_prompt}],
+                                             tokenize=False, add_generation_prompt=True)
+    return user_prompt
+
+
+def stop_token_ids(tokenizer):
+    """
+    EOS ids a sequence may stop at: the tokenizer's EOS plus Llama 3's end-of-turn token.
+    """
+    ids = [tokenizer.eos_token_id]
+    eot_id = tokenizer.convert_tokens_to_ids('<|eot_id|>') if '<|eot_id|>' in tokenizer.get_vocab() else None
+    if eot_id is not None:
+        ids.append(eot_id)
+    return [token_id for token_id in dict.fromkeys(ids) if token_id is not None]
+
+
+class HFBackend:
+    """
+    Batched `model.generate` with left padding.
+
+    Every prompt of a batch is left-padded to the longest one, so the new tokens of
+    all rows start at the same position and are sliced off together. Generation
+    stops per row at EOS (finished rows are padded) and for the batch once every
+    row has finished or `max_new_tokens` is reached.
+
+    Args:
+        model_name (str): Model id or path, e.g. a tiny HF model for CPU tests.
+        device (str): 'cuda', 'cpu' or None to pick CUDA when available.
+        dtype (str): torch dtype name, float16 on CUDA and float32 on CPU by default.
+        max_new_tokens (int): Generation budget per prompt.
+        temperature (float): Sampling temperature, 0 for greedy decoding.
+        min_p (float): Min-p sampling threshold.
+        constrained (bool): Only let the model emit lists of catalogue expectation calls
+            (see constrained_decoding.py); each row stops as soon as its list closes.
+        catalogue_file (str): Accepted expectations catalogue for constrained decoding.
+    """
+
+    def __init__(self, model_name, device=None, dtype=None, max_new_tokens=256, temperature=1.5, min_p=0.1,
+                 constrained=False, catalogue_file=None):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList
+
+        self.torch = torch
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        dtype = getattr(torch, dtype) if dtype else (torch.float16 if self.device == 'cuda' else torch.float32)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side='left')
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype).to(self.device).eval()
+        self.stop_ids = stop_token_ids(self.tokenizer)
+        self.generation_kwargs = {'max_new_tokens': max_new_tokens, 'use_cache': True}
+        if temperature > 0:
+            self.generation_kwargs.update(do_sample=True, temperature=temperature, min_p=min_p)
+        else:
+            self.generation_kwargs.update(do_sample=False)
+        self.logits_processor_list = LogitsProcessorList
+        self.grammar = None
+        if constrained:
+            from constrained_decoding import CATALOGUE_FILE, GrammarIndex
+            self.grammar = GrammarIndex.from_tokenizer(self.tokenizer, self.stop_ids, catalogue_file or CATALOGUE_FILE)
+
+    def prompt_length(self, user_prompt):
+        return len(self.tokenizer(render_prompt(self.tokenizer, user_prompt), add_special_tokens=False).input_ids)
+
+    def generate(self, user_prompts):
+        """
+        Returns (answer text, number of generated tokens) per prompt, in order.
+        """
+        prompts = [render_prompt(self.tokenizer, user_prompt) for user_prompt in user_prompts]
+        # The chat template already starts with the BOS token
+        inputs = self.tokenizer(prompts, return_tensors='pt', padding=True,
+                                add_special_tokens=not getattr(self.tokenizer, 'chat_template', None)).to(self.device)
+        # Custom processors run before temperature and min-p, so sampling only sees grammatical tokens
+        processors = self.logits_processor_list([self.grammar.processor()] if self.grammar else [])
+        with self.torch.inference_mode():
+            outputs = self.model.generate(**inputs, eos_token_id=self.stop_ids, logits_processor=processors,
+                                          pad_token_id=self.tokenizer.pad_token_id, **self.generation_kwargs)
+        new_tokens = outputs[:, inputs.input_ids.shape[1]:].tolist()
+
+        results = []
+        for tokens in new_tokens:
+            # Cut each row at its first stop token; the rest is padding
+            end = next((i for i, token in enumerate(tokens) if token in self.stop_ids), len(tokens))
+            results.append((self.tokenizer.decode(tokens[:end], skip_special_tokens=True), end))
+        return results
+
+
+class VLLMBackend:
+    """
+    vLLM engine, which batches continuously on its own: a whole window is submitted at once.
+
+    Args:
+        model_name (str): Model id or path.
+        max_new_tokens (int): Generation budget per prompt.
+        temperature (float): Sampling temperature, 0 for greedy decoding.
+        min_p (float): Min-p sampling threshold.
+        **engine_kwargs: Passed to `vllm.LLM`, e.g. gpu_memory_utilization or max_model_len.
+    """
+
+    def __init__(self, model_name, max_new_tokens=256, temperature=1.5, min_p=0.1, **engine_kwargs):
+        from vllm import LLM, SamplingParams
+
+        self.llm = LLM(model=model_name, **engine_kwargs)
+        self.tokenizer = self.llm.get_tokenizer()
+        self.sampling_params = SamplingParams(max_tokens=max_new_tokens, temperature=temperature,
+                                              min_p=min_p if temperature > 0 else 0.0,
+                                              stop_token_ids=stop_token_ids(self.tokenizer))
+
+    def prompt_length(self, user_prompt):
+        return len(self.tokenizer(render_prompt(self.tokenizer, user_prompt), add_special_tokens=False).input_ids)
+
+    def generate(self, user_prompts):
+        prompts = [render_prompt(self.tokenizer, user_prompt) for user_prompt in user_prompts]
+        outputs = self.llm.generate(prompts, self.sampling_params, use_tqdm=False)
+        return [(output.outputs[0].text, len(output.outputs[0].token_ids)) for output in outputs]
+
+
+def load_backend(name, model_name, device=None, dtype=None, constrained=False, **sampling_kwargs):
+    """
+    Creates the requested backend; 'vllm' falls back to HF when vLLM is not installed.
+    Constrained decoding is only implemented for the HF backend.
+    """
+    if name == 'vllm' and constrained:
+        logging.warning("Constrained decoding needs the HF backend, using it instead of vLLM.")
+    elif name == 'vllm':
+        try:
+            return VLLMBackend(model_name, **sampling_kwargs)
+        except ImportError:
+            logging.warning("vLLM is not installed, falling back to the HF backend.")
+    return HFBackend(model_name, device=device, dtype=dtype, constrained=constrained, **sampling_kwargs)
+
+
+def length_sorted_batches(records, lengths, batch_size):
+    """
+    Splits a window of records into batches of similar prompt length, longest first,
+    so little compute is spent on padding.
+
+    Returns:
+        list: Batches of (position in window, record).
+    """
+    order = sorted(range(len(records)), key=lambda i: lengths[i], reverse=True)
+    return [[(i, records[i]) for i in order[start:start + batch_size]] for start in range(0, len(order), batch_size)]
+
+
+def load_completed(output_file):
+    """
+    Indices of the rows already written to `output_file`; a torn last line is dropped.
+    """
+    completed = set()
+    with open(output_file, 'rb+') as file:
+        data = file.read()
+        end = data.rfind(b'\n') + 1
+        if end != len(data):
+            file.truncate(end)
+    for record in read_jsonl(output_file):
+        completed.add(record['index'])
+    return completed
+
+
+def run_inference(backend, input_file, output_file, batch_size=16, window=512, resume=False, limit=None):
+    """
+    Streams the input JSONL through the backend and appends one result per row to `output_file`.
+
+    Rows are read in windows of `window` records; each window is cut into length-sorted
+    batches and written back in input order, so the output lines up with the input
+    file as the evaluation expects.
+
+    Args:
+        backend (HFBackend | VLLMBackend): Model backend.
+        input_file (str): JSONL with a `user_prompt` field per row, e.g. data/test.jsonl.
+        output_file (str): JSONL results sink.
+        batch_size (int): Prompts per `generate` call (HF backend).
+        window (int): Rows read, sorted and written together.
+        resume (bool): Skip rows already in `output_file`.
+        limit (int): Only process the first `limit` rows.
+
+    Returns:
+        dict: rows, generated tokens, elapsed seconds, tokens/sec and batch latencies.
+    """
+    if os.path.exists(output_file) and not resume:
+        raise FileExistsError(f"'{output_file}' already exists; pass --resume to continue that run")
+    completed = load_completed(output_file) if resume and os.path.exists(output_file) else set()
+    os.makedirs(os.path.dirname(os.path.abspath(output_file)), exist_ok=True)
+
+    pending = ((index, record) for index, record in enumerate(islice(read_jsonl(input_file), limit))
+               if index not in completed)
+    stats = {'rows': 0, 'generated_tokens': 0, 'batch_latencies': []}
+    batch_number = 0
+    start = time.perf_counter()
+
+    with open(output_file, 'a', encoding='utf-8') as sink:
+        while True:
+            chunk = list(islice(pending, window))
+            if not chunk:
+                break
+            records = [record for _, record in chunk]
+            if isinstance(backend, VLLMBackend):
+                batches = [list(enumerate(records))]
+            else:
+                lengths = [backend.prompt_length(record['user_prompt']) for record in records]
+                batches = length_sorted_batches(records, lengths, batch_size)
+
+            answers = [None] * len(records)
+            for batch in batches:
+                batch_number += 1
+                batch_start = time.perf_counter()
+                outputs = backend.generate([record['user_prompt'] for _, record in batch])
+                latency = time.perf_counter() - batch_start
+                tokens = sum(n_tokens for _, n_tokens in outputs)
+                for (position, _), output in zip(batch, outputs):
+                    answers[position] = output
+                stats['batch_latencies'].append(latency)
+                stats['generated_tokens'] += tokens
+                print(f"Batch {batch_number}: {len(batch)} prompts, {tokens} new tokens in {latency:.2f}s "
+                      f"({tokens / latency if latency else 0.0:.1f} tokens/sec)")
+
+            for (index, record), (text, _) in zip(chunk, answers):
+                sink.write(json.dumps({
+                    'index': index,
+                    'user_prompt': record['user_prompt'],
+                    'generated_expectations': text.strip(),
+                    'great_expectations': extract_expectations(text),
+                }) + '\n')
+            sink.flush()
+            os.fsync(sink.fileno())
+            stats['rows'] += len(chunk)
+
+    stats['elapsed'] = time.perf_counter() - start
+    stats['tokens_per_sec'] = stats['generated_tokens'] / stats['elapsed'] if stats['elapsed'] else 0.0
+    return stats
+
+
+def report(stats):
+    latencies = sorted(stats['batch_latencies'])
+    message = (f"Generated {stats['generated_tokens']} tokens for {stats['rows']} rows in {stats['elapsed']:.1f}s: "
+               f"{stats['tokens_per_sec']:.1f} tokens/sec, {stats['rows'] / stats['elapsed'] if stats['elapsed'] else 0.0:.2f} rows/sec")
+    if latencies:
+        message += (f"; batch latency mean {statistics.fmean(latencies):.2f}s, "
+                    f"p50 {latencies[len(latencies) // 2]:.2f}s, max {latencies[-1]:.2f}s")
+    logging.info(message)
+    print(message)
+    return message
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batched offline inference over a JSONL file of user prompts.')
+    parser.add_argument('--model', default='unsloth/Llama-3.2-3B-Instruct-unsloth-bnb-4bit',
+                        help='Model id or path; a tiny model such as hf-internal-testing/tiny-random-LlamaForCausalLM runs on CPU')
+    parser.add_argument('-i', '--input', default='data/test.jsonl')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Results JSONL, data/inference_results_<timestamp>.jsonl by default')
+    parser.add_argument('--backend', choices=['hf', 'vllm'], default='hf')
+    parser.add_argument('--batch-size', type=int, default=16, help='Prompts per generate call (hf backend)')
+    parser.add_argument('--window', type=int, default=512, help='Rows sorted by length and written together')
+    parser.add_argument('--max-new-tokens', type=int, default=256)
+    parser.add_argument('--temperature', type=float, default=1.5, help='0 for greedy decoding')
+    parser.add_argument('--min-p', type=float, default=0.1)
+    parser.add_argument('--device', default=None, help='cuda or cpu (hf backend)')
+    parser.add_argument('--dtype', default=None, help='torch dtype, e.g. float16 or bfloat16 (hf backend)')
+    parser.add_argument('--limit', type=int, default=None, help='Only run the first N rows')
+    parser.add_argument('--constrained', action='store_true',
+                        help='Only generate lists of catalogue expectation calls (hf backend)')
+    parser.add_argument('--resume', action='store_true', help='Continue the run in --output')
+    args = parser.parse_args()
+    if args.resume and not args.output:
+        parser.error('--resume requires --output pointing at the run to continue')
+
+    output = args.output or f"data/inference_results_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+    backend = load_backend(args.backend, args.model, device=args.device, dtype=args.dtype, constrained=args.constrained,
+                           max_new_tokens=args.max_new_tokens, temperature=args.temperature, min_p=args.min_p)
+    stats = run_inference(backend, args.input, output, batch_size=args.batch_size, window=args.window,
+                          resume=args.resume, limit=args.limit)
+    report(stats)
+    print(f"Inference completed and saved to {output}")
@@ -0,0 +1,286 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+
+# Instruction of the rows in data/train.jsonl, data/eval.jsonl and data/test.jsonl
+DEFAULT_INSTRUCTION = ('Convert the data quality prompts to great_expectations in the form '
+                       'expectation_type(columnName, params...).\nDo not hallucinate')
+COLUMNS = ['user_prompt', 'generated_expectations', 'instruction', 'source_file']
+SOURCE_EXTENSIONS = ('.csv', '.jsonl')
+# Rows buffered per split before they are written as one record batch
+BATCH_ROWS = 50000
+DEFAULT_SPLITS = 'train=0.8,eval=0.1,test=0.1'
+# Part of the split hash; changing it reshuffles every row between the splits
+SPLIT_SALT = 'ge-llm-split-v1'
+
+
+def schema():
+    import pyarrow as pa
+
+    return pa.schema([(column, pa.string()) for column in COLUMNS])
+
+
+def find_sources(inputs):
+    """
+    CSV and JSONL files of the inputs; folders are walked recursively, like `combine_csv_files` did.
+    """
+    sources = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                sources.extend(os.path.join(root, file) for file in sorted(files) if file.endswith(SOURCE_EXTENSIONS))
+        elif path.endswith(SOURCE_EXTENSIONS):
+            sources.append(path)
+    return sources
+
+
+def read_source(file_path):
+    """
+    Lazily yields the records of one CSV or JSONL shard.
+    """
+    with open(file_path, 'r', encoding='utf-8-sig', newline='') as file:
+        if file_path.endswith('.jsonl'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+
+def clean_expectations(text):
+    """
+    Joins the expectations on one line, as the finetuning notebook cleaned them before splitting.
+    """
+    return text.replace('      ', '').replace('\n', ',').replace(',,', ',')
+
+
+def prompt_hash(user_prompt):
+    normalized = ' '.join(user_prompt.split()).casefold()
+    return hashlib.blake2b(f"{SPLIT_SALT}:{normalized}".encode('utf-8'), digest_size=8).digest()
+
+
+def parse_splits(splits):
+    """
+    Parses 'train=0.8,eval=0.1,test=0.1' into [(name, cumulative fraction), ...].
+    """
+    parsed, total = [], 0.0
+    for part in splits.split(','):
+        name, fraction = part.split('=')
+        total += float(fraction)
+        parsed.append((name.strip(), total))
+    if abs(total - 1.0) > 1e-6:
+        raise ValueError(f"Split fractions must sum to 1, got {total}")
+    return parsed
+
+
+def assign_split(user_prompt, splits):
+    """
+    Split of a row from the hash of its normalized prompt: the same prompt always lands in the
+    same split, whatever the order or number of source files, so no shuffle is needed.
+    """
+    position = int.from_bytes(prompt_hash(user_prompt), 'big') / 2 ** 64
+    return next((name for name, bound in splits if position < bound), splits[-1][0])
+
+
+class SplitWriter:
+    """
+    Streams the rows of one split to an Arrow IPC stream file (memory-mapped by
+    `datasets.Dataset.from_file`) or a Parquet file, `BATCH_ROWS` rows per record batch.
+
+    Args:
+        path (str): Output file.
+        file_format (str): 'arrow' or 'parquet'.
+    """
+
+    def __init__(self, path, file_format='arrow'):
+        import pyarrow as pa
+
+        self.pa = pa
+        self.schema = schema()
+        self.rows = 0
+        self.buffer = {column: [] for column in COLUMNS}
+        # The IPC writer does not close its sink, so the file is kept to be closed after it
+        self.sink = None
+        if file_format == 'parquet':
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.sink = pa.OSFile(path, 'wb')
+            self.writer = pa.ipc.new_stream(self.sink, self.schema)
+
+    def write(self, row):
+        for column in COLUMNS:
+            self.buffer[column].append(row[column])
+        if len(self.buffer['user_prompt']) >= BATCH_ROWS:
+            self.flush()
+
+    def flush(self):
+        if self.buffer['user_prompt']:
+            self.rows += len(self.buffer['user_prompt'])
+            self.writer.write_batch(self.pa.RecordBatch.from_pydict(self.buffer, schema=self.schema))
+            self.buffer = {column: [] for column in COLUMNS}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+def build_dataset(inputs, output_dir, splits=DEFAULT_SPLITS, file_format='arrow', instruction=DEFAULT_INSTRUCTION,
+                  export_jsonl=False):
+    """
+    Streams the source shards into one Arrow (or Parquet) file per split.
+
+    Rows are cleaned like the notebook did, exact duplicate (prompt, expectations)
+    pairs are written once, and each row goes to the split of its prompt hash.
+    Only the hashes of the rows seen so far and one record batch per split are
+    held in memory.
+
+    Args:
+        inputs (list): CSV/JSONL files or folders with `user_prompt` and `generated_expectations` columns.
+        output_dir (str): Directory of the split files and `dataset_info.json`.
+        splits (str): Split names and fractions.
+        file_format (str): 'arrow' or 'parquet'.
+        instruction (str): Instruction of rows that do not carry their own.
+        export_jsonl (bool): Also write `<split>.jsonl` in the layout of data/train.jsonl.
+
+    Returns:
+        dict: The dataset info written to `dataset_info.json`.
+    """
+    start = time.perf_counter()
+    csv.field_size_limit(sys.maxsize)
+    split_bounds = parse_splits(splits)
+    sources = find_sources(inputs)
+    os.makedirs(output_dir, exist_ok=True)
+    extension = 'parquet' if file_format == 'parquet' else 'arrow'
+    writers = {name: SplitWriter(os.path.join(output_dir, f"{name}.{extension}"), file_format)
+               for name, _ in split_bounds}
+    jsonl_files = ({name: open(os.path.join(output_dir, f"{name}.jsonl"), 'w', encoding='utf-8') for name in writers}
+                   if export_jsonl else {})
+    seen = set()
+    stats = {'rows_read': 0, 'skipped_empty': 0, 'duplicates': 0, 'sources': {}}
+    try:
+        for file_path in sources:
+            source_file = os.path.basename(file_path)
+            rows_before = stats['rows_read']
+            for record in read_source(file_path):
+                if 'user_prompt' not in record or 'generated_expectations' not in record:
+                    logging.warning(f"Skipping {file_path}: no user_prompt and generated_expectations columns")
+                    break
+                stats['rows_read'] += 1
+                user_prompt = (record.get('user_prompt') or '').strip()
+                expectations = (record.get('generated_expectations') or '').strip()
+                if not user_prompt or not expectations:
+                    stats['skipped_empty'] += 1
+                    continue
+                row = {
+                    'user_prompt': user_prompt,
+                    'generated_expectations': clean_expectations(expectations),
+                    'instruction': record.get('instruction') or instruction,
+                    'source_file': source_file,
+                }
+                key = hashlib.blake2b(f"{row['user_prompt']}\x00{row['generated_expectations']}".encode('utf-8'),
+                                      digest_size=8).digest()
+                if key in seen:
+                    stats['duplicates'] += 1
+                    continue
+                seen.add(key)
+                split = assign_split(user_prompt, split_bounds)
+                writers[split].write(row)
+                if split in jsonl_files:
+                    jsonl_files[split].write(json.dumps({column: row[column] for column in COLUMNS[:3]}) + '\n')
+            if stats['rows_read'] > rows_before:
+                stats['sources'][file_path] = stats['rows_read'] - rows_before
+            logging.info(f"Read {stats['rows_read'] - rows_before} rows from {file_path}")
+    finally:
+        for writer in writers.values():
+            writer.close()
+        for file in jsonl_files.values():
+            file.close()
+
+    elapsed = time.perf_counter() - start
+    info = {
+        'format': file_format,
+        'columns': COLUMNS,
+        'splits': {name: writer.rows for name, writer in writers.items()},
+        'split_fractions': splits,
+        'split_salt': SPLIT_SALT,
+        'files': {name: f"{name}.{extension}" for name in writers},
+        'rows_read': stats['rows_read'],
+        'skipped_empty': stats['skipped_empty'],
+        'duplicates': stats['duplicates'],
+        'sources': stats['sources'],
+        'elapsed_seconds': round(elapsed, 2),
+        'rows_per_second': round(stats['rows_read'] / elapsed) if elapsed else 0,
+    }
+    with open(os.path.join(output_dir, 'dataset_info.json'), 'w', encoding='utf-8') as file:
+        json.dump(info, file, indent=2)
+    return info
+
+
+def load_splits(dataset_dir):
+    """
+    Loads the built splits as a `datasets.DatasetDict`.
+
+    Arrow files are memory-mapped in place by `Dataset.from_file`, so loading takes
+    the same time whatever the size of the corpus and nothing is copied or shuffled.
+    The result can replace `load_dataset("json", data_files=...)` in the notebooks,
+    e.g. `to_sharegpt(load_splits('data/dataset')['train'], ...)`.
+    """
+    from datasets import Dataset, DatasetDict, load_dataset
+
+    with open(os.path.join(dataset_dir, 'dataset_info.json'), 'r', encoding='utf-8') as file:
+        info = json.load(file)
+    files = {name: os.path.join(dataset_dir, file_name) for name, file_name in info['files'].items()}
+    if info['format'] == 'parquet':
+        return load_dataset('parquet', data_files=files)
+    return DatasetDict({name: Dataset.from_file(path) for name, path in files.items()})
+
+
+def time_memory_mapped_load(dataset_dir):
+    """
+    Seconds to open every Arrow split through a memory map and count its rows.
+    """
+    import pyarrow as pa
+
+    with open(os.path.join(dataset_dir, 'dataset_info.json'), 'r', encoding='utf-8') as file:
+        info = json.load(file)
+    start = time.perf_counter()
+    rows = 0
+    for file_name in info['files'].values():
+        with pa.memory_map(os.path.join(dataset_dir, file_name)) as source:
+            rows += pa.ipc.open_stream(source).read_all().num_rows
+    return time.perf_counter() - start, rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Stream CSV/JSONL shards into hash-split Arrow or Parquet files for finetuning.')
+    parser.add_argument('inputs', nargs='*', default=['data/finetuning_dataset'],
+                        help='CSV/JSONL files or folders (walked recursively)')
+    parser.add_argument('-o', '--output-dir', default='data/dataset')
+    parser.add_argument('--splits', default=DEFAULT_SPLITS, help='Split names and fractions')
+    parser.add_argument('--format', choices=['arrow', 'parquet'], default='arrow',
+                        help='arrow files are memory-mapped by datasets; parquet files are smaller')
+    parser.add_argument('--instruction', default=DEFAULT_INSTRUCTION, help='Instruction of rows without one')
+    parser.add_argument('--export-jsonl', action='store_true',
+                        help='Also write <split>.jsonl like data/train.jsonl, for the notebooks and batch_inference.py')
+    args = parser.parse_args()
+
+    info = build_dataset(args.inputs, args.output_dir, splits=args.splits, file_format=args.format,
+                         instruction=args.instruction, export_jsonl=args.export_jsonl)
+    logging.info(f"Dataset info: {info}")
+    print(f"Read {info['rows_read']} rows from {len(info['sources'])} files in {info['elapsed_seconds']}s "
+          f"({info['rows_per_second']} rows/sec): {info['splits']}, "
+          f"{info['duplicates']} duplicates and {info['skipped_empty']} empty rows skipped")
+    if args.format == 'arrow':
+        seconds, rows = time_memory_mapped_load(args.output_dir)
+        print(f"Memory-mapped load of {rows} rows: {seconds * 1000:.1f} ms")
+    print(f"Dataset saved to {args.output_dir}")
@@ -0,0 +1,302 @@
+import argparse
+import json
+import logging
+import statistics
+import time
+from itertools import islice
+
+from expectation_parser import CATALOGUE_FILE, load_catalogue, score_pair
+
+# Characters that change the grammar state inside a call's arguments
+SPECIAL_CHARS = frozenset('()[]{}"\'\\#')
+WHITESPACE = frozenset(' \t\n')
+# Deepest bracket nesting allowed inside a call
+MAX_DEPTH = 6
+# Whitespace characters allowed before a name, e.g. ', ' or ',\n'
+MAX_SEPARATOR_SPACE = 2
+
+# Grammar states: ('sep', spaces) before a name, ('name', prefix) while typing one, ('args', depth, quote, escaped)
+# inside the parentheses and ('after',) once a call closed, where only ',' or EOS may follow
+START = ('sep', 0)
+AFTER_CALL = ('after',)
+
+
+class CallListGrammar:
+    """
+    Character-level automaton for a list of expectation calls:
+    `name(args), name(args), ...` with names from the catalogue.
+
+    Arguments may hold any text with balanced brackets and closed string
+    literals, but no comments. The list can only end right after a call closes.
+
+    Args:
+        names (list): Accepted expectation names.
+    """
+
+    def __init__(self, names):
+        self.names = frozenset(names)
+        self.prefixes = frozenset(name[:i] for name in names for i in range(1, len(name) + 1))
+        self.steps = {}
+
+    def step(self, state, char):
+        """
+        State after `char`, or None when the grammar does not allow it. Memoized per (state, char).
+        """
+        key = (state, char)
+        if key not in self.steps:
+            self.steps[key] = self._step(state, char)
+        return self.steps[key]
+
+    def _step(self, state, char):
+        kind = state[0]
+        if kind == 'sep':
+            if char in WHITESPACE:
+                return ('sep', state[1] + 1) if state[1] < MAX_SEPARATOR_SPACE else None
+            return ('name', char) if char in self.prefixes else None
+        if kind == 'name':
+            prefix = state[1] + char
+            if prefix in self.prefixes:
+                return ('name', prefix)
+            return ('args', 1, None, False) if char == '(' and state[1] in self.names else None
+        if kind == 'after':
+            return START if char == ',' else None
+
+        _, depth, quote, escaped = state
+        if quote:
+            if escaped:
+                return ('args', depth, quote, False)
+            if char == '\\':
+                return ('args', depth, quote, True)
+            return ('args', depth, None if char == quote else quote, False)
+        if char in '"\'':
+            return ('args', depth, char, False)
+        if char in '([{':
+            return ('args', depth + 1, None, False) if depth < MAX_DEPTH else None
+        if char in ')]}':
+            if depth == 1:
+                return AFTER_CALL if char == ')' else None
+            return ('args', depth - 1, None, False)
+        if char in '#\\':
+            return None
+        return state
+
+    def advance(self, state, text):
+        for char in text:
+            if state is None:
+                return None
+            state = self.step(state, char)
+        return state
+
+    def accepts_end(self, state):
+        return state == AFTER_CALL
+
+
+class TokenTrie:
+    """
+    Character trie over token strings; each node lists the ids of the tokens ending there.
+    """
+
+    def __init__(self):
+        self.children = {}
+        self.ids = []
+
+    def insert(self, text, token_id):
+        node = self
+        for char in text:
+            node = node.children.setdefault(char, TokenTrie())
+        node.ids.append(token_id)
+
+
+def token_strings(tokenizer):
+    """
+    Text every token adds to the output, with SentencePiece word-start markers turned into spaces.
+    Tokens that decode to partial UTF-8 sequences map to None.
+    """
+    strings = []
+    for token_id, token in enumerate(tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))):
+        text = tokenizer.decode([token_id])
+        if isinstance(token, str) and token.startswith('▁') and not text.startswith(' '):
+            text = ' ' + text
+        strings.append(None if '�' in text else text)
+    return strings
+
+
+class GrammarIndex:
+    """
+    Allowed-token sets of the call-list grammar over a tokenizer's vocabulary, cached per grammar state.
+
+    Tokens without any SPECIAL_CHARS ("plain" tokens) never change an argument
+    state, so inside arguments they are all allowed at once and only the small
+    trie of special tokens is walked. Names are matched by walking the full
+    token trie, pruned to catalogue prefixes after the first character.
+
+    Args:
+        strings (list): Text of every token id (None for tokens never allowed).
+        names (list): Accepted expectation names.
+        eos_token_ids (list): Tokens that may end the list after a closed call.
+    """
+
+    def __init__(self, strings, names, eos_token_ids):
+        self.grammar = CallListGrammar(names)
+        self.strings = strings
+        self.eos_token_ids = list(eos_token_ids)
+        self.trie = TokenTrie()
+        self.special_trie = TokenTrie()
+        self.plain_ids = []
+        special = set(self.eos_token_ids)
+        for token_id, text in enumerate(strings):
+            if not text or token_id in special:
+                continue
+            self.trie.insert(text, token_id)
+            if SPECIAL_CHARS.isdisjoint(text):
+                self.plain_ids.append(token_id)
+            else:
+                self.special_trie.insert(text, token_id)
+        self.allowed_cache = {}
+
+    @classmethod
+    def from_tokenizer(cls, tokenizer, eos_token_ids, catalogue_file=CATALOGUE_FILE):
+        start = time.perf_counter()
+        index = cls(token_strings(tokenizer), load_catalogue(catalogue_file), eos_token_ids)
+        logging.info(f"Grammar index over {len(index.strings)} tokens built in {time.perf_counter() - start:.1f}s")
+        return index
+
+    def _walk(self, node, state, allowed):
+        for char, child in node.children.items():
+            next_state = self.grammar.step(state, char)
+            if next_state is not None:
+                allowed.extend(child.ids)
+                self._walk(child, next_state, allowed)
+
+    def allowed_tokens(self, state):
+        """
+        Ids of the tokens that keep the output inside the grammar from `state`.
+        """
+        if state not in self.allowed_cache:
+            allowed = []
+            if state[0] == 'args':
+                allowed.extend(self.plain_ids)
+                self._walk(self.special_trie, state, allowed)
+            else:
+                self._walk(self.trie, state, allowed)
+            if self.grammar.accepts_end(state):
+                allowed.extend(self.eos_token_ids)
+            self.allowed_cache[state] = allowed
+        return self.allowed_cache[state]
+
+    def processor(self):
+        return ExpectationLogitsProcessor(self)
+
+
+class ExpectationLogitsProcessor:
+    """
+    `transformers` logits processor restricting every row of a `generate` call to the grammar.
+
+    Row states are advanced by the token generated at the previous step, so a
+    new processor is needed per `generate` call; the masks are cached in the
+    shared GrammarIndex.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.states = None
+        self.masks = {}
+
+    def mask(self, state, scores):
+        if state not in self.masks:
+            mask = scores.new_ones(scores.shape[-1], dtype=bool)
+            allowed = [token_id for token_id in self.index.allowed_tokens(state) if token_id < scores.shape[-1]]
+            mask[allowed] = False
+            self.masks[state] = mask
+        return self.masks[state]
+
+    def __call__(self, input_ids, scores):
+        if self.states is None:
+            self.states = [START] * input_ids.shape[0]
+        else:
+            for row, token_id in enumerate(input_ids[:, -1].tolist()):
+                state = self.states[row]
+                if state is None:
+                    continue
+                if token_id in self.index.eos_token_ids and self.index.grammar.accepts_end(state):
+                    self.states[row] = None
+                else:
+                    self.states[row] = self.index.grammar.advance(state, self.index.strings[token_id] or '')
+        for row, state in enumerate(self.states):
+            # Finished rows (and rows that left the grammar) are not constrained
+            if state is not None:
+                scores[row] = scores[row].masked_fill(self.mask(state, scores), float('-inf'))
+        return scores
+
+
+def run_mode(backend, records, batch_size):
+    """
+    Generates answers for `records` and scores them against their references.
+
+    Returns:
+        dict: Tokens and latency per example, structural validity and mean structural scores.
+    """
+    from batch_inference import extract_expectations
+
+    tokens, latencies, scores = [], [], []
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        batch_start = time.perf_counter()
+        outputs = backend.generate([record['user_prompt'] for record in batch])
+        latency = time.perf_counter() - batch_start
+        for record, (text, n_tokens) in zip(batch, outputs):
+            tokens.append(n_tokens)
+            latencies.append(latency / len(batch))
+            scores.append(score_pair(record['generated_expectations'], extract_expectations(text)))
+    latencies.sort()
+    return {
+        'examples': len(records),
+        'tokens_per_example': statistics.fmean(tokens),
+        'latency_per_example': statistics.fmean(latencies),
+        'latency_p50': latencies[len(latencies) // 2],
+        # Every call parsed and named a catalogue expectation
+        'structurally_valid': statistics.fmean(
+            float(score['parse_errors'] == 0 and score['valid_rate'] == 1.0) for score in scores),
+        'valid_rate': statistics.fmean(score['valid_rate'] for score in scores),
+        'call_f1': statistics.fmean(score['call_f1'] for score in scores),
+        'exact_match': statistics.fmean(score['exact_match'] for score in scores),
+    }
+
+
+def compare(args):
+    """
+    Runs the same examples without and with the grammar and prints both reports.
+    """
+    from batch_inference import HFBackend, read_jsonl
+
+    records = list(islice(read_jsonl(args.input), args.limit))
+    backend = HFBackend(args.model, device=args.device, max_new_tokens=args.max_new_tokens,
+                        temperature=args.temperature, constrained=True, catalogue_file=args.catalogue)
+    grammar = backend.grammar
+    report = {}
+    for mode in ('unconstrained', 'constrained'):
+        backend.grammar = grammar if mode == 'constrained' else None
+        report[mode] = run_mode(backend, records, args.batch_size)
+        logging.info(f"{mode}: {report[mode]}")
+        print(f"{mode}: " + ', '.join(f"{name} {value:.3f}" for name, value in report[mode].items()))
+    print(f"Grammar states cached: {len(grammar.allowed_cache)}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Compare unconstrained and grammar-constrained decoding: tokens, latency and structural validity.')
+    parser.add_argument('--model', default='hf-internal-testing/tiny-random-LlamaForCausalLM',
+                        help='Model id or path; small models keep the comparison runnable on CPU')
+    parser.add_argument('-i', '--input', default='data/test.jsonl')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the comparison report')
+    parser.add_argument('--limit', type=int, default=64, help='Examples per mode')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--max-new-tokens', type=int, default=256)
+    parser.add_argument('--temperature', type=float, default=0.0, help='0 (greedy) keeps both modes comparable')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--catalogue', default=CATALOGUE_FILE, help='Accepted expectations catalogue (CSV)')
+    compare(parser.parse_args())
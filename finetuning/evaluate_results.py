@@ -0,0 +1,292 @@
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from importlib import metadata
+
+DEFAULT_CACHE_PATH = os.getenv('EVAL_CACHE_PATH', './.cache/eval_metrics.sqlite')
+BERTSCORE_MODEL = 'distilbert-base-uncased'
+
+# Bump when the way a metric is computed changes, so its cached values are not reused
+METRIC_SCHEMA = 1
+
+# Per-row CSV columns of each metric, in the order of Results/eval_results_baseline_dataset.csv
+METRIC_COLUMNS = {
+    'rouge': ['rouge1_fmeasure', 'rouge2_fmeasure', 'rougeL_fmeasure'],
+    'bleu': ['granular_bleu_score'],
+    'bertscore': ['f1', 'precision', 'recall'],
+    'meteor': ['meteor'],
+}
+# Package whose version identifies each metric's implementation
+METRIC_PACKAGES = {'rouge': 'rouge-score', 'bleu': 'sacrebleu', 'bertscore': 'bert-score', 'meteor': 'nltk'}
+
+
+def metric_version(metric):
+    """
+    Identifies the implementation and settings behind a metric's values.
+    """
+    try:
+        package_version = metadata.version(METRIC_PACKAGES[metric])
+    except metadata.PackageNotFoundError:
+        package_version = 'unknown'
+    settings = {'rouge': 'stemmer', 'bertscore': BERTSCORE_MODEL}.get(metric, '')
+    return f"{METRIC_SCHEMA}:{METRIC_PACKAGES[metric]}=={package_version}:{settings}"
+
+
+def metric_key(metric, version, reference, hypothesis):
+    payload = json.dumps([metric, version, reference, hypothesis], ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class MetricCache:
+    """
+    SQLite store of per-example metric values keyed by hash(metric, version, reference, hypothesis),
+    so a re-run only scores the pairs whose hypothesis (or metric version) changed.
+
+    Args:
+        path (str): SQLite database file.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS metrics (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def get_many(self, keys):
+        """
+        Returns {key: values} for the keys found in the cache.
+        """
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = self.connection.execute(
+                f"SELECT key, value FROM metrics WHERE key IN ({','.join('?' * len(chunk))})", chunk)
+            found.update((key, json.loads(value)) for key, value in rows)
+        return found
+
+    def put_many(self, items):
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO metrics (key, value) VALUES (?, ?)',
+                                        [(key, json.dumps(values)) for key, values in items.items()])
+
+    def close(self):
+        self.connection.close()
+
+
+# Scorers are created once per worker process, on first use
+_scorers = {}
+
+
+def score_rouge(reference, hypothesis):
+    if 'rouge' not in _scorers:
+        from rouge_score import rouge_scorer
+        _scorers['rouge'] = rouge_scorer.RougeScorer(["rouge1", "rouge2", "rougeL"], use_stemmer=True)
+    scores = _scorers['rouge'].score(reference, hypothesis)
+    return {
+        'rouge1_fmeasure': scores['rouge1'].fmeasure,
+        'rouge2_fmeasure': scores['rouge2'].fmeasure,
+        'rougeL_fmeasure': scores['rougeL'].fmeasure,
+    }
+
+
+def score_bleu(reference, hypothesis):
+    import sacrebleu
+    return {'granular_bleu_score': sacrebleu.sentence_bleu(hypothesis, [reference]).score}
+
+
+def score_meteor(reference, hypothesis):
+    """
+    Sentence METEOR as `evaluate.load('meteor')` computes it; the corpus score is their mean.
+    """
+    if 'meteor' not in _scorers:
+        import nltk
+        for resource in ('wordnet', 'punkt_tab', 'omw-1.4'):
+            nltk.download(resource, quiet=True)
+        from nltk.tokenize import word_tokenize
+        from nltk.translate.meteor_score import meteor_score
+        _scorers['meteor'] = (word_tokenize, meteor_score)
+    word_tokenize, meteor_score = _scorers['meteor']
+    return {'meteor': meteor_score([word_tokenize(reference)], word_tokenize(hypothesis))}
+
+
+CPU_METRICS = {'rouge': score_rouge, 'bleu': score_bleu, 'meteor': score_meteor}
+
+
+def score_chunk(metric, pairs):
+    """
+    Worker entry point: scores a chunk of (reference, hypothesis) pairs with one CPU metric.
+    """
+    score = CPU_METRICS[metric]
+    return [score(reference, hypothesis) for reference, hypothesis in pairs]
+
+
+def score_bertscore(pairs, batch_size=64, device=None):
+    """
+    BERTScore of the pairs, computed `batch_size` pairs at a time with one loaded model.
+    """
+    from bert_score import BERTScorer
+
+    scorer = BERTScorer(model_type=BERTSCORE_MODEL, batch_size=batch_size, device=device)
+    results = []
+    for start in range(0, len(pairs), batch_size):
+        batch = pairs[start:start + batch_size]
+        precision, recall, f1 = scorer.score([hypothesis for _, hypothesis in batch],
+                                             [reference for reference, _ in batch])
+        results.extend({'f1': f, 'precision': p, 'recall': r}
+                       for p, r, f in zip(precision.tolist(), recall.tolist(), f1.tolist()))
+        print(f"BERTScore: {min(start + batch_size, len(pairs))}/{len(pairs)} pairs")
+    return results
+
+
+def load_jsonl(file_path):
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def load_pairs(test_file, inference_file):
+    """
+    Lines up the test rows with the inference results.
+
+    Results written by batch_inference.py carry the `index` of their test row; older
+    result files are matched by position, as the notebooks did.
+
+    Returns:
+        list: Dicts with user_prompt, reference and hypothesis.
+    """
+    test_data = load_jsonl(test_file)
+    inference_data = load_jsonl(inference_file)
+    if inference_data and all('index' in row for row in inference_data):
+        pairs = [(test_data[row['index']], row) for row in inference_data]
+    else:
+        pairs = list(zip(test_data, inference_data))
+    return [
+        {
+            'user_prompt': test['user_prompt'],
+            'reference': test['generated_expectations'],
+            'hypothesis': inference.get('great_expectations') or '',
+        }
+        for test, inference in pairs
+    ]
+
+
+def evaluate(rows, metrics, cache, workers=None, chunk_size=64, bert_batch_size=64, device=None):
+    """
+    Adds the per-row values of `metrics` to `rows`, scoring only pairs missing from the cache.
+
+    CPU metrics are scored in chunks on a process pool; BERTScore runs in batches in
+    this process. Identical (reference, hypothesis) pairs are scored once.
+
+    Returns:
+        dict: Metric -> number of pairs scored (the rest came from the cache).
+    """
+    keys, pending = {}, {}
+    for metric in metrics:
+        version = metric_version(metric)
+        keys[metric] = [metric_key(metric, version, row['reference'], row['hypothesis']) for row in rows]
+        cached = cache.get_many(set(keys[metric]))
+        pending[metric] = {key: (row['reference'], row['hypothesis'])
+                           for key, row in zip(keys[metric], rows) if key not in cached}
+        for key, row in zip(keys[metric], rows):
+            if key in cached:
+                row.update(cached[key])
+
+    scored = {}
+    cpu_jobs = [metric for metric in metrics if metric in CPU_METRICS and pending[metric]]
+    if cpu_jobs:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = []
+            for metric in cpu_jobs:
+                items = list(pending[metric].items())
+                for start in range(0, len(items), chunk_size):
+                    chunk = items[start:start + chunk_size]
+                    futures.append((metric, chunk, executor.submit(score_chunk, metric, [pair for _, pair in chunk])))
+            for metric, chunk, future in futures:
+                scored.setdefault(metric, {}).update(zip([key for key, _ in chunk], future.result()))
+    if 'bertscore' in metrics and pending['bertscore']:
+        items = list(pending['bertscore'].items())
+        values = score_bertscore([pair for _, pair in items], batch_size=bert_batch_size, device=device)
+        scored['bertscore'] = dict(zip([key for key, _ in items], values))
+
+    for metric, values in scored.items():
+        cache.put_many(values)
+        for key, row in zip(keys[metric], rows):
+            if key in values:
+                row.update(values[key])
+    return {metric: len(pending[metric]) for metric in metrics}
+
+
+def corpus_summary(rows, metrics):
+    """
+    Corpus BLEU, mean METEOR and the mean of every per-row column.
+    """
+    summary = {'rows': len(rows)}
+    if 'bleu' in metrics:
+        import sacrebleu
+        summary['corpus_bleu'] = sacrebleu.corpus_bleu(
+            [row['hypothesis'] for row in rows], [[row['reference'] for row in rows]]).score
+    for metric in metrics:
+        for column in METRIC_COLUMNS[metric]:
+            summary[f"mean_{column}"] = statistics.fmean(row[column] for row in rows) if rows else 0.0
+    return summary
+
+
+def write_results(rows, metrics, output_csv):
+    columns = ['user_prompt', 'reference', 'hypothesis'] + [
+        column for metric in METRIC_COLUMNS if metric in metrics for column in METRIC_COLUMNS[metric]]
+    os.makedirs(os.path.dirname(os.path.abspath(output_csv)), exist_ok=True)
+    with open(output_csv, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.DictWriter(file, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score inference results against the test set (ROUGE, BLEU, METEOR, BERTScore).')
+    parser.add_argument('-t', '--test-file', default='data/test.jsonl')
+    parser.add_argument('-i', '--inference-file', default='data/inference_results_baseline.jsonl')
+    parser.add_argument('-o', '--output', default='data/eval_results_baseline_dataset.csv',
+                        help='Per-row CSV; the corpus summary is written next to it as .summary.json')
+    parser.add_argument('--metrics', default='rouge,bleu,bertscore,meteor',
+                        help=f"Comma separated subset of {', '.join(METRIC_COLUMNS)}")
+    parser.add_argument('--workers', type=int, default=None, help='Scoring processes (default: CPU count)')
+    parser.add_argument('--chunk-size', type=int, default=64, help='Pairs per process pool task')
+    parser.add_argument('--bert-batch-size', type=int, default=64, help='Pairs per BERTScore batch')
+    parser.add_argument('--device', default=None, help='BERTScore device, e.g. cuda or cpu')
+    parser.add_argument('--cache-path', default=DEFAULT_CACHE_PATH, help='SQLite cache of per-example metric values')
+    args = parser.parse_args()
+
+    metrics = [metric.strip() for metric in args.metrics.split(',') if metric.strip()]
+    unknown = set(metrics) - set(METRIC_COLUMNS)
+    if unknown:
+        parser.error(f"Unknown metrics: {', '.join(sorted(unknown))}")
+
+    start = time.perf_counter()
+    rows = load_pairs(args.test_file, args.inference_file)
+    cache = MetricCache(args.cache_path)
+    try:
+        scored = evaluate(rows, metrics, cache, workers=args.workers, chunk_size=args.chunk_size,
+                          bert_batch_size=args.bert_batch_size, device=args.device)
+    finally:
+        cache.close()
+    write_results(rows, metrics, args.output)
+    summary = corpus_summary(rows, metrics)
+    summary['scored'] = scored
+    summary_file = os.path.splitext(args.output)[0] + '.summary.json'
+    with open(summary_file, 'w') as file:
+        json.dump(summary, file, indent=2)
+
+    logging.info(f"Evaluation summary: {summary}")
+    for name, value in summary.items():
+        if name not in ('rows', 'scored'):
+            print(f"{name}: {value:.4f}")
+    print(f"Scored {scored} new pairs of {len(rows)} rows in {time.perf_counter() - start:.1f}s "
+          f"(the rest came from the cache).")
+    print(f"Results saved to {args.output} and {summary_file}")
@@ -0,0 +1,255 @@
+import argparse
+import ast
+import csv
+import functools
+import json
+import os
+import re
+import statistics
+import sys
+import time
+from collections import namedtuple
+
+# Resolved against the repository root, so the scorer runs from any directory
+CATALOGUE_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'data', 'finetuning_dataset', 'listExpectations.csv')
+
+# Start of an expectation call; the arguments are delimited by scanning for the matching ')'
+CALL_START = re.compile(r'\b(expect_\w+)\s*\(')
+# Whitespace between two arguments where the model dropped the comma, e.g. `column="x" value=3`
+MISSING_COMMA = re.compile(r'''(?<=["'\]\)\}\w])(\s+)(?=\w+\s*=[^=])''')
+# Brackets, plus the string literals and comments whose brackets must be skipped
+CALL_TOKEN = re.compile(r'''"(?:[^"\\\n]|\\.)*(?:"|$)|'(?:[^'\\\n]|\\.)*(?:'|$)|#[^\n]*|[()\[\]{}]''', re.MULTILINE)
+
+# A call without nested calls, dicts or comments (most model output); strings and flat lists
+# may appear in its arguments. Written unrolled so finding all calls of a row is one cheap scan
+# instead of a bracket scan per call.
+STRING = r'''(?:"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')'''
+PLAIN = r'''[^()\[\]{}"'#\\]*'''
+SIMPLE_CALL = re.compile(
+    rf'''(expect_\w+)\s*\(({PLAIN}(?:(?:{STRING}|\[{PLAIN}(?:{STRING}{PLAIN})*\]){PLAIN})*)\)''')
+
+# Keyword spellings that mean the same argument
+KWARG_ALIASES = {'type': 'type_', 'columns': 'column_list'}
+# Arguments whose list value is a set, so element order does not matter
+UNORDERED_KWARGS = {'value_set', 'column_set'}
+
+# One parsed call: `kwargs` is a sorted tuple of (name, canonical value), None when the call did not parse
+ExpectationCall = namedtuple('ExpectationCall', ['name', 'kwargs'])
+
+
+def find_call_end(text, start):
+    """
+    Index just past the ')' closing the call whose '(' is at `start - 1`,
+    skipping brackets inside string literals and comments. Unclosed calls end at the text's end.
+    """
+    depth = 1
+    for token in CALL_TOKEN.finditer(text, start):
+        char = token.group(0)
+        if char in '([{':
+            depth += 1
+        elif char in ')]}':
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    return len(text)
+
+
+def canonical_value(node, unordered=False):
+    """
+    Hashable, formatting-independent form of an argument: literals by value
+    (1 == 1.0, quoting ignored), lists as tuples (sorted when `unordered`),
+    and anything else (names, expressions) by its unparsed source.
+    """
+    if isinstance(node, ast.Constant):
+        value = node.value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+        return value.strip() if isinstance(value, str) else value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant):
+        return -canonical_value(node.operand)
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        items = tuple(canonical_value(item) for item in node.elts)
+        return tuple(sorted(items, key=repr)) if unordered or isinstance(node, ast.Set) else items
+    if isinstance(node, ast.Dict):
+        return tuple(sorted(((canonical_value(k), canonical_value(v)) for k, v in zip(node.keys, node.values)),
+                            key=repr))
+    return ('<expr>', ast.unparse(node))
+
+
+def positional_names(name, count):
+    """
+    Keyword names of positional arguments, so `f("x")` and `f(column="x")` compare equal.
+    """
+    if name.startswith('expect_column_pair_'):
+        names = ['column_A', 'column_B']
+    elif name.startswith('expect_column_'):
+        names = ['column']
+    else:
+        names = []
+    return [names[i] if i < len(names) else f'_{i}' for i in range(count)]
+
+
+def canonical_call(name, node):
+    args = dict(zip(positional_names(name, len(node.args)), node.args))
+    for keyword in node.keywords:
+        if keyword.arg is not None:
+            args[KWARG_ALIASES.get(keyword.arg, keyword.arg)] = keyword.value
+    return ExpectationCall(name, tuple(sorted(
+        (key, canonical_value(value, unordered=key in UNORDERED_KWARGS)) for key, value in args.items())))
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_call(name, source):
+    """
+    Parses the text of one call, retrying with the missing commas between arguments restored.
+    """
+    for candidate in (source, MISSING_COMMA.sub(r',\1', source)):
+        try:
+            node = ast.parse(candidate.strip(), mode='eval').body
+        except (SyntaxError, ValueError):
+            continue
+        if isinstance(node, ast.Call):
+            return canonical_call(name, node)
+    return ExpectationCall(name, None)
+
+
+@functools.lru_cache(maxsize=65536)
+def parse_expectations(text):
+    """
+    Parses a generated or reference string into canonical expectation calls.
+
+    Every `expect_*(` occurrence is parsed on its own, so text around the calls,
+    trailing comments and missing commas between calls do not matter.
+
+    Args:
+        text (str): Expectations as produced by the model, e.g.
+            'expect_column_values_to_be_in_set(column="x", value_set=["a", "b"]),...'
+    Returns:
+        tuple: ExpectationCall per call, in order of appearance.
+    """
+    text = text or ''
+    calls = []
+    position = 0
+    for simple in SIMPLE_CALL.finditer(text):
+        if text.find('expect_', position, simple.start()) != -1:
+            calls.extend(parse_calls(text, position, simple.start()))
+        calls.append(parse_call(simple.group(1), simple.group(0)))
+        position = simple.end()
+    if text.find('expect_', position) != -1:
+        calls.extend(parse_calls(text, position, len(text)))
+    return tuple(calls)
+
+
+def parse_calls(text, start, end):
+    """
+    Parses the calls in text[start:end] with `ast`, one call at a time.
+    """
+    text = text[start:end]
+    calls = []
+    position = 0
+    while True:
+        match = CALL_START.search(text, position)
+        if not match:
+            return calls
+        position = find_call_end(text, match.end())
+        calls.append(parse_call(match.group(1), text[match.start():position]))
+
+
+@functools.lru_cache(maxsize=None)
+def load_catalogue(file_path=CATALOGUE_FILE):
+    """
+    Names of the accepted expectations in the catalogue CSV.
+    """
+    with open(file_path, 'r', encoding='utf-8-sig') as file:
+        return frozenset(row['Expectations'].strip() for row in csv.DictReader(file) if row['Expectations'])
+
+
+def f1_score(precision, recall):
+    return 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+
+
+def set_scores(hypothesis, reference):
+    """
+    Precision, recall and F1 of two sets; two empty sets agree perfectly.
+    """
+    if not hypothesis and not reference:
+        return 1.0, 1.0, 1.0
+    overlap = len(hypothesis & reference)
+    precision = overlap / len(hypothesis) if hypothesis else 0.0
+    recall = overlap / len(reference) if reference else 0.0
+    return precision, recall, f1_score(precision, recall)
+
+
+def score_pair(reference, hypothesis, catalogue=None):
+    """
+    Structural scores of one hypothesis against its reference.
+
+    Returns:
+        dict: call_* scores compare whole calls (name and canonical arguments),
+        name_* scores only expectation names; exact_match is 1.0 when both sets
+        of calls are equal; valid_rate is the share of hypothesis calls naming a
+        catalogue expectation; parse_errors counts hypothesis calls that did not parse.
+    """
+    catalogue = load_catalogue() if catalogue is None else catalogue
+    reference_calls, hypothesis_calls = parse_expectations(reference), parse_expectations(hypothesis)
+    reference_set, hypothesis_set = set(reference_calls), set(hypothesis_calls)
+    call_precision, call_recall, call_f1 = set_scores(hypothesis_set, reference_set)
+    name_precision, name_recall, name_f1 = set_scores({call.name for call in hypothesis_set},
+                                                      {call.name for call in reference_set})
+    return {
+        'call_precision': call_precision,
+        'call_recall': call_recall,
+        'call_f1': call_f1,
+        'name_precision': name_precision,
+        'name_recall': name_recall,
+        'name_f1': name_f1,
+        'exact_match': float(hypothesis_set == reference_set),
+        'valid_rate': (sum(call.name in catalogue for call in hypothesis_calls) / len(hypothesis_calls)
+                       if hypothesis_calls else 0.0),
+        'parse_errors': sum(call.kwargs is None for call in hypothesis_calls),
+    }
+
+
+SCORE_COLUMNS = list(score_pair('', '', catalogue=frozenset()))
+
+
+def summarize(scores):
+    """
+    Mean of every structural score over the rows.
+    """
+    return {column: statistics.fmean(row[column] for row in scores) if scores else 0.0 for column in SCORE_COLUMNS}
+
+
+def main(args):
+    csv.field_size_limit(sys.maxsize)
+    catalogue = load_catalogue(args.catalogue)
+    with open(args.input, 'r', encoding='utf-8') as file:
+        rows = list(csv.DictReader(file))
+
+    start = time.perf_counter()
+    scores = [score_pair(row[args.reference_column], row[args.hypothesis_column], catalogue) for row in rows]
+    elapsed = time.perf_counter() - start
+
+    if args.output:
+        with open(args.output, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=['user_prompt', 'reference', 'hypothesis'] + SCORE_COLUMNS,
+                                    extrasaction='ignore')
+            writer.writeheader()
+            for row, score in zip(rows, scores):
+                writer.writerow({'user_prompt': row.get('user_prompt'), 'reference': row[args.reference_column],
+                                 'hypothesis': row[args.hypothesis_column], **score})
+
+    summary = summarize(scores)
+    print(json.dumps(summary, indent=2))
+    print(f"Scored {len(rows)} rows in {elapsed:.2f}s ({len(rows) / elapsed if elapsed else 0.0:.0f} rows/sec)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Structural scores of generated expectations against references.')
+    parser.add_argument('input', help='CSV with reference and hypothesis columns, e.g. Results/final_model_result.csv')
+    parser.add_argument('-o', '--output', default=None, help='Per-row CSV of the structural scores')
+    parser.add_argument('--reference-column', default='reference')
+    parser.add_argument('--hypothesis-column', default='hypothesis')
+    parser.add_argument('--catalogue', default=CATALOGUE_FILE, help='Accepted expectations catalogue (CSV)')
+    main(parser.parse_args())
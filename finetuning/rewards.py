@@ -0,0 +1,234 @@
+import argparse
+import functools
+import json
+import random
+import re
+import time
+
+from expectation_parser import CATALOGUE_FILE, SIMPLE_CALL, load_catalogue, parse_expectations, set_scores
+
+# RL_dataset.py answers end in `\n#### <expectations>`; the payload is everything after the last marker
+ANSWER_MARKER = '####'
+# A numbered reasoning step before the marker, e.g. `2. The order_date must be ...`
+REASONING_STEP = re.compile(r'^\s*\d+\.\s+\S', re.MULTILINE)
+# What may remain of a clean payload once its calls are removed: separators and the CSV quoting
+PAYLOAD_JUNK = re.compile(r'''[^\s,"']''')
+
+# Parts of the format reward: a payload with calls, reasoning steps before it, nothing but calls in it
+FORMAT_WEIGHTS = {'payload': 0.5, 'reasoning': 0.25, 'clean': 0.25}
+# Share of the overlap reward given for the right expectation names with wrong arguments
+NAME_OVERLAP_WEIGHT = 0.25
+DEFAULT_WEIGHTS = {'format': 0.2, 'validity': 0.3, 'overlap': 0.5}
+REWARD_COLUMNS = list(DEFAULT_WEIGHTS)
+
+
+def completion_text(completion):
+    """
+    Text of a completion, given as a string or as the conversational
+    `[{'role': 'assistant', 'content': ...}]` form TRL passes.
+    """
+    if isinstance(completion, str):
+        return completion
+    return completion[-1]['content'] if completion else ''
+
+
+def extract_payload(text):
+    """
+    Expectations after the last `####` marker, without the CSV quotes around them.
+
+    Returns:
+        tuple: (payload, reasoning before the marker); payload is None when there is no marker.
+    """
+    reasoning, marker, payload = text.rpartition(ANSWER_MARKER)
+    if not marker:
+        return None, text
+    return payload.strip().strip('"').replace('""', '"'), reasoning
+
+
+def reference_calls(reference):
+    """
+    Calls of a reference: a `generated_expectations` string or a GSM8K answer ending in `####`.
+    """
+    payload, _ = extract_payload(reference or '')
+    return frozenset(parse_expectations(reference if payload is None else payload))
+
+
+@functools.lru_cache(maxsize=65536)
+def completion_features(text, catalogue):
+    """
+    Format and validity rewards of one completion and its parsed calls.
+
+    GRPO samples each prompt several times and completions repeat across steps,
+    so this is cached on the text; `parse_expectations` caches the calls themselves.
+
+    Returns:
+        tuple: (format reward, validity reward, frozenset of calls).
+    """
+    payload, reasoning = extract_payload(text)
+    if payload is None:
+        return 0.0, 0.0, frozenset()
+    calls = parse_expectations(payload)
+    if not calls:
+        return 0.0, 0.0, frozenset()
+    format_reward = FORMAT_WEIGHTS['payload']
+    if REASONING_STEP.search(reasoning):
+        format_reward += FORMAT_WEIGHTS['reasoning']
+    if not PAYLOAD_JUNK.search(SIMPLE_CALL.sub('', payload)):
+        format_reward += FORMAT_WEIGHTS['clean']
+    valid = sum(call.kwargs is not None and call.name in catalogue for call in calls)
+    return format_reward, valid / len(calls), frozenset(calls)
+
+
+def overlap(calls, reference):
+    """
+    F1 of the calls against the reference calls, with partial credit for matching expectation names.
+    """
+    if not calls:
+        return 0.0
+    _, _, call_f1 = set_scores(calls, reference)
+    _, _, name_f1 = set_scores({call.name for call in calls}, {call.name for call in reference})
+    return (1 - NAME_OVERLAP_WEIGHT) * call_f1 + NAME_OVERLAP_WEIGHT * name_f1
+
+
+def batch_rewards(completions, references, catalogue=None, weights=None):
+    """
+    Format, validity and overlap rewards of a whole batch of completions.
+
+    Each distinct completion is parsed once (and cached across batches), each
+    distinct reference once per batch, and the weighted total is one matrix product.
+
+    Args:
+        completions (list): Completions, as strings or TRL conversational completions.
+        references (list): Reference expectations or GSM8K answers, one per completion.
+        catalogue (frozenset): Accepted expectation names; defaults to listExpectations.csv.
+        weights (dict): Weight of each reward in the total; defaults to DEFAULT_WEIGHTS.
+    Returns:
+        dict: numpy arrays 'format', 'validity', 'overlap' and 'total', one value per completion.
+    """
+    import numpy as np
+
+    catalogue = load_catalogue() if catalogue is None else catalogue
+    weights = DEFAULT_WEIGHTS if weights is None else weights
+    rewards = np.zeros((len(REWARD_COLUMNS), len(completions)))
+    references_seen = {}
+    for i, (completion, reference) in enumerate(zip(completions, references)):
+        format_reward, validity, calls = completion_features(completion_text(completion), catalogue)
+        if reference not in references_seen:
+            references_seen[reference] = reference_calls(reference)
+        rewards[:, i] = format_reward, validity, overlap(calls, references_seen[reference])
+    result = dict(zip(REWARD_COLUMNS, rewards))
+    result['total'] = np.array([weights[column] for column in REWARD_COLUMNS]) @ rewards
+    return result
+
+
+def format_reward(completions, **kwargs):
+    """
+    GRPO reward function (TRL signature) scoring the `####` answer layout.
+    """
+    catalogue = load_catalogue()
+    return [completion_features(completion_text(completion), catalogue)[0] for completion in completions]
+
+
+def validity_reward(completions, **kwargs):
+    """
+    GRPO reward function: share of the answer's calls that parse and name a catalogue expectation.
+    """
+    catalogue = load_catalogue()
+    return [completion_features(completion_text(completion), catalogue)[1] for completion in completions]
+
+
+def overlap_reward(completions, generated_expectations, **kwargs):
+    """
+    GRPO reward function: call overlap with the dataset's `generated_expectations` column.
+    """
+    return batch_rewards(completions, generated_expectations)['overlap'].tolist()
+
+
+def gsm8k_answer(expectations):
+    return f"1. The expectations follow from the prompt.\n\\n####  \"{expectations.replace(chr(34), chr(34) * 2)}\""
+
+
+def synthetic_completions(references, count, seed=0):
+    """
+    GSM8K-style completions built from references: exact answers, a dropped call,
+    a hallucinated expectation name, a trailing comment and a missing marker.
+    """
+    rng = random.Random(seed)
+    completions, completion_references = [], []
+    while len(completions) < count:
+        reference = rng.choice(references)
+        calls = [call.strip() for call in reference.split('),') if call.strip()]
+        variant = rng.randrange(5)
+        if variant == 1 and len(calls) > 1:
+            calls.pop(rng.randrange(len(calls)))
+        text = '),'.join(calls)
+        if variant == 2:
+            text = text.replace('expect_column_values_to_', 'expect_column_value_to_', 1)
+        elif variant == 3:
+            text += '  # replace with the actual value'
+        completion = text if variant == 4 else gsm8k_answer(text)
+        completions.append(completion)
+        completion_references.append(reference)
+    return completions, completion_references
+
+
+def benchmark(args):
+    """
+    Completions per second of `batch_rewards` over GRPO-sized batches, with cold and
+    warm caches, against scoring every completion on its own with uncompiled regexes.
+    """
+    with open(args.input, 'r', encoding='utf-8') as file:
+        references = [json.loads(line)['generated_expectations'] for line in file if line.strip()]
+    completions, completion_references = synthetic_completions(references, args.completions)
+    catalogue = load_catalogue(args.catalogue)
+
+    def per_completion(completions, completion_references):
+        # One completion at a time and nothing cached, as a naive reward function would
+        scores = []
+        for completion, reference in zip(completions, completion_references):
+            payload = re.search(r'####\s*(.*)\Z', completion, re.DOTALL)
+            if payload is None:
+                scores.append(0.0)
+                continue
+            calls = parse_expectations.__wrapped__(payload.group(1).strip().strip('"').replace('""', '"'))
+            valid = sum(call.name in catalogue for call in calls)
+            _, _, f1 = set_scores(set(calls), set(parse_expectations.__wrapped__(reference)))
+            scores.append(valid / len(calls) + f1 if calls else 0.0)
+        return scores
+
+    def batched():
+        for start in range(0, len(completions), args.batch_size):
+            batch_rewards(completions[start:start + args.batch_size],
+                          completion_references[start:start + args.batch_size], catalogue)
+
+    results = {}
+    naive_count = min(len(completions), args.naive_completions)
+    start = time.perf_counter()
+    per_completion(completions[:naive_count], completion_references[:naive_count])
+    results['per_completion'] = naive_count / (time.perf_counter() - start)
+    for mode in ('cold', 'warm'):
+        if mode == 'cold':
+            completion_features.cache_clear()
+            parse_expectations.cache_clear()
+        start = time.perf_counter()
+        batched()
+        results[f'batched_{mode}'] = len(completions) / (time.perf_counter() - start)
+
+    rewards = batch_rewards(completions, completion_references, catalogue)
+    for column in REWARD_COLUMNS + ['total']:
+        print(f"mean {column} reward: {rewards[column].mean():.3f}")
+    for mode, rate in results.items():
+        print(f"{mode:>15}: {rate:,.0f} completions/sec")
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the batch reward functions for GRPO training.')
+    parser.add_argument('-i', '--input', default='data/test.jsonl',
+                        help='JSONL with generated_expectations references to build completions from')
+    parser.add_argument('-n', '--completions', type=int, default=20000)
+    parser.add_argument('--naive-completions', type=int, default=2000,
+                        help='Completions scored one by one for the comparison')
+    parser.add_argument('--batch-size', type=int, default=64, help='Completions per reward call, e.g. 8 prompts x 8 generations')
+    parser.add_argument('--catalogue', default=CATALOGUE_FILE, help='Accepted expectations catalogue (CSV)')
+    benchmark(parser.parse_args())
@@ -0,0 +1,481 @@
+import argparse
+import copy
+import hashlib
+import json
+import logging
+import math
+import queue
+import random
+import threading
+import time
+import urllib.request
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from batch_inference import extract_expectations, read_jsonl, stop_token_ids
+from build_dataset import DEFAULT_INSTRUCTION
+from tokenized_cache import MERGED_PROMPT
+
+# Stands in for the user prompt when the chat template is rendered to find the shared prefix
+PROMPT_SENTINEL = '\x00USER_PROMPT\x00'
+# Queue waits of the most recent requests kept for the /stats percentile
+STATS_WINDOW = 10000
+
+
+def expand_cache(cache, batch_size):
+    """
+    Copy of a batch-1 KV cache repeated `batch_size` times along the batch dimension.
+    """
+    cache = copy.deepcopy(cache)
+    if hasattr(cache, 'batch_repeat_interleave'):
+        cache.batch_repeat_interleave(batch_size)
+        return cache
+    # Legacy tuple of (key, value) per layer
+    return tuple((key.repeat(batch_size, 1, 1, 1), value.repeat(batch_size, 1, 1, 1)) for key, value in cache)
+
+
+class PrefixCachedModel:
+    """
+    HF model answering user prompts in the finetuning format, reusing the KV cache of the shared prefix.
+
+    Every request renders to `<chat template start><instruction> \\n User prompt is: \\n<user prompt>...`.
+    The part before the user prompt is prefilled once at start-up. A batch is laid
+    out as [prefix][padding][prompt suffix]: the attention mask hides the padding
+    and the position ids continue from the prefix, so the cached prefix keys and
+    values are valid for every row and only the suffixes are prefilled.
+
+    Args:
+        model_name (str): Model id or path, e.g. a tiny HF model for CPU tests.
+        instruction (str): Instruction shared by all requests.
+        device (str): 'cuda', 'cpu' or None to pick CUDA when available.
+        dtype (str): torch dtype name.
+        max_new_tokens (int): Generation budget per prompt.
+        temperature (float): Sampling temperature, 0 for greedy decoding.
+        min_p (float): Min-p sampling threshold.
+        prefix_cache (bool): Reuse the prefix KV cache; False prefills every prompt in full.
+        constrained (bool): Only generate lists of catalogue expectation calls (constrained_decoding.py).
+    """
+
+    def __init__(self, model_name, instruction=DEFAULT_INSTRUCTION, device=None, dtype=None, max_new_tokens=256,
+                 temperature=0.0, min_p=0.1, prefix_cache=True, constrained=False):
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer, LogitsProcessorList
+
+        self.torch = torch
+        self.logits_processor_list = LogitsProcessorList
+        self.instruction = instruction
+        self.device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+        dtype = getattr(torch, dtype) if dtype else (torch.float16 if self.device == 'cuda' else torch.float32)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, padding_side='left')
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=dtype).to(self.device).eval()
+        self.stop_ids = stop_token_ids(self.tokenizer)
+        self.generation_kwargs = {'max_new_tokens': max_new_tokens, 'use_cache': True}
+        if temperature > 0:
+            self.generation_kwargs.update(do_sample=True, temperature=temperature, min_p=min_p)
+        else:
+            self.generation_kwargs.update(do_sample=False)
+        self.grammar = None
+        if constrained:
+            from constrained_decoding import GrammarIndex
+            self.grammar = GrammarIndex.from_tokenizer(self.tokenizer, self.stop_ids)
+
+        rendered = self.render(PROMPT_SENTINEL)
+        self.prefix_text = rendered[:rendered.index(PROMPT_SENTINEL)]
+        self.prefix_ids = self.tokenizer(self.prefix_text, add_special_tokens=False).input_ids
+        self.prefix_cache = None
+        if prefix_cache:
+            with torch.inference_mode():
+                output = self.model(torch.tensor([self.prefix_ids], device=self.device), use_cache=True)
+            self.prefix_cache = output.past_key_values
+        self.stats = {'prompt_tokens': 0, 'prefill_tokens_saved': 0}
+
+    def render(self, user_prompt):
+        content = MERGED_PROMPT.format(instruction=self.instruction, user_prompt=user_prompt)
+        if getattr(self.tokenizer, 'chat_template', None):
+            return self.tokenizer.apply_chat_template([{'role': 'user', 'content': content}],
+                                                      tokenize=False, add_generation_prompt=True)
+        return content
+
+    def encode(self, user_prompts):
+        """
+        input_ids and attention_mask of a batch; [prefix][padding][suffix] rows when the prefix is cached.
+        """
+        texts = [self.render(user_prompt) for user_prompt in user_prompts]
+        pad_id = self.tokenizer.pad_token_id
+        if self.prefix_cache is None:
+            rows = [self.tokenizer(text, add_special_tokens=False).input_ids for text in texts]
+            width = max(len(row) for row in rows)
+            input_ids = [[pad_id] * (width - len(row)) + row for row in rows]
+            attention_mask = [[0] * (width - len(row)) + [1] * len(row) for row in rows]
+        else:
+            suffixes = [self.tokenizer(text[len(self.prefix_text):], add_special_tokens=False).input_ids
+                        for text in texts]
+            width = max(len(suffix) for suffix in suffixes)
+            input_ids = [self.prefix_ids + [pad_id] * (width - len(suffix)) + suffix for suffix in suffixes]
+            attention_mask = [[1] * len(self.prefix_ids) + [0] * (width - len(suffix)) + [1] * len(suffix)
+                              for suffix in suffixes]
+            self.stats['prefill_tokens_saved'] += len(self.prefix_ids) * len(texts)
+        self.stats['prompt_tokens'] += sum(map(sum, attention_mask))
+        return (self.torch.tensor(input_ids, device=self.device),
+                self.torch.tensor(attention_mask, device=self.device))
+
+    def generate(self, user_prompts):
+        """
+        Returns (answer text, number of generated tokens) per prompt, in order.
+        """
+        input_ids, attention_mask = self.encode(user_prompts)
+        kwargs = dict(self.generation_kwargs)
+        if self.prefix_cache is not None:
+            kwargs['past_key_values'] = expand_cache(self.prefix_cache, len(user_prompts))
+        if self.grammar:
+            kwargs['logits_processor'] = self.logits_processor_list([self.grammar.processor()])
+        with self.torch.inference_mode():
+            outputs = self.model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                          eos_token_id=self.stop_ids, pad_token_id=self.tokenizer.pad_token_id,
+                                          **kwargs)
+        results = []
+        for tokens in outputs[:, input_ids.shape[1]:].tolist():
+            end = next((i for i, token in enumerate(tokens) if token in self.stop_ids), len(tokens))
+            results.append((self.tokenizer.decode(tokens[:end], skip_special_tokens=True), end))
+        return results
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests into batches for one generate function.
+
+    A batch is closed `max_wait_ms` after its first request arrived or when it
+    holds `max_batch_size` requests, whichever comes first; one worker thread
+    runs the batches one after the other.
+
+    Args:
+        generate (callable): Takes a list of prompts, returns one result per prompt.
+        max_batch_size (int): Largest batch.
+        max_wait_ms (float): Latency window a request may wait for others to join its batch.
+    """
+
+    def __init__(self, generate, max_batch_size=8, max_wait_ms=10.0):
+        self.generate = generate
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.batched_requests = 0
+        self.queue_waits = deque(maxlen=STATS_WINDOW)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, prompt):
+        future = Future()
+        self.queue.put((prompt, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            self.batches += 1
+            self.batched_requests += len(batch)
+            self.queue_waits.extend(started - queued for _, _, queued in batch)
+            try:
+                results = list(self.generate([prompt for prompt, _, _ in batch]))
+                if len(results) != len(batch):
+                    # Unmatched requests would otherwise wait on their futures forever
+                    raise RuntimeError(f"generate returned {len(results)} results for {len(batch)} prompts")
+            except Exception as e:
+                logging.error(f"Batch of {len(batch)} failed: {e}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+
+class ResponseCache:
+    """
+    Thread-safe exact-match LRU cache of answers, keyed by the hash of the instruction and user prompt.
+
+    Args:
+        max_entries (int): Entries kept; the least recently used one is evicted first. 0 disables the cache.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @staticmethod
+    def key(instruction, user_prompt):
+        return hashlib.sha256(json.dumps([instruction, user_prompt]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        """
+        Cached value without counting a hit or miss or refreshing its position.
+        """
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, value):
+        if not self.max_entries:
+            return
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class ExpectationService:
+    """
+    Answers user prompts from the response cache, or through the micro-batcher;
+    identical prompts already in flight share one generation.
+    """
+
+    def __init__(self, model, max_batch_size=8, max_wait_ms=10.0, cache_entries=10000):
+        self.model = model
+        self.batcher = MicroBatcher(model.generate, max_batch_size, max_wait_ms)
+        self.cache = ResponseCache(cache_entries)
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def answer(self, user_prompt):
+        key = ResponseCache.key(self.model.instruction, user_prompt)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return dict(cached, cached=True)
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is None:
+                # The generation may have finished since the cache lookup: answers are cached
+                # before they leave in_flight, so one of the two has it
+                cached = self.cache.peek(key)
+                if cached is not None:
+                    return dict(cached, cached=True)
+                future = self.in_flight[key] = self.batcher.submit(user_prompt)
+        try:
+            text, n_tokens = future.result()
+            answer = {'generated_expectations': text.strip(), 'great_expectations': extract_expectations(text),
+                      'generated_tokens': n_tokens}
+            self.cache.put(key, answer)
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+        return dict(answer, cached=False)
+
+    def stats(self):
+        batches = self.batcher.batches
+        waits = sorted(self.batcher.queue_waits)
+        return {
+            'batches': batches,
+            'mean_batch_size': self.batcher.batched_requests / batches if batches else 0.0,
+            'queue_wait_p50_ms': waits[len(waits) // 2] * 1000 if waits else 0.0,
+            'cache_hits': self.cache.hits,
+            'cache_misses': self.cache.misses,
+            'cache_entries': len(self.cache.entries),
+            **getattr(self.model, 'stats', {}),
+        }
+
+
+class ExpectationHandler(BaseHTTPRequestHandler):
+    """
+    `POST /v1/expectations` with {"user_prompt": ...}; `GET /health` and `GET /stats`.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/') == '/health':
+            self._send_json(200, {'status': 'ok'})
+        elif self.path.rstrip('/') == '/stats':
+            self._send_json(200, self.server.service.stats())
+        else:
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if self.path.rstrip('/') != '/v1/expectations':
+            self.rfile.read(length)
+            self._send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            user_prompt = json.loads(self.rfile.read(length) or b'{}')['user_prompt'].strip()
+        except (ValueError, KeyError, TypeError, AttributeError):
+            self._send_json(400, {'error': 'Expected a JSON body with a "user_prompt" string'})
+            return
+        start = time.perf_counter()
+        try:
+            answer = self.server.service.answer(user_prompt)
+        except Exception as e:
+            self._send_json(500, {'error': str(e)})
+            return
+        self._send_json(200, dict(answer, latency_ms=(time.perf_counter() - start) * 1000))
+
+
+class ExpectationServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 makes bursts of concurrent connections wait for a 1 s SYN retry
+    request_queue_size = 128
+
+
+def start_server(service, host='127.0.0.1', port=0):
+    """
+    Start the service on a background thread; its base URL is `server.base_url`.
+    """
+    server = ExpectationServer((host, port), ExpectationHandler)
+    server.service = service
+    server.base_url = f'http://{host}:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def post_prompt(base_url, user_prompt, timeout=300):
+    request = urllib.request.Request(f"{base_url}/v1/expectations", method='POST',
+                                     data=json.dumps({'user_prompt': user_prompt}).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return json.loads(response.read())
+
+
+def load_test(base_url, prompts, requests=200, concurrency=16, seed=0):
+    """
+    Sends `requests` prompts drawn from `prompts` (with repeats) from `concurrency` client threads.
+
+    Returns:
+        dict: Throughput, p50/p90/p99 latency, cache hits and the server's stats.
+    """
+    rng = random.Random(seed)
+    workload = [rng.choice(prompts) for _ in range(requests)]
+    latencies, cached, errors = [], 0, 0
+
+    def send(user_prompt):
+        start = time.perf_counter()
+        answer = post_prompt(base_url, user_prompt)
+        return time.perf_counter() - start, answer['cached']
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(send, user_prompt) for user_prompt in workload]:
+            try:
+                latency, was_cached = future.result()
+            except Exception as e:
+                logging.error(f"Request failed: {e}")
+                errors += 1
+                continue
+            latencies.append(latency)
+            cached += was_cached
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    def percentile(p):
+        # Nearest rank, as tracing.percentile
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, max(0, math.ceil(p * len(latencies)) - 1))] * 1000
+
+    with urllib.request.urlopen(f"{base_url}/stats") as response:
+        server_stats = json.loads(response.read())
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'elapsed_seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'latency_p50_ms': percentile(0.50),
+        'latency_p90_ms': percentile(0.90),
+        'latency_p99_ms': percentile(0.99),
+        'cached_responses': cached,
+        'server': server_stats,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='HTTP inference service with micro-batching, prefix KV caching and a response cache.')
+    parser.add_argument('--model', default='hf-internal-testing/tiny-random-LlamaForCausalLM',
+                        help='Model id or path, e.g. the finetuned model; the default tiny model runs on CPU')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--instruction', default=DEFAULT_INSTRUCTION)
+    parser.add_argument('--max-batch-size', type=int, default=8)
+    parser.add_argument('--max-wait-ms', type=float, default=10.0, help='Latency window for filling a batch')
+    parser.add_argument('--cache-entries', type=int, default=10000, help='Response cache size, 0 disables it')
+    parser.add_argument('--no-prefix-cache', action='store_true', help='Prefill every prompt in full')
+    parser.add_argument('--constrained', action='store_true', help='Only generate catalogue expectation calls')
+    parser.add_argument('--max-new-tokens', type=int, default=256)
+    parser.add_argument('--temperature', type=float, default=0.0, help='0 for greedy decoding')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--dtype', default=None)
+    parser.add_argument('--load-test', action='store_true',
+                        help='Start the server on a free port, run the load generator against it and exit')
+    parser.add_argument('--url', default=None, help='Run the load generator against this running server instead')
+    parser.add_argument('-i', '--input', default='data/eval.jsonl', help='Prompts of the load generator')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--unique-prompts', type=int, default=100, help='Distinct prompts the load is drawn from')
+    parser.add_argument('-o', '--output', default=None, help='JSON file for the load test report')
+    args = parser.parse_args()
+
+    if args.url:
+        base_url = args.url.rstrip('/')
+    else:
+        model = PrefixCachedModel(args.model, instruction=args.instruction, device=args.device, dtype=args.dtype,
+                                  max_new_tokens=args.max_new_tokens, temperature=args.temperature,
+                                  prefix_cache=not args.no_prefix_cache, constrained=args.constrained)
+        service = ExpectationService(model, args.max_batch_size, args.max_wait_ms, args.cache_entries)
+        server = start_server(service, args.host, 0 if args.load_test else args.port)
+        base_url = server.base_url
+        print(f"Serving {args.model} on {base_url}/v1/expectations "
+              f"(prefix of {len(model.prefix_ids)} tokens {'not ' if args.no_prefix_cache else ''}cached)")
+        if not args.load_test:
+            try:
+                threading.Event().wait()
+            except KeyboardInterrupt:
+                server.shutdown()
+            raise SystemExit(0)
+
+    prompts = [record['user_prompt'] for record, _ in zip(read_jsonl(args.input), range(args.unique_prompts))]
+    report = load_test(base_url, prompts, requests=args.requests, concurrency=args.concurrency)
+    logging.info(f"Load test: {report}")
+    print(f"{report['requests']} requests ({args.concurrency} concurrent, {len(prompts)} distinct prompts): "
+          f"{report['requests_per_second']:.1f} requests/sec, p50 {report['latency_p50_ms']:.0f} ms, "
+          f"p90 {report['latency_p90_ms']:.0f} ms, p99 {report['latency_p99_ms']:.0f} ms, "
+          f"{report['cached_responses']} from the response cache, {report['errors']} errors")
+    print(f"Server: {report['server']}")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
@@ -0,0 +1,240 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from importlib import metadata
+
+DEFAULT_CACHE_DIR = os.getenv('TOKENIZED_CACHE_DIR', './.cache/tokenized')
+# The notebook's `to_sharegpt(merged_prompt=...)`; the [[...]] part is included when user_prompt is set
+MERGED_PROMPT = "{instruction} \n User prompt is: \n{user_prompt}"
+OUTPUT_COLUMN = 'generated_expectations'
+# Examples tokenized (and packed) per `Dataset.map` batch
+MAP_BATCH_SIZE = 1000
+
+# Bump when the formatting, tokenization or packing below changes, so old entries are not reused
+CACHE_SCHEMA = 1
+
+
+def file_hash(file_path):
+    """
+    Content hash of a dataset file, streamed in 1 MiB blocks.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def package_version(name):
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return 'unknown'
+
+
+def tokenizer_identity(tokenizer, revision=None):
+    """
+    Name, revision and chat template of a tokenizer: everything that changes its output for the same text.
+    """
+    chat_template = getattr(tokenizer, 'chat_template', None) or ''
+    return {
+        'name': tokenizer.name_or_path,
+        'revision': revision or tokenizer.init_kwargs.get('_commit_hash') or tokenizer.init_kwargs.get('revision'),
+        'class': type(tokenizer).__name__,
+        'vocab_size': len(tokenizer),
+        'chat_template': hashlib.sha256(chat_template.encode('utf-8')).hexdigest(),
+        'transformers': package_version('transformers'),
+    }
+
+
+def cache_key(content_hash, tokenizer, max_seq_length, packing, revision=None):
+    """
+    Key of a tokenized dataset: (dataset content, tokenizer name/revision, chat template, max_seq_length, packing).
+
+    Returns:
+        tuple: (hex key, the parts it was computed from).
+    """
+    parts = {
+        'schema': CACHE_SCHEMA,
+        'content': content_hash,
+        'tokenizer': tokenizer_identity(tokenizer, revision),
+        'max_seq_length': max_seq_length,
+        'packing': packing,
+        'merged_prompt': MERGED_PROMPT,
+    }
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()[:32], parts
+
+
+def to_conversation(instruction, user_prompt, expectations):
+    """
+    One row as `to_sharegpt` + `standardize_sharegpt` turned it into a conversation.
+    """
+    return [
+        {'role': 'user', 'content': MERGED_PROMPT.format(instruction=instruction, user_prompt=user_prompt)},
+        {'role': 'assistant', 'content': expectations},
+    ]
+
+
+def pack_sequences(sequences, max_seq_length, separator_id):
+    """
+    Concatenates token sequences, `separator_id` after each, and cuts the stream into blocks
+    of `max_seq_length` tokens, as `SFTTrainer(packing=True)` does. The last block may be shorter.
+    """
+    blocks, stream = [], []
+    for sequence in sequences:
+        stream.extend(sequence)
+        if separator_id is not None and (not sequence or sequence[-1] != separator_id):
+            stream.append(separator_id)
+        while len(stream) >= max_seq_length:
+            blocks.append(stream[:max_seq_length])
+            stream = stream[max_seq_length:]
+    if stream:
+        blocks.append(stream)
+    return blocks
+
+
+def load_source(dataset_file):
+    """
+    Loads a JSONL split (data/train.jsonl) or an Arrow split written by build_dataset.py.
+    """
+    from datasets import Dataset, load_dataset
+
+    if dataset_file.endswith('.arrow'):
+        return Dataset.from_file(dataset_file)
+    return load_dataset('json', data_files=dataset_file, split='train')
+
+
+def tokenize_dataset(dataset, tokenizer, max_seq_length, packing=False, num_proc=None):
+    """
+    Applies the chat template and tokenizes, with the columns `SFTTrainer` expects of a
+    prepared dataset: `text`, `input_ids` and `attention_mask` (only the last two when packed).
+    """
+    bos = tokenizer.bos_token or ''
+
+    def tokenize(batch):
+        texts = [
+            tokenizer.apply_chat_template(to_conversation(instruction, user_prompt, expectations),
+                                          tokenize=False, add_generation_prompt=False)
+            for instruction, user_prompt, expectations in zip(batch['instruction'], batch['user_prompt'],
+                                                              batch[OUTPUT_COLUMN])
+        ]
+        # The chat template already starts with the BOS token
+        encoded = [tokenizer(text, add_special_tokens=not (bos and text.startswith(bos)),
+                             truncation=True, max_length=max_seq_length).input_ids for text in texts]
+        if packing:
+            blocks = pack_sequences(encoded, max_seq_length, tokenizer.eos_token_id)
+            return {'input_ids': blocks, 'attention_mask': [[1] * len(block) for block in blocks]}
+        return {'text': texts, 'input_ids': encoded, 'attention_mask': [[1] * len(ids) for ids in encoded]}
+
+    return dataset.map(tokenize, batched=True, batch_size=MAP_BATCH_SIZE, num_proc=num_proc,
+                       remove_columns=dataset.column_names, desc='Tokenizing')
+
+
+def get_tokenized_dataset(dataset_file, tokenizer, max_seq_length=512, packing=False, revision=None,
+                          cache_dir=DEFAULT_CACHE_DIR, num_proc=None):
+    """
+    Tokenized dataset for `SFTTrainer`, built once per (content, tokenizer, template,
+    max_seq_length, packing) and memory-mapped from the cache afterwards.
+
+    Replaces `to_standardize_sharegpt(convert_data_to_sharegpt(dataset_file), tokenizer)`
+    in the notebook's `objective`, so Optuna trials (in this or another process) only
+    pay for the formatting and tokenization once. Pass the result with
+    `dataset_kwargs={'skip_prepare_dataset': True}`; a packed dataset is already
+    packed, so also pass `packing=False`.
+
+    Args:
+        dataset_file (str): JSONL or Arrow split with instruction, user_prompt and generated_expectations.
+        tokenizer: Tokenizer with the chat template applied (e.g. after `get_chat_template`).
+        max_seq_length (int): Truncation length, and block length when packing.
+        packing (bool): Pack the examples into `max_seq_length` blocks.
+        revision (str): Tokenizer revision, when the tokenizer does not record its commit hash.
+        cache_dir (str): Directory of the cache entries.
+        num_proc (int): Processes for `Dataset.map` on a cache miss.
+
+    Returns:
+        datasets.Dataset
+    """
+    from datasets import load_from_disk
+
+    key, parts = cache_key(file_hash(dataset_file), tokenizer, max_seq_length, packing, revision)
+    path = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(path, 'cache_info.json')):
+        logging.info(f"Tokenized cache hit for {dataset_file}: {path}")
+        return load_from_disk(path)
+
+    start = time.perf_counter()
+    dataset = tokenize_dataset(load_source(dataset_file), tokenizer, max_seq_length, packing, num_proc)
+    # Written under a temporary name and renamed, so concurrent trials never read a partial entry
+    temporary = os.path.join(cache_dir, f".{key}.{uuid.uuid4().hex}")
+    dataset.save_to_disk(temporary)
+    with open(os.path.join(temporary, 'cache_info.json'), 'w') as file:
+        json.dump({'source': dataset_file, 'rows': len(dataset), 'seconds': time.perf_counter() - start, **parts},
+                  file, indent=2)
+    try:
+        os.rename(temporary, path)
+    except OSError:
+        # Another process stored the same entry first
+        shutil.rmtree(temporary, ignore_errors=True)
+    logging.info(f"Tokenized {dataset_file} in {time.perf_counter() - start:.1f}s, cached at {path}")
+    return load_from_disk(path)
+
+
+def list_entries(cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Info of every cache entry, newest first.
+    """
+    entries = []
+    if os.path.isdir(cache_dir):
+        for name in os.listdir(cache_dir):
+            info_file = os.path.join(cache_dir, name, 'cache_info.json')
+            if os.path.exists(info_file):
+                with open(info_file, 'r') as file:
+                    entries.append({'key': name, 'modified': os.path.getmtime(info_file), **json.load(file)})
+    return sorted(entries, key=lambda entry: entry['modified'], reverse=True)
+
+
+def load_tokenizer(name, revision=None, chat_template=None):
+    """
+    AutoTokenizer of `name`; `chat_template` (e.g. 'llama-3.1') applies the unsloth template the notebook uses.
+    """
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(name, revision=revision)
+    if chat_template:
+        from unsloth.chat_templates import get_chat_template
+        tokenizer = get_chat_template(tokenizer, chat_template=chat_template)
+    return tokenizer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build (or reuse) the tokenized datasets of the finetuning trials ahead of time.')
+    parser.add_argument('-i', '--inputs', nargs='+', default=['data/train.jsonl', 'data/eval.jsonl'],
+                        help='JSONL or Arrow splits')
+    parser.add_argument('--tokenizer', default='unsloth/Llama-3.2-3B-bnb-4bit')
+    parser.add_argument('--revision', default=None)
+    parser.add_argument('--chat-template', default='llama-3.1', help='unsloth chat template name, empty to keep the tokenizer\'s')
+    parser.add_argument('--max-seq-length', type=int, default=512)
+    parser.add_argument('--packing', action='store_true', help='Pre-pack the examples into max-seq-length blocks')
+    parser.add_argument('--num-proc', type=int, default=None)
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR)
+    parser.add_argument('--list', action='store_true', help='List the cache entries and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for entry in list_entries(args.cache_dir):
+            print(f"{entry['key']}  {entry['source']}  rows {entry['rows']}  max_seq_length {entry['max_seq_length']}  "
+                  f"packing {entry['packing']}  tokenizer {entry['tokenizer']['name']}")
+    else:
+        tokenizer = load_tokenizer(args.tokenizer, args.revision, args.chat_template)
+        for dataset_file in args.inputs:
+            start = time.perf_counter()
+            dataset = get_tokenized_dataset(dataset_file, tokenizer, args.max_seq_length, args.packing,
+                                            revision=args.revision, cache_dir=args.cache_dir, num_proc=args.num_proc)
+            print(f"{dataset_file}: {len(dataset)} rows ready in {time.perf_counter() - start:.2f}s "
+                  f"(a second run loads them from {args.cache_dir})")